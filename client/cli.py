@@ -2,22 +2,42 @@
 
 import sys
 import argparse
+import ipaddress
+import json
+import statistics
+import time
 import yaml
 import os
+import re
 import subprocess
+import tempfile
 
 debug = False
 
-def run(cmd):
+# host facts are cached per host, a later run within the ttl in seconds
+# reuses them instead of querying the hosts again.
+FACTS_DIR = os.path.expanduser('~/.cache/lustre-deploy/facts')
+FACTS_TTL = 600
+# seconds to wait for the namespaces of the nvme targets once connected.
+NVME_CONNECT_TIMEOUT = 60
+
+def run(cmd, capture=False, check=True):
     global debug
 
     if debug:
         print(f"=> debug {cmd}", flush=True)
-        return
+        return '' if capture else None
 
     print(f"=> {cmd}", flush=True)
+    if not check:
+        # the caller copes with the hosts that failed.
+        result = subprocess.run(cmd, shell=True, check=False,
+                                stdout=subprocess.PIPE if capture else None, text=True)
+        print("", flush=True)
+        return result.stdout
     try:
-        result = subprocess.run(cmd, shell=True, check=True)
+        result = subprocess.run(cmd, shell=True, check=True,
+                                stdout=subprocess.PIPE if capture else None, text=True)
     except subprocess.CalledProcessError as e:
         print(f"Command failed: {cmd}\nExit code: {e.returncode}")
         sys.exit(e.returncode)
@@ -26,6 +46,7 @@ def run(cmd):
         sys.exit(result.returncode)
 
     print("", flush=True)
+    return result.stdout
 
 
 class ClientDispacher:
@@ -50,6 +71,32 @@ class ClientDispacher:
         agent = self.workfile(self.agent)
         run(f'clush -qS -w {self.hosts} -b {agent} {opname} {opargs}')
 
+    def query(self, opname, *args, fanout=None):
+        """
+        execute an op on all hosts and return the json lines printed
+        by each host, keyed by host. A host that is unreachable or whose
+        op fails does not stop the others; it is only missing from the
+        result, or has the lines it printed before failing.
+        """
+        opargs = ' '.join(str(arg) for arg in args)
+        agent = self.workfile(self.agent)
+        fanopt = f'-f {fanout} ' if fanout else ''
+        output = run(f'clush -q {fanopt}-w {self.hosts} {agent} {opname} {opargs}',
+                     capture=True, check=False)
+        results = {}
+        for line in output.splitlines():
+            host, _, data = line.partition(': ')
+            if data.startswith('{'):
+                results.setdefault(host, []).append(json.loads(data))
+        return results
+
+    def count(self):
+        output = run(f'nodeset -c {self.hosts}', capture=True)
+        return int(output) if output.strip() else 1
+
+    def hostnames(self):
+        return run(f'nodeset -e {self.hosts}', capture=True).split()
+
     def copy(self, *files):
         copyfiles = ' '.join(files)
         run(f'clush -qS -w {self.hosts} --copy {copyfiles} --dest {self.workdir}')
@@ -86,6 +133,31 @@ class ClientItem:
     def dump(self, dispacher):
         pass
 
+    def bench(self, dispacher, opts):
+        pass
+
+    def status(self, facts):
+        """
+        the rows of the components of this item, one per host, from the
+        records gathered on each host.
+        """
+        return []
+
+    def preflight(self, facts):
+        """
+        what this item needs but a host does not have, one error per
+        host, from the facts gathered on each host.
+        """
+        return []
+
+
+def status_row(host, component, state='healthy', detail=''):
+    return {'host': host, 'component': component, 'state': state, 'detail': detail}
+
+
+def fact_names(records, *kinds):
+    return {record['name'] for record in records if record['kind'] in kinds}
+
 
 class ClientPkgs(ClientItem):
     def __init__(self, cfg):
@@ -109,6 +181,19 @@ class ClientPkgs(ClientItem):
             return pkg
         dispacher.execute('apt_uninstall', *map(getname, self.pkgs))
 
+    def preflight(self, facts):
+        # the module packages are built for one kernel, as in
+        # lustre-client-modules-5.15.0-94-generic_2.14.0-ddn85-1_amd64.deb
+        kernels = {match.group(1) for match in
+                   (re.match(r'.*-modules-(\d+\.\d+[^_]*)_', os.path.basename(pkg)) for pkg in self.pkgs)
+                   if match}
+        errors = []
+        for host, records in facts.items():
+            kernel = next((r['kernel'] for r in records if r['kind'] == 'host'), None)
+            errors += [f'{host}: kernel {kernel}, modules built for {k}'
+                       for k in kernels if k != kernel]
+        return errors
+
 
 class ClientItemSet(ClientItem):
     def __init__(self, cfg):
@@ -146,6 +231,16 @@ class ClientItemSet(ClientItem):
         for item in self.items:
             item.dump(dispacher)
 
+    def bench(self, dispacher, opts):
+        for item in self.items:
+            item.bench(dispacher, opts)
+
+    def status(self, facts):
+        return [row for item in self.items for row in item.status(facts)]
+
+    def preflight(self, facts):
+        return [error for item in self.items for error in item.preflight(facts)]
+
 
 class LfsNetwork(ClientItem):
     def __init__(self, cfg):
@@ -159,6 +254,11 @@ class LfsNetwork(ClientItem):
     def nics(self):
         return self.cfg['nics']
 
+    def preflight(self, facts):
+        return [f'{host}: no nic {nic} for {self.net}'
+                for host, records in facts.items()
+                for nic in self.nics.split(',') if nic not in fact_names(records, 'nic')]
+
 
 class LfsNetWorks(ClientItemSet):
     def __init__(self, cfg):
@@ -183,6 +283,19 @@ class LfsNetWorks(ClientItemSet):
     def dump(self, dispacher):
         dispacher.execute('lfs_dump_networks')
 
+    def status(self, facts):
+        rows = []
+        for lnet in self.items:
+            # tcp0 is listed as tcp by lctl.
+            nets = (lnet.net, lnet.net[:-1] if lnet.net.endswith('0') else lnet.net)
+            for host, records in facts.items():
+                nids = [r['name'] for r in records if r['kind'] == 'nid']
+                if any(nid.partition('@')[2] in nets for nid in nids):
+                    rows.append(status_row(host, f'lnet {lnet.net}'))
+                else:
+                    rows.append(status_row(host, f'lnet {lnet.net}', 'missing', 'no nid'))
+        return rows
+
 
 class LfsRoute(ClientItem):
     def __init__(self, cfg):
@@ -201,8 +314,8 @@ class LfsRoutes(ClientItemSet):
     def __init__(self, cfg):
         super().__init__(cfg)
 
-    def getitem(self):
-        return [LfsRoute(cfg) for cfg in self.cfg[
+    def getitems(self):
+        return [LfsRoute(cfg) for cfg in self.cfg]
 
     @property
     def routes(self):
@@ -221,6 +334,21 @@ class LfsRoutes(ClientItemSet):
     def dump(self, dispacher):
         dispacher.execute('lfs_dump_routes')
 
+    def status(self, facts):
+        rows = []
+        for route in self.items:
+            component = f'route {route.net} {route.nid}'
+            for host, records in facts.items():
+                states = [r['state'] for r in records if r['kind'] == 'route'
+                          and r['name'] == route.net and r['gateway'] == route.nid]
+                if not states:
+                    rows.append(status_row(host, component, 'missing'))
+                elif 'up' not in states:
+                    rows.append(status_row(host, component, 'degraded', 'gateway down'))
+                else:
+                    rows.append(status_row(host, component))
+        return rows
+
 
 class LfsMount(ClientItem):
     def __init__(self, cfg):
@@ -255,6 +383,52 @@ class LfsMount(ClientItem):
         #dispacher.execute('lfs_dump_mount', self.srcpath, self.dstpath, self.options)
         pass
 
+    def bench(self, dispacher, opts):
+        # all hosts wait for the same start time, so the fan-out has to
+        # reach every host at once.
+        nhost = dispacher.count()
+        starttime = int(time.time()) + opts.start_delay
+        results = dispacher.query('lfs_bench', self.dstpath, starttime, opts.runtime,
+                                  opts.size, opts.nfiles, fanout=nhost)
+        # a host whose bench failed, e.g. not mounted, prints no result.
+        results = {host: lines[-1] for host, lines in results.items()
+                   if 'write_mbs' in lines[-1]}
+        report = bench_report(self.dstpath, results, dispacher.hostnames(), opts.tolerance)
+        print(json.dumps(report, indent=2))
+        opts.reports.append(report)
+
+    def status(self, facts):
+        component = f'mount {self.dstpath}'
+        dstpath = os.path.normpath(self.dstpath)
+        return [status_row(host, component)
+                if {'kind': 'mount', 'name': dstpath} in records
+                else status_row(host, component, 'missing', 'not mounted')
+                for host, records in facts.items()]
+
+def bench_report(dstpath, results, hosts, tolerance):
+    """
+    aggregate the per-host results of one mount and find the stragglers,
+    i.e. hosts notably below the median of any metric. The hosts without
+    a result are missing.
+    """
+    metrics = ('write_mbs', 'read_mbs', 'create_ops')
+    report = {
+        'mount': dstpath,
+        'hosts': results,
+        'missing': [host for host in hosts if host not in results],
+        'aggregate': {key: sum(res[key] for res in results.values()) for key in metrics},
+        'stragglers': {},
+    }
+    for key in metrics:
+        if not results:
+            break
+        median = statistics.median(res[key] for res in results.values())
+        for host, res in results.items():
+            if res[key] < median * (1 - tolerance):
+                report['stragglers'].setdefault(host, []).append(key)
+    return report
+
+
 class LfsMounts(ClientItemSet):
     def __init__(self, cfg):
         super().__init__(cfg)
@@ -300,6 +474,27 @@ class LvmNvmet(ClientItem):
     def trsvcid(self):
         return self.cfg['trsvcid']
 
+    @property
+    def namespaces(self):
+        """
+        the links of the namespaces expected from the target, e.g.
+        n059-0000:01:00.0-n1 for /dev/disk/nvme/n059-0000:01:00.0-n1.
+        """
+        return [f'/dev/disk/nvme/{name}' for name in self.cfg.get('namespaces', [])]
+
+    @property
+    def connect_timeout(self):
+        return self.cfg.get('connect_timeout', NVME_CONNECT_TIMEOUT)
+
+    def preflight(self, facts):
+        if 'host_traddr' not in self.cfg:
+            return [f'nvmet {self.traddr}: no host_traddr']
+        network = ipaddress.ip_network(self.host_traddr, strict=False)
+        return [f'{host}: no address in {network} to connect {self.traddr}'
+                for host, records in facts.items()
+                if not any(ipaddress.ip_address(addr) in network
+                           for addr in fact_names(records, 'ipaddr'))]
+
 
 class LvmNvmets(ClientItemSet):
     def __init__(self, cfg):
@@ -320,7 +515,11 @@ class LvmNvmets(ClientItemSet):
         dispacher.execute("lvm_del_nvmets")
 
     def start(self, dispacher):
-        dispacher.execute("lvm_start_nvmets")
+        # the vgs start right after, so the namespaces must be there.
+        timeout = max([nvmet.connect_timeout for nvmet in self.items if nvmet.namespaces],
+                      default=NVME_CONNECT_TIMEOUT)
+        dispacher.execute("lvm_start_nvmets", str(timeout),
+                          *[path for nvmet in self.items for path in nvmet.namespaces])
 
     def stop(self, dispacher):
         dispacher.execute("lvm_stop_nvmets")
@@ -328,6 +527,23 @@ class LvmNvmets(ClientItemSet):
     def dump(self, dispacher):
         dispacher.execute('lvm_dump_nvmets')
 
+    def status(self, facts):
+        rows = []
+        for nvmet in self.items:
+            component = f'nvme {nvmet.traddr}'
+            for host, records in facts.items():
+                states = [r['state'] for r in records if r['kind'] == 'nvme_ctrl'
+                          and f"traddr={nvmet.traddr}," in f"{r['address']},"]
+                live = states.count('live')
+                if not states:
+                    rows.append(status_row(host, component, 'missing', 'not connected'))
+                elif live < len(states):
+                    rows.append(status_row(host, component, 'degraded',
+                                           f'{live}/{len(states)} controllers live'))
+                else:
+                    rows.append(status_row(host, component))
+        return rows
+
 
 class LvmIscsit(ClientItem):
     def __init__(self, cfg):
@@ -345,17 +561,67 @@ class LvmIscsit(ClientItem):
     def port(self):
         return self.cfg['port']
 
+    @property
+    def nr_sessions(self):
+        return self.cfg.get('nr_sessions', 1)
+
+    @property
+    def ifaces(self):
+        """
+        the nics the sessions are bound to, each with its own iscsi
+        iface. Without any, the sessions follow the routing table.
+        """
+        return self.cfg.get('ifaces', [])
+
+    @property
+    def params(self):
+        """
+        the node settings of the initiator, e.g. the burst lengths that
+        the sequential preset of the target accepts.
+        """
+        return [f'{k}={v}' for k, v in self.cfg.get('params', {}).items()]
+
+    @property
+    def sessions(self):
+        return self.nr_sessions * max(len(self.ifaces), 1)
+
+    def preflight(self, facts):
+        return [f'{host}: no nic {nic} for {self.iqn}'
+                for host, records in facts.items()
+                for nic in self.ifaces if nic not in fact_names(records, 'nic')]
+
     def install(self, dispacher):
-        dispacher.execute("lvm_add_iscsit", self.iqn, self.addr, self.port)
+        dispacher.execute("lvm_add_iscsit", self.iqn, self.addr, str(self.port),
+                          str(self.nr_sessions), ','.join(self.ifaces) or '-', *self.params)
 
     def uninstall(self, dispacher):
-        dispacher.execute("lvm_del_iscsit", self.iqn, self.addr, self.port)
+        dispacher.execute("lvm_del_iscsit", self.iqn, self.addr, str(self.port))
 
     def start(self, dispacher):
-        dispacher.execute("lvm_start_iscsit", self.iqn, self.addr, self.port)
+        dispacher.execute("lvm_start_iscsit", self.iqn, self.addr, str(self.port),
+                          str(self.sessions))
 
     def stop(self, dispacher):
-        dispacher.execute("lvm_stop_iscsit", self.iqn, self.addr, self.port)
+        dispacher.execute("lvm_stop_iscsit", self.iqn, self.addr, str(self.port))
+
+    def check(self, dispacher):
+        dispacher.execute("lvm_chk_iscsit", self.iqn, self.addr, str(self.port),
+                          str(self.sessions))
+
+    def status(self, facts):
+        component = f'iscsi {self.iqn} {self.addr}:{self.port}'
+        session = {'kind': 'iscsi_session', 'name': self.iqn, 'portal': f'{self.addr}:{self.port}'}
+        rows = []
+        for host, records in facts.items():
+            count = records.count(session)
+            if not count:
+                rows.append(status_row(host, component, 'missing', 'no session'))
+            elif count < self.sessions:
+                rows.append(status_row(host, component, 'degraded',
+                                       f'{count}/{self.sessions} sessions'))
+            else:
+                rows.append(status_row(host, component))
+        return rows
 
 
 class LvmIscsits(ClientItemSet):
@@ -369,6 +635,115 @@ class LvmIscsits(ClientItemSet):
         dispacher.execute("lvm_dump_iscsits")
 
 
+# the multipath settings of the lio luns: all sessions of a lun in one
+# path group, each io sent to the path with the least outstanding bytes,
+# and requests as large as the target takes.
+MULTIPATH_DEVICE = {
+    'path_grouping_policy': 'multibus',
+    'path_selector': 'service-time 0',
+    'path_checker': 'tur',
+    'rr_min_io_rq': 1,
+    'failback': 'immediate',
+    'no_path_retry': 12,
+    'fast_io_fail_tmo': 5,
+    'dev_loss_tmo': 60,
+    'max_sectors_kb': 1024,
+}
+
+
+class LvmMultipath(ClientItem):
+    def __init__(self, cfg):
+        super().__init__(cfg)
+
+    @property
+    def device(self):
+        device = {**MULTIPATH_DEVICE, **(self.cfg or {})}
+        # values with spaces are quoted, like the path selectors.
+        return {k: f'"{v}"' if ' ' in str(v) else v for k, v in device.items()}
+
+    def conf(self):
+        lines = ['# generated by cli.py, do not edit.',
+                 'defaults {',
+                 '\tuser_friendly_names no',
+                 '\tfind_multipaths no',
+                 '}',
+                 '',
+                 # only the lio luns, not the local disks of the host.
+                 'blacklist {',
+                 '\tdevice {',
+                 '\t\tvendor ".*"',
+                 '\t\tproduct ".*"',
+                 '\t}',
+                 '}',
+                 '',
+                 'blacklist_exceptions {',
+                 '\tdevice {',
+                 '\t\tvendor "LIO-ORG"',
+                 '\t\tproduct ".*"',
+                 '\t}',
+                 '}',
+                 '',
+                 'devices {',
+                 '\tdevice {',
+                 '\t\tvendor "LIO-ORG"',
+                 '\t\tproduct ".*"']
+        lines += [f'\t\t{k} {v}' for k, v in self.device.items()]
+        lines += ['\t}', '}']
+        return '\n'.join(lines) + '\n'
+
+    def install(self, dispacher):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'multipath.conf')
+            with open(path, 'w') as f:
+                f.write(self.conf())
+            workpaths = dispacher.copy(path)
+        dispacher.execute('lvm_add_multipath', *workpaths)
+
+    def uninstall(self, dispacher):
+        dispacher.execute('lvm_del_multipath')
+
+    def start(self, dispacher):
+        dispacher.execute('lvm_start_multipath')
+
+    def stop(self, dispacher):
+        dispacher.execute('lvm_stop_multipath')
+
+    def check(self, dispacher):
+        dispacher.execute('lvm_chk_multipath')
+
+    def dump(self, dispacher):
+        dispacher.execute('lvm_dump_multipath')
+
+
+class LvmLocking(ClientItem):
+    def __init__(self, cfg):
+        super().__init__(cfg or {})
+
+    @property
+    def io_timeout(self):
+        # seconds of a sanlock io, 0 keeps the sanlock default. It must
+        # be the same on all hosts sharing the vgs.
+        return self.cfg.get('io_timeout', 0)
+
+    @property
+    def adopt(self):
+        # lvmlockd adopts the locks of its previous instance on restart.
+        return 1 if self.cfg.get('adopt', True) else 0
+
+    @property
+    def lockstart_concurrency(self):
+        return self.cfg.get('lockstart_concurrency', 8)
+
+    def install(self, dispacher):
+        dispacher.execute('lvm_add_locking', str(self.io_timeout), str(self.adopt))
+
+    def uninstall(self, dispacher):
+        dispacher.execute('lvm_del_locking')
+
+    def dump(self, dispacher):
+        dispacher.execute('lvm_dump_locking')
+
+
 class LvmVg(ClientItem):
     def __init__(self, cfg):
         super().__init__(cfg)
@@ -389,14 +764,29 @@ class LvmVg(ClientItem):
     def stop(self, dispacher):
         dispacher.execute('lvm_stop_vg', self.vg)
 
+    def status(self, facts):
+        component = f'vg {self.vg}'
+        return [status_row(host, component) if {'kind': 'lvmlock', 'name': self.vg} in records
+                else status_row(host, component, 'missing', 'lockspace not started')
+                for host, records in facts.items()]
+
 
 class LvmVgs(ClientItemSet):
-    def __init__(self, cfg):
+    def __init__(self, cfg, concurrency=8):
         super().__init__(cfg)
+        self.concurrency = concurrency
 
     def getitems(self):
         return [LvmVg(vg) for vg in self.cfg]
 
+    def start(self, dispacher):
+        # the lockspaces are joined together on each host rather than
+        # one vg after the other.
+        dispacher.execute('lvm_start_vgs', str(self.concurrency),
+                          *[item.vg for item in self.items])
+        for item in self.items:
+            item.check(dispacher)
+
     def dump(self, dispacher):
         dispacher.execute('lvm_dump_vgs')
 
@@ -410,9 +800,16 @@ class LvmConfig(ClientItemSet):
         items.append(ClientPkgs(self.cfg['pkgs']))
         if 'nvmets' in self.cfg:
             items.append(LvmNvmets(self.cfg['nvmets']))
+        # multipathd runs before the logins, so each lun gets its map
+        # as soon as its first session shows up.
+        if 'multipath' in self.cfg:
+            items.append(LvmMultipath(self.cfg['multipath']))
         if 'iscsits' in self.cfg:
             items.append(LvmIscsits(self.cfg['iscsits']))
-        items.append(LvmVgs(self.cfg['vgs']))
+        locking = LvmLocking(self.cfg.get('locking'))
+        if 'locking' in self.cfg:
+            items.append(locking)
+        items.append(LvmVgs(self.cfg['vgs'], locking.lockstart_concurrency))
         return items
 
 
@@ -429,6 +826,77 @@ class ClientConfig(ClientItemSet):
         return items
 
 
+def status(dispacher, cli, opts):
+    """
+    gather the records of all hosts in one fan-out, check every
+    configured component and print a table of the fleet.
+    """
+    facts = dispacher.query('host_status', fanout=opts.fanout)
+    rows = cli.status(facts)
+    rows += [status_row(host, 'host', 'missing', 'unreachable')
+             for host in dispacher.hostnames() if host not in facts]
+    if opts.report:
+        with open(opts.report, 'w') as f:
+            json.dump(rows, f, indent=2)
+
+    components = {}
+    for row in rows:
+        components.setdefault(row['component'], []).append(row)
+    print(f"{'component':<48} {'healthy':>8} {'degraded':>8} {'missing':>8}  hosts")
+    for component, crows in components.items():
+        counts = {state: sum(1 for row in crows if row['state'] == state)
+                  for state in ('healthy', 'degraded', 'missing')}
+        bad = [row['host'] for row in crows if row['state'] != 'healthy']
+        print(f"{component:<48} {counts['healthy']:>8} {counts['degraded']:>8} "
+              f"{counts['missing']:>8}  {' '.join(bad[:8])}{' ...' if len(bad) > 8 else ''}")
+    if any(row['state'] != 'healthy' for row in rows):
+        sys.exit(1)
+
+
+def gather_facts(dispacher, ttl, fanout=None):
+    """
+    the inventory of all hosts, keyed by host: block devices and their
+    links, nvme controllers, pci devices with their numa node, nics and
+    addresses, kernel and modules. The facts of a host are cached
+    locally for ttl seconds; unless all hosts have fresh facts, they
+    are queried again in one fan-out.
+    """
+    facts = {}
+    now = time.time()
+    hosts = dispacher.hostnames()
+    for host in hosts:
+        path = f'{FACTS_DIR}/{host}.json'
+        if os.path.exists(path) and now - os.path.getmtime(path) < ttl:
+            with open(path, 'r') as f:
+                facts[host] = json.load(f)
+    if hosts and len(facts) == len(hosts):
+        return facts
+
+    facts = dispacher.query('host_facts', fanout=fanout)
+    os.makedirs(FACTS_DIR, exist_ok=True)
+    for host, records in facts.items():
+        with open(f'{FACTS_DIR}/{host}.json', 'w') as f:
+            json.dump(records, f)
+    return facts
+
+
+def preflight(dispacher, cli, opts):
+    """
+    check the config against the facts of all hosts, and exit before
+    any op runs if a host lacks what the config names.
+    """
+    facts = gather_facts(dispacher, opts.facts_ttl, opts.fanout)
+    if debug:
+        print("=> debug skip pre-flight checks", flush=True)
+        return
+    errors = [f'{host}: unreachable' for host in dispacher.hostnames() if host not in facts]
+    errors += cli.preflight(facts)
+    for error in errors:
+        print(f"pre-flight: {error}")
+    if errors:
+        sys.exit(1)
+
+
 def build(cfg, args):
     dispacher = dispacher_create(cfg['client'], args.nodes)
     cli = ClientConfig(cfg)
@@ -436,11 +904,30 @@ def build(cfg, args):
 
 
 def main(argv):
+    global debug
+
     ap = argparse.ArgumentParser('deploy client hosts')
     ap.add_argument('-f', '--file', required=True, action='store')
     ap.add_argument('-n', '--nodes', required=True, action='store')
     ap.add_argument('--debug', required=False, action='store_true')
-    ap.add_argument(dest='operation', choices=['install', 'start', 'stop', 'uninstall', 'dump'],
+    ap.add_argument('--runtime', type=int, default=60, action='store',
+                    help="seconds of each bench phase")
+    ap.add_argument('--size', default='16G', action='store',
+                    help="file size written by each host in bench")
+    ap.add_argument('--nfiles', type=int, default=10000, action='store',
+                    help="files created by each host in bench")
+    ap.add_argument('--start-delay', type=int, default=30, action='store',
+                    help="seconds given to the fan-out before bench starts")
+    ap.add_argument('--tolerance', type=float, default=0.2, action='store',
+                    help="fraction below the median that makes a host a straggler")
+    ap.add_argument('--report', action='store',
+                    help="path of the json report written by bench or status")
+    ap.add_argument('--fanout', type=int, default=256, action='store',
+                    help="hosts queried at once by status and the host facts")
+    ap.add_argument('--facts-ttl', type=int, default=FACTS_TTL, action='store',
+                    help="seconds the cached host facts are used, 0 to gather them again")
+    ap.add_argument(dest='operation',
+                    choices=['install', 'start', 'stop', 'uninstall', 'dump', 'bench', 'status'],
                     help="client deployment operation")
     args = ap.parse_args(args=argv)
     if args.debug:
@@ -449,12 +936,21 @@ def main(argv):
     with open(args.file, 'r') as f:
         config = yaml.safe_load(f)
     dispatcher, cli = build(config, args)
+    if args.operation in ('install', 'start'):
+        preflight(dispatcher, cli, args)
 
     if args.operation == 'install':     cli.install(dispatcher)
     if args.operation == 'start':       cli.start(dispatcher)
     if args.operation == 'stop':        cli.stop(dispatcher)
     if args.operation == 'uninstall':   cli.uninstall(dispatcher)
     if args.operation == 'dump':        cli.dump(dispatcher)
+    if args.operation == 'status':      status(dispatcher, cli, args)
+    if args.operation == 'bench':
+        args.reports = []
+        cli.bench(dispatcher, args)
+        if args.report:
+            with open(args.report, 'w') as f:
+                json.dump(args.reports, f, indent=2)
 
 
 if __name__ == '__main__':
@@ -198,6 +198,54 @@ lfs_dump_mounts() {
 	runcmd mount -t lustre
 }
 
+lfs_bench_wait() {
+	local starttime=$1
+	local now=$(date +%s)
+
+	if [ $starttime -gt $now ]; then
+		sleep $((starttime - now))
+	fi
+}
+
+lfs_bench() {
+	local dstpath=$1
+	local starttime=$2
+	local runtime=$3
+	local size=$4
+	local nfiles=$5
+	local workdir=$dstpath/.lfsbench/$(hostname)
+	local fioopts="--directory=$workdir --numjobs=4 --group_reporting --output-format=terse"
+	local phase=$((runtime + 10))
+	local write_mbs read_mbs create_ops
+
+	if ! findmnt -n --mountpoint $dstpath --type lustre > /dev/null; then
+		errexit "$dstpath is not mounted"
+	fi
+	runcmd mkdir -p $workdir
+
+	# every phase starts at the same time on all hosts, so that the
+	# results add up to the throughput of the whole fleet.
+	lfs_bench_wait $starttime
+	write_mbs=$(runcmd fio --name=write $fioopts --rw=write --bs=1M --size=$size \
+		    --direct=1 --ioengine=libaio --iodepth=16 --runtime=$runtime --time_based |
+		    awk -F';' '{ print $48 / 1024 }')
+
+	# same job name as the write phase to read back the files it wrote.
+	lfs_bench_wait $((starttime + phase))
+	read_mbs=$(runcmd fio --name=write $fioopts --rw=read --bs=1M --size=$size \
+		   --direct=1 --ioengine=libaio --iodepth=16 --runtime=$runtime --time_based |
+		   awk -F';' '{ print $7 / 1024 }')
+
+	lfs_bench_wait $((starttime + 2 * phase))
+	create_ops=$(runcmd fio --name=create $fioopts --ioengine=filecreate \
+		     --nrfiles=$nfiles --filesize=4k --openfiles=1 |
+		     awk -F';' '{ print $8 }')
+
+	runcmd rm -rf $workdir
+	printf '{"write_mbs": %s, "read_mbs": %s, "create_ops": %s}\n' \
+		${write_mbs:-0} ${read_mbs:-0} ${create_ops:-0}
+}
+
 lvm_add_nvmets() {
 	local traddr htraddr transport trsvcid append
 	local cfgline="--nr-io-queues=4 --ctrl-loss-tmo=20 --reconnect-delay=1 --keep-alive-tmo=1"
@@ -231,9 +279,116 @@ lvm_get_nvmets() {
 	runcmd nvme list-subsys | awk -F'NQN=' '{print $2}' | grep -v '^nqn\.'
 }
 
+# the subsystems reported by a discovery controller, besides itself.
+nvme_discover_nqns() {
+	nvme discover $* 2>/dev/null |
+		awk '$1 == "subnqn:" && $2 !~ /discovery$/ { print $2 }'
+}
+
+nvme_connected() {
+	local nqn=$1
+	local traddr=$2
+	local ctldir
+
+	for ctldir in /sys/class/nvme/nvme*; do
+		[ -e $ctldir/subsysnqn ] || continue
+		if [ "$(cat $ctldir/subsysnqn)" = "$nqn" ] &&
+		   [[ "$(cat $ctldir/address)," == *traddr=$traddr,* ]]; then
+			return 0
+		fi
+	done
+	return 1
+}
+
+# connect all subsystems of a discovery entry at once, where connect-all
+# connects them one after the other.
+nvme_connect_entry() {
+	local opts="$*"
+	local traddr=$(echo $opts | grep -oE -- '--traddr=[^ ]+' | cut -d= -f2)
+	local nqn
+	local pids=()
+	local rc=0
+
+	for nqn in $(nvme_discover_nqns $opts); do
+		if nvme_connected $nqn $traddr; then
+			continue
+		fi
+		runcmd nvme connect --nqn=$nqn $opts &
+		pids+=( $! )
+	done
+	for pid in ${pids[@]}; do
+		wait $pid || rc=1
+	done
+	return $rc
+}
+
+# wait for the udev links of the namespaces for at most timeout seconds,
+# and report when each of them showed up or that it is missing.
+nvme_wait_namespaces() {
+	local timeout=$1
+	shift 1
+	local start=$(($(date +%s%N) / 1000000))
+	local now path missing
+	local -A arrival=()
+
+	if [ $debug -eq 1 ]; then
+		return
+	fi
+
+	while true; do
+		now=$(($(date +%s%N) / 1000000))
+		missing=0
+		for path in $*; do
+			if [ -z "${arrival[$path]}" ] && [ -e $path ]; then
+				arrival[$path]=$((now - start))
+			fi
+			[ -n "${arrival[$path]}" ] || missing=$((missing + 1))
+		done
+		if [ $missing -eq 0 ] || [ $((now - start)) -ge $((timeout * 1000)) ]; then
+			break
+		fi
+		# settle returns at once when no event is queued.
+		udevadm settle --timeout=1 || true
+		sleep 0.1
+	done
+
+	for path in $*; do
+		if [ -n "${arrival[$path]}" ]; then
+			echo "$path present ${arrival[$path]}ms"
+		else
+			echo "$path missing"
+		fi
+	done
+	if [ $missing -ne 0 ]; then
+		errexit "$missing of $# namespaces missing after ${timeout}s"
+	fi
+}
+
+# connect the entries of discovery.conf at once, then wait for the
+# namespaces the vgs are on, so that no vg starts before its disks.
 lvm_start_nvmets() {
+	local timeout=$1
+	shift 1
+	local entry
+	local pids=()
+	local rc=0
+
 	runcmd systemctl enable nvmf-autoconnect.service
-	runcmd nvme connect-all
+	if [ -e /etc/nvme/discovery.conf ]; then
+		while read entry; do
+			[ -n "$entry" ] || continue
+			nvme_connect_entry $entry < /dev/null &
+			pids+=( $! )
+		done < /etc/nvme/discovery.conf
+	fi
+	for pid in ${pids[@]}; do
+		wait $pid || rc=1
+	done
+	if [ $rc -ne 0 ]; then
+		errexit 'nvme connect failed'
+	fi
+
+	nvme_wait_namespaces $timeout $*
 }
 
 lvm_stop_nvmets() {
@@ -253,12 +408,43 @@ lvm_dump_nvmets() {
 	fi
 }
 
+lvm_iscsit_count() {
+	local iqn=$1
+	local addr=$2
+	local port=$3
+
+	iscsiadm -m session 2>/dev/null | awk -v portal="$addr:$port," -v iqn=$iqn '
+		index($3, portal) == 1 && $4 == iqn { n++ } END { print n + 0 }'
+}
+
 lvm_add_iscsit() {
 	local iqn=$1
 	local addr=$2
 	local port=$3
+	local nr_sessions=$4
+	local nics=$5
+	shift 5
+	local nic iface param
+	local ifopts=""
+
+	# one iscsi iface per nic, so each session is bound to its nic.
+	if [ "$nics" != "-" ]; then
+		for nic in ${nics//,/ }; do
+			iface=iface-$nic
+			if ! iscsiadm -m iface -I $iface > /dev/null 2>&1; then
+				runcmd iscsiadm -m iface -I $iface -o new
+			fi
+			runcmd iscsiadm -m iface -I $iface -o update -n iface.net_ifacename -v $nic
+			ifopts+=" -I $iface"
+		done
+	fi
 
-	runcmd iscsiadm -m discovery -t st -p $addr:$port
+	runcmd iscsiadm -m discovery -t st -p $addr:$port $ifopts
+	# the node records of all ifaces of the portal are updated at once.
+	runcmd iscsiadm -m node -T $iqn -p $addr:$port -o update -n node.session.nr_sessions -v $nr_sessions
+	for param in $*; do
+		runcmd iscsiadm -m node -T $iqn -p $addr:$port -o update -n ${param%%=*} -v ${param#*=}
+	done
 }
 
 lvm_del_iscsit() {
@@ -275,9 +461,12 @@ lvm_start_iscsit() {
 	local iqn=$1
 	local addr=$2
 	local port=$3
+	local sessions=${4:-1}
 
-	if ! $(iscsiadm -m session 2>/dev/null | grep -q "$addr:$port.*$iqn"); then
-		runcmd iscsiadm -m node -l -T $iqn -p $addr:$port
+	# a login of a target already partly logged in fails for the
+	# sessions present (15) and adds the missing ones.
+	if [ $(lvm_iscsit_count $iqn $addr $port) -lt $sessions ]; then
+		runcmd "iscsiadm -m node -l -T $iqn -p $addr:$port || [ \$? -eq 15 ]"
 	fi
 }
 
@@ -286,16 +475,67 @@ lvm_stop_iscsit() {
 	local addr=$2
 	local port=$3
 
-	if $(iscsiadm -m session 2>/dev/null | grep -q "$addr:$port.*$iqn"); then
+	if [ $(lvm_iscsit_count $iqn $addr $port) -gt 0 ]; then
 		runcmd iscsiadm -m node -u -T $iqn -p $addr:$port
 	fi
 }
 
+lvm_chk_iscsit() {
+	local iqn=$1
+	local addr=$2
+	local port=$3
+	local sessions=${4:-1}
+	local n
+
+	n=$(lvm_iscsit_count $iqn $addr $port)
+	if [ $n -lt $sessions ]; then
+		errexit "iscsi $iqn $addr:$port has $n of $sessions sessions"
+	fi
+}
+
 lvm_dump_iscsits() {
-	runcmd iscsiadm -m session
+	runcmd iscsiadm -m iface
+	runcmd iscsiadm -m session -P 1
 	runcmd iscsiadm -m node
 }
 
+lvm_add_multipath() {
+	local conf=$1
+
+	runcmd install -m 644 $conf /etc/multipath.conf
+}
+
+lvm_del_multipath() {
+	runcmd rm -f /etc/multipath.conf
+}
+
+lvm_start_multipath() {
+	runcmd systemctl enable multipathd --now
+	runcmd multipathd reconfigure
+}
+
+lvm_stop_multipath() {
+	# the maps in use by lvm are kept, unused ones are flushed.
+	runcmd "multipath -F || true"
+	runcmd systemctl disable multipathd --now
+}
+
+lvm_chk_multipath() {
+	local dev
+
+	# every lun of a lio target is a path of a multipath map.
+	for dev in /sys/block/sd*; do
+		[ "$(cat $dev/device/vendor 2>/dev/null | xargs)" == "LIO-ORG" ] || continue
+		if [ -z "$(ls $dev/holders)" ]; then
+			errexit "${dev##*/} is not in a multipath map"
+		fi
+	done
+}
+
+lvm_dump_multipath() {
+	runcmd multipath -ll
+}
+
 lvm_add_vg() {
 	local vg=$1
 	local hn id idbase
@@ -335,9 +575,54 @@ lvm_del_vg() {
 	runcmd "cat /dev/null > /etc/lvm/lvmlocal.conf"
 }
 
-lvm_start_vg() {
-	local vg=$1
+LVMLOCKD_DROPIN=/etc/systemd/system/lvmlockd.service.d/tuning.conf
+# left by lvm_add_locking when the lvmlockd options change, until
+# lvm_start_locking restarts lvmlockd with them.
+LOCKING_CHANGED=/run/lvmlockd-tuning.changed
+
+lvm_add_locking() {
+	local io_timeout=$1
+	local adopt=$2
+	local conf=/etc/sanlock/sanlock.conf
+	local opts="--adopt $adopt"
+	local content
+
+	# all hosts of a lockspace must use the same io timeout, the lease
+	# renewal and the join delay of a lockspace are multiples of it.
+	if [ $io_timeout -gt 0 ]; then
+		runcmd mkdir -p /etc/sanlock
+		runcmd touch $conf
+		runcmd sed -i '/^io_timeout/d' $conf
+		runcmd "echo 'io_timeout = $io_timeout' >> $conf"
+		opts+=" --sanlock-timeout $io_timeout"
+	fi
+
+	content=$(printf '[Service]\nExecStart=\nExecStart=%s --foreground %s' \
+		  $(command -v lvmlockd || echo /usr/sbin/lvmlockd) "$opts")
+	if [ "$(cat $LVMLOCKD_DROPIN 2>/dev/null)" != "$content" ]; then
+		runcmd mkdir -p $(dirname $LVMLOCKD_DROPIN)
+		runcmd "echo '$content' > $LVMLOCKD_DROPIN"
+		runcmd touch $LOCKING_CHANGED
+	fi
+	runcmd systemctl daemon-reload
+}
 
+lvm_del_locking() {
+	runcmd rm -f $LVMLOCKD_DROPIN
+	if [ -e /etc/sanlock/sanlock.conf ]; then
+		runcmd sed -i '/^io_timeout/d' /etc/sanlock/sanlock.conf
+	fi
+	runcmd systemctl daemon-reload
+}
+
+lvm_dump_locking() {
+	runcmd systemctl cat lvmlockd
+	if [ -e /etc/sanlock/sanlock.conf ]; then
+		runcmd cat /etc/sanlock/sanlock.conf
+	fi
+}
+
+lvm_start_locking() {
 	if ! ls /dev/mapper/*-lvmlock > /dev/null 2>&1; then
 		runcmd systemctl disable wdmd --now
 
@@ -346,12 +631,70 @@ lvm_start_vg() {
 		runcmd systemctl enable lvmlockd
 		runcmd systemctl restart lvmlockd
 		runcmd systemctl enable lvmagent.service --now
+	elif [ -e $LOCKING_CHANGED ]; then
+		# lvmlockd runs with its former options. A restart keeps the
+		# locks of the started vgs only if it adopts them.
+		if ! grep -q -- '--adopt 1' $LVMLOCKD_DROPIN; then
+			echo "warning: restart lvmlockd once all vgs are stopped to apply $LVMLOCKD_DROPIN" >&2
+			return 0
+		fi
+		runcmd systemctl restart lvmlockd
 	fi
+	runcmd rm -f $LOCKING_CHANGED
+}
+
+lvm_lockstart_vg() {
+	local vg=$1
+	local start=$(date +%s%N)
+	local started
 
 	runcmd vgchange --lockstart $vg
 	if [ ! -e /dev/mapper/$vg-lvmlock ]; then
 		errexit "start vg=$vg failed"
 	fi
+	started=$(date +%s%N)
+	# the lvs created for shared activation by lvm.py are active on
+	# every host, the others are left to lvmagent.
+	runcmd lvchange -asy --select "'vg_name=$vg && lv_tags=activation_shared'"
+	echo "vg=$vg lockstart $(((started - start) / 1000000))ms" \
+	     "activate $((($(date +%s%N) - started) / 1000000))ms"
+}
+
+lvm_start_vg() {
+	local vg=$1
+
+	lvm_start_locking
+	lvm_lockstart_vg $vg
+}
+
+# start the lockspaces of several vgs, at most concurrency at a time.
+# Each join of a sanlock lockspace waits out its host_id lease, so the
+# joins overlap instead of queueing one after the other.
+lvm_start_vgs() {
+	local concurrency=$1
+	shift 1
+	local vg
+	local running=0
+	local rc=0
+
+	lvm_start_locking
+
+	for vg in $*; do
+		if [ $running -ge $concurrency ]; then
+			wait -n || rc=1
+			running=$((running - 1))
+		fi
+		lvm_lockstart_vg $vg &
+		running=$((running + 1))
+	done
+	while [ $running -gt 0 ]; do
+		wait -n || rc=1
+		running=$((running - 1))
+	done
+
+	if [ $rc -ne 0 ]; then
+		errexit "start vgs $* failed"
+	fi
 }
 
 lvm_stop_vg() {
@@ -380,6 +723,109 @@ lvm_dump_vgs() {
 	fi
 }
 
+# print the state of all client components of the host, one json
+# record per line and component.
+host_status() {
+	local nid mnt ctldir lock
+
+	if [ $(cmd_exist lctl) -eq 1 ]; then
+		for nid in $(lctl list_nids 2>/dev/null); do
+			printf '{"kind": "nid", "name": "%s"}\n' $nid
+		done
+	fi
+	if [ $(cmd_exist lnetctl) -eq 1 ]; then
+		lnetctl route show -v 2>/dev/null | awk '
+			$2 == "net:"	{ net = $3 }
+			$1 == "gateway:"	{ gw = $2 }
+			$1 == "state:"	{ printf "{\"kind\": \"route\", \"name\": \"%s\", \"gateway\": \"%s\", \"state\": \"%s\"}\n", net, gw, $2 }'
+	fi
+
+	for mnt in $(findmnt -rn -t lustre -o TARGET); do
+		printf '{"kind": "mount", "name": "%s"}\n' $mnt
+	done
+
+	for ctldir in /sys/class/nvme-fabrics/ctl/nvme*; do
+		[ -e $ctldir/subsysnqn ] || continue
+		printf '{"kind": "nvme_ctrl", "name": "%s", "state": "%s", "address": "%s"}\n' \
+			$(cat $ctldir/subsysnqn) $(cat $ctldir/state) $(cat $ctldir/address)
+	done
+
+	# tcp: [1] 10.5.41.201:3261,1 iqn.2024-04.com.ebcloud.scsivol-tgt (non-flash)
+	if [ $(cmd_exist iscsiadm) -eq 1 ]; then
+		iscsiadm -m session 2>/dev/null | awk '{
+			split($3, portal, ",")
+			printf "{\"kind\": \"iscsi_session\", \"name\": \"%s\", \"portal\": \"%s\"}\n", $4, portal[1] }'
+	fi
+
+	for lock in /dev/mapper/*-lvmlock; do
+		[ -e $lock ] || continue
+		lock=${lock##*/}
+		printf '{"kind": "lvmlock", "name": "%s"}\n' ${lock%-lvmlock}
+	done
+}
+
+# the inventory of the host as json lines, one record per fact, checked
+# by the pre-flight of cli.py.
+host_facts() {
+	local ctldir pcidir nic pci
+
+	printf '{"kind": "host", "name": "%s", "kernel": "%s", "machine": "%s"}\n' \
+		$(hostname) $(uname -r) $(uname -m)
+	if [ -e /proc/modules ]; then
+		awk '{ printf "{\"kind\": \"module\", \"name\": \"%s\"}\n", $1 }' /proc/modules
+	fi
+
+	lsblk -bnrpo NAME,SIZE,TYPE | awk '{
+		printf "{\"kind\": \"block\", \"name\": \"%s\", \"size\": %s, \"type\": \"%s\"}\n", $1, $2, $3 }'
+	# udev escapes odd characters of the link names as \xNN.
+	find /dev/disk /dev/md -type l -printf '%p %l\n' 2>/dev/null | awk '{
+		gsub(/\\/, "\\\\"); n = split($2, target, "/")
+		printf "{\"kind\": \"devlink\", \"name\": \"%s\", \"target\": \"%s\"}\n", $1, target[n] }'
+
+	for ctldir in /sys/class/nvme/nvme*; do
+		[ -e $ctldir/transport ] || continue
+		printf '{"kind": "nvme", "name": "%s", "transport": "%s", "address": "%s", "model": "%s", "serial": "%s"}\n' \
+			${ctldir##*/} $(cat $ctldir/transport) "$(cat $ctldir/address)" \
+			"$(xargs < $ctldir/model)" "$(xargs < $ctldir/serial)"
+	done
+
+	# storage and network controllers only. The uplink is the root port
+	# above the device, shared by all devices behind the same switch.
+	for pcidir in /sys/bus/pci/devices/*; do
+		case $(cat $pcidir/class) in
+		0x01*|0x02*)	;;
+		*)		continue	;;
+		esac
+		printf '{"kind": "pci", "name": "%s", "class": "%s", "numa": %s, "uplink": "%s"}\n' \
+			${pcidir##*/} $(cat $pcidir/class) $(cat $pcidir/numa_node) \
+			$(realpath $pcidir | grep -oE '[0-9a-f]{4}:[0-9a-f]{2}:[0-9a-f]{2}\.[0-7]' | head -1)
+	done
+
+	for nic in /sys/class/net/*; do
+		[ ${nic##*/} != lo ] || continue
+		pci=""
+		if [ -e $nic/device ]; then
+			pci=$(realpath $nic/device | grep -oE '[0-9a-f]{4}:[0-9a-f]{2}:[0-9a-f]{2}\.[0-7]' | tail -1)
+		fi
+		printf '{"kind": "nic", "name": "%s", "state": "%s", "pci": "%s"}\n' \
+			${nic##*/} $(cat $nic/operstate) "$pci"
+	done
+	ip -o -4 addr show | awk '{
+		split($4, addr, "/")
+		printf "{\"kind\": \"ipaddr\", \"name\": \"%s\", \"prefix\": %s, \"nic\": \"%s\"}\n", addr[1], addr[2], $2 }'
+}
+
+# the machine of the config is the architecture or the dmi product name
+# of the hosts.
+host_check() {
+	local machine=$1
+	local product=$(cat /sys/class/dmi/id/product_name 2>/dev/null)
+
+	if [ "$(uname -m)" != "$machine" ] && [ "$product" != "$machine" ]; then
+		errexit "$(hostname) is not $machine but $(uname -m) ${product:-with no product name}"
+	fi
+}
+
 if [ "x$CLIENT_DEBUG" == "x1" ]; then
 	debug=1
 fi
@@ -404,20 +850,35 @@ case $oper in
 'lfs_start_mount')		lfs_start_mount $*		;;
 'lfs_stop_mount')		lfs_stop_mount $*		;;
 'lfs_dump_mounts')		lfs_dump_mounts $*		;;
+'lfs_bench')			lfs_bench $*			;;
 'lvm_add_nvmets')		lvm_add_nvmets $*		;;
 'lvm_del_nvmets')		lvm_del_nvmets $*		;;
 'lvm_start_nvmets')		lvm_start_nvmets $*		;;
 'lvm_stop_nvmets')		lvm_stop_nvmets $*		;;
 'lvm_dump_nvmets')		lvm_dump_nvmets $*		;;
-'lvm_add_iscsits')		lvm_add_iscsits $*		;;
-'lvm_del_iscsits')		lvm_del_iscsits $*		;;
-'lvm_start_iscsits')		lvm_start_iscsits $*		;;
-'lvm_stop_iscsits')		lvm_stop_iscsits $*		;;
+'lvm_add_iscsit')		lvm_add_iscsit $*		;;
+'lvm_del_iscsit')		lvm_del_iscsit $*		;;
+'lvm_start_iscsit')		lvm_start_iscsit $*		;;
+'lvm_stop_iscsit')		lvm_stop_iscsit $*		;;
+'lvm_chk_iscsit')		lvm_chk_iscsit $*		;;
 'lvm_dump_iscsits')		lvm_dump_iscsits $*		;;
+'lvm_add_multipath')		lvm_add_multipath $*		;;
+'lvm_del_multipath')		lvm_del_multipath $*		;;
+'lvm_start_multipath')		lvm_start_multipath $*		;;
+'lvm_stop_multipath')		lvm_stop_multipath $*		;;
+'lvm_chk_multipath')		lvm_chk_multipath $*		;;
+'lvm_dump_multipath')		lvm_dump_multipath $*		;;
 'lvm_add_vg')			lvm_add_vg $*			;;
 'lvm_del_vg')			lvm_del_vg $*			;;
 'lvm_start_vg')			lvm_start_vg $*			;;
+'lvm_start_vgs')			lvm_start_vgs $*			;;
+'lvm_add_locking')		lvm_add_locking $*		;;
+'lvm_del_locking')		lvm_del_locking $*		;;
+'lvm_dump_locking')		lvm_dump_locking $*		;;
 'lvm_stop_vg')			lvm_stop_vg $*			;;
 'lvm_dump_vgs')			lvm_dump_vgs $*			;;
+'host_status')			host_status $*			;;
+'host_facts')			host_facts $*			;;
+'host_check')			host_check $*			;;
 *)				errexit "unknown op: $oper"	;;
 esac
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+
+import argparse
+import re
+import sys
+import yaml
+from tgtconfig import (FACTS_TTL, ConfigAgent, ConfigItem, Scheduler, gather_facts, parallel,
+                       preflight_check, query_status)
+
+VARIABLE = re.compile(r'\$\{([\w.-]+)\}')
+
+# the variables every node has unless the fleet sets them. Besides these,
+# ${node} is the node name, ${index} its position in the fleet and ${num}
+# the number in its name.
+DEFAULT_VARS = {
+    'hostid': '${node}',
+    'portid': '${index}',
+    'nid': '${mgmtip}@tcp',
+}
+
+# the mode of the other hosts of the fleet in the config of a node: the
+# backups of its lustre targets, the clients of its nvme or iscsi targets.
+PEER_MODES = {'ltgt': 'backup', 'nvmet': 'client', 'iscsit': 'client'}
+
+
+def expand_nodeset(nodes):
+    """
+    the node names of a nodeset like n[059,099-100], or of a list of
+    nodesets, in order.
+    """
+    if isinstance(nodes, list):
+        return [name for item in nodes for name in expand_nodeset(item)]
+    nodes = str(nodes)
+    match = re.fullmatch(r'([^\[\]]*)\[([^\[\]]+)\]([^\[\]]*)', nodes)
+    if not match:
+        if '[' in nodes or ']' in nodes:
+            raise ValueError(f'invalid nodeset {nodes}')
+        return [nodes]
+
+    prefix, ranges, suffix = match.groups()
+    names = []
+    for part in ranges.split(','):
+        first, _, last = part.partition('-')
+        last = last or first
+        if not first.isdigit() or not last.isdigit():
+            raise ValueError(f'invalid nodeset {nodes}')
+        # the width of the first number pads the others, as n[059-100].
+        names += [f'{prefix}{i:0{len(first)}d}{suffix}'
+                  for i in range(int(first), int(last) + 1)]
+    return names
+
+
+def substitute(value, lookup):
+    """
+    replace the ${name} variables of value, looked up by lookup. A
+    string that is a single variable takes the value of the variable
+    as is, and a list variable in a list is spliced into it.
+    """
+    if isinstance(value, dict):
+        return {key: substitute(item, lookup) for key, item in value.items()}
+    if isinstance(value, list):
+        items = []
+        for item in value:
+            result = substitute(item, lookup)
+            if isinstance(item, str) and isinstance(result, list):
+                items += result
+            else:
+                items.append(result)
+        return items
+    if not isinstance(value, str):
+        return value
+    match = VARIABLE.fullmatch(value)
+    if match:
+        return lookup(match.group(1))
+    return VARIABLE.sub(lambda m: str(lookup(m.group(1))), value)
+
+
+class FleetNode:
+    def __init__(self, name, index, rawvars):
+        self.name = name
+        self.index = index
+        number = re.search(r'(\d+)\D*$', name)
+        self.values = {'node': name, 'index': index,
+                       'num': int(number.group(1)) if number else None}
+        self.rawvars = rawvars
+        self.resolving = set()
+
+    def var(self, name):
+        # the variables are resolved on first use, so that they may refer
+        # to each other in any order.
+        if name in self.values:
+            return self.values[name]
+        if name not in self.rawvars:
+            raise ValueError(f'node {self.name} has no variable {name}')
+        if name in self.resolving:
+            raise ValueError(f'variable {name} of node {self.name} refers to itself')
+        self.resolving.add(name)
+        self.values[name] = substitute(self.rawvars[name], self.var)
+        self.resolving.discard(name)
+        return self.values[name]
+
+
+class Fleet:
+    def __init__(self, cfgdata):
+        cfg = ConfigItem(cfgdata)
+        self.script = cfg.script or './tgtagent.sh'
+        self.workdir = cfg.workdir or '/tmp/target'
+        self.persistent = cfg.persistent or False
+        self.peers = cfg.peers or 'all'
+        self.overrides = cfg.overrides or {}
+
+        names = expand_nodeset(cfg.nodes or [])
+        if len(set(names)) != len(names):
+            raise ValueError(f'duplicate nodes in fleet {cfg.nodes}')
+        unknown = set(self.overrides) - set(names)
+        if unknown:
+            raise ValueError(f"overrides of unknown nodes {', '.join(sorted(unknown))}")
+        self.nodes = [FleetNode(name, index, {**DEFAULT_VARS, **(cfg.vars or {}),
+                                              **self.overrides.get(name, {}).get('vars', {})})
+                      for index, name in enumerate(names)]
+        self.byname = {node.name: node for node in self.nodes}
+
+    def lookup(self, node, ref):
+        """
+        the value of a variable in the templates of node: ${name} of the
+        node itself, ${next.name} and ${prev.name} of its neighbours in
+        the fleet, ${<node>.name} of a given node and ${all.name} the
+        list of the values of all nodes.
+        """
+        scope, _, name = ref.rpartition('.')
+        if not scope:
+            return node.var(name)
+        if scope == 'all':
+            return [other.var(name) for other in self.nodes]
+        if scope == 'next':
+            return self.nodes[(node.index + 1) % len(self.nodes)].var(name)
+        if scope == 'prev':
+            return self.nodes[node.index - 1].var(name)
+        if scope in self.byname:
+            return self.byname[scope].var(name)
+        raise ValueError(f'unknown variable {ref}')
+
+    def peer_nodes(self, node):
+        """
+        the other nodes from the next one around the fleet, all of them
+        or as many as peers.
+        """
+        others = [self.nodes[(node.index + i) % len(self.nodes)]
+                  for i in range(1, len(self.nodes))]
+        return others if self.peers == 'all' else others[:int(self.peers)]
+
+    def agent(self, node, mode, persistent=None):
+        return {'mgmtip': node.var('mgmtip'), 'script': self.script, 'workdir': self.workdir,
+                'mode': mode, 'persistent': self.persistent if persistent is None else persistent}
+
+    def configs(self, kind, section):
+        """
+        the config of each node of section, i.e. its template with the
+        variables of the node, updated by the overrides of the node for
+        kind, and the agents: the node is active, the peers in the mode
+        of kind. A persistent key in the overrides of kind applies to the
+        active agent of the node.
+        """
+        section = ConfigItem(section)
+        names = expand_nodeset(section.nodes) if section.nodes else list(self.byname)
+        configs = []
+        for name in names:
+            if name not in self.byname:
+                raise ValueError(f'{kind} node {name} is not in the fleet')
+            node = self.byname[name]
+            template = {**(section.template or {}),
+                        **self.overrides.get(name, {}).get(kind, {})}
+            config = substitute(template, lambda ref: self.lookup(node, ref))
+            config['agents'] = [self.agent(node, 'active', config.pop('persistent', None))]
+            config['agents'] += [self.agent(peer, PEER_MODES[kind])
+                                 for peer in self.peer_nodes(node)]
+            configs.append(config)
+        return configs
+
+
+def build(config, kind, nodeclass, journal=None):
+    """
+    expand the fleet into the model of each node and return the agents
+    and the model of every node. A host has one agent per mode, shared
+    by all nodes, and is started once.
+    """
+    configs = Fleet(config['fleet']).configs(kind, config[kind])
+    scheduler = Scheduler(config.get('concurrency'))
+    agents = {}
+    nodes = []
+    for nodecfg in configs:
+        nodeagents = []
+        for agentcfg in nodecfg['agents']:
+            key = (agentcfg['mgmtip'], agentcfg['mode'])
+            if key not in agents:
+                agents[key] = ConfigAgent(agentcfg, journal, scheduler)
+            nodeagents.append(agents[key])
+        nodeagents.sort(key=lambda a: a.mode)
+        nodes.append((nodeagents, nodeclass(nodecfg)))
+
+    hosts = {}
+    for agent in agents.values():
+        hosts.setdefault(agent.mgmtip, []).append(agent)
+    # a persistent agent of a host starts the resident agent.
+    for hostagents in hosts.values():
+        hostagents.sort(key=lambda agent: not agent.persistent)
+    parallel(lambda hostagents: hostagents[0].start(), hosts.values())
+    # the resident agent of a host serves all modes.
+    for hostagents in hosts.values():
+        for agent in hostagents[1:]:
+            agent.channel = hostagents[0].channel
+    return nodes
+
+
+def deploy(nodes, func, reverse=False):
+    """
+    call func(agent, model) for all agents of all nodes, mode by mode as
+    the scripts do for one node, e.g. all targets before any client
+    connects. Within a mode the hosts run in parallel, each one through
+    its nodes in fleet order.
+    """
+    modes = sorted({agent.mode for agents, _ in nodes for agent in agents}, reverse=reverse)
+    for mode in modes:
+        hosts = {}
+        for agents, model in nodes:
+            for agent in agents:
+                if agent.mode == mode:
+                    hosts.setdefault(agent.mgmtip, []).append((agent, model))
+        parallel(lambda steps: [func(agent, model) for agent, model in steps],
+                 hosts.values())
+
+
+def node_facts(nodes, gather):
+    """
+    gather the facts of every host once, with gather(agents) as in
+    query_status or gather_facts, and return the facts of each node
+    keyed by its own agents.
+    """
+    hosts = {}
+    for agents, _ in nodes:
+        for agent in agents:
+            hosts.setdefault(agent.mgmtip, agent)
+    facts = {agent.mgmtip: records for agent, records in gather(list(hosts.values())).items()}
+    return [{agent: facts[agent.mgmtip] for agent in agents} for agents, _ in nodes]
+
+
+def preflight(nodes, ttl=FACTS_TTL):
+    facts = node_facts(nodes, lambda agents: gather_facts(agents, ttl))
+    preflight_check([error for (_, model), nodefacts in zip(nodes, facts)
+                     for error in model.preflight(nodefacts)])
+
+
+def status(nodes):
+    facts = node_facts(nodes, query_status)
+    return [row for (_, model), nodefacts in zip(nodes, facts)
+            for row in model.status(nodefacts)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="print the node configs of a fleet")
+    parser.add_argument('-c', '--config', type=str, required=True,
+                        help="Path to the fleet config file")
+    parser.add_argument(dest='kind', choices=list(PEER_MODES),
+                        help="section of the fleet config expanded")
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as f:
+        config = yaml.safe_load(f)
+    configs = Fleet(config['fleet']).configs(args.kind, config[args.kind])
+    yaml.safe_dump_all(configs, sys.stdout, sort_keys=False)
+
+
+if __name__ == "__main__":
+    main()
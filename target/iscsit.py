@@ -3,7 +3,50 @@
 import argparse
 import yaml
 import sys
-from tgtconfig import ConfigAgent, ConfigItem
+import fleet
+from tgtconfig import (FACTS_TTL, ConfigAgent, ConfigItem, Journal, fact_names, gather_facts,
+                       preflight_check, setup_affinity)
+
+BACKSTORES = ('block', 'fileio')
+
+# presets of backstore and tpg settings. sequential suits the large
+# streaming ios of lustre and lvm: a deeper command window per session,
+# bigger data segments and bursts, and unsolicited immediate data so a
+# write does not wait for a r2t round trip. The initiators must allow
+# the same lengths, see LvmIscsit of cli.py. The attributes under the
+# name of a backstore type apply only to the luns of that type: iblock
+# reports the write cache of its device and refuses emulate_write_cache.
+PRESETS = {
+    'sequential': {
+        'backstore': {
+            'type': 'block',
+            'attributes': {'queue_depth': 128},
+            'fileio': {'attributes': {'emulate_write_cache': 1}},
+        },
+        'attributes': {'default_cmdsn_depth': 128},
+        'parameters': {
+            'MaxRecvDataSegmentLength': 262144,
+            'MaxXmitDataSegmentLength': 262144,
+            'FirstBurstLength': 262144,
+            'MaxBurstLength': 1048576,
+            'ImmediateData': 'Yes',
+            'InitialR2T': 'No',
+            'MaxOutstandingR2T': 8,
+        },
+    },
+}
+
+
+def preset(name):
+    if name is None:
+        return {}
+    if name not in PRESETS:
+        raise ValueError(f'unknown preset {name}')
+    return PRESETS[name]
+
+
+def setargs(settings):
+    return [f'{k}={v}' for k, v in settings.items()]
 
 
 class IscsitPortal:
@@ -39,37 +82,60 @@ class IscsitAcl:
 
 
 class IscsitLun:
-    def __init__(self, cfgdata, hostid, iqn):
+    def __init__(self, cfgdata, hostid, iqn, backstore):
         cfg = ConfigItem(cfgdata)
         self.iqn = iqn
         self.hostid = hostid
         self.lunid = cfg.lunid
         self.devid = cfg.devid
         self.devpath = cfg.devpath
+        # the backstore of the lun overrides that of its target.
+        lun_backstore = cfg.backstore or {}
+        self.backstore = lun_backstore.get('type') or backstore.get('type') or 'block'
+        if self.backstore not in BACKSTORES:
+            raise ValueError(f'invalid backstore type: {self.backstore}')
+        self.attributes = {**backstore.get('attributes', {}),
+                           **backstore.get('typed', {}).get(self.backstore, {}),
+                           **lun_backstore.get('attributes', {})}
 
     def create(self, agent):
         if len(self.devid) > 16:
             print("length of devid is greater than 16")
             sys.exit(1)
-        agent.execute('iscsit_lun_create', self.iqn,
-                      f'{self.hostid}-{self.devid}', self.devpath, self.lunid)
+        agent.execute('iscsit_lun_create', self.iqn, f'{self.hostid}-{self.devid}',
+                      self.devpath, self.lunid, self.backstore, *setargs(self.attributes))
 
     def destroy(self, agent):
-        agent.execute('iscsit_lun_destroy', self.iqn,
-                      f'{self.hostid}-{self.devid}', self.devpath, self.lunid)
+        agent.execute('iscsit_lun_destroy', self.iqn, f'{self.hostid}-{self.devid}',
+                      self.devpath, self.lunid, self.backstore)
 
 
 class IscsitTarget:
-    def __init__(self, cfgdata, hostid):
+    def __init__(self, cfgdata, hostid, node_preset=None):
         cfg = ConfigItem(cfgdata)
         self.hostid = hostid
         self.iqn = f'iqn.2024-04.com.hanrun.{hostid}.{cfg.name}'
+        # the settings of the target override its preset, or else the
+        # preset of the node.
+        settings = preset(cfg.preset or node_preset)
+        base, own = settings.get('backstore', {}), cfg.backstore or {}
+        backstore = {'type': own.get('type') or base.get('type'),
+                     'attributes': {**base.get('attributes', {}), **own.get('attributes', {})},
+                     'typed': {bstype: base.get(bstype, {}).get('attributes', {})
+                               for bstype in BACKSTORES}}
+        self.attributes = {**settings.get('attributes', {}), **(cfg.attributes or {})}
+        self.parameters = {**settings.get('parameters', {}), **(cfg.parameters or {})}
         self.portals = [IscsitPortal(portal, self.iqn) for portal in cfg.portals]
         self.acls = [IscsitAcl(acl, self.iqn) for acl in cfg.acls]
-        self.luns = [IscsitLun(lun, self.hostid, self.iqn) for lun in cfg.luns]
+        self.luns = [IscsitLun(lun, self.hostid, self.iqn, backstore) for lun in cfg.luns]
 
     def create(self, agent):
         agent.execute('iscsit_iqn_create', self.iqn)
+        # before the acls, which take the tpg defaults when created.
+        if self.attributes:
+            agent.execute('iscsit_tpg_set', self.iqn, 'attribute', *setargs(self.attributes))
+        if self.parameters:
+            agent.execute('iscsit_tpg_set', self.iqn, 'parameter', *setargs(self.parameters))
 
         for portal in self.portals:
             portal.create(agent)
@@ -100,7 +166,7 @@ class IscsitTarget:
 class IscsitNode:
     def __init__(self, cfg):
         cfg = ConfigItem(cfg)
-        self.targets = [IscsitTarget(tgt, cfg.hostid) for tgt in cfg.targets]
+        self.targets = [IscsitTarget(tgt, cfg.hostid, cfg.preset) for tgt in cfg.targets]
 
     def create(self, agent):
         for tgt in self.targets:
@@ -115,41 +181,114 @@ class IscsitNode:
         for tgt in self.targets:
             tgt.destroy(agent)
 
-
-def build(config):
+    def preflight(self, facts):
+        """
+        the target has the addresses of its portals and the devices of
+        its luns.
+        """
+        errors = []
+        for agent, records in facts.items():
+            if agent.mode == 'client':
+                continue
+            addrs = fact_names(records, 'ipaddr') | {'0.0.0.0'}
+            devices = fact_names(records, 'block', 'devlink')
+            errors += [f'{agent.mgmtip}: no address {portal.addr} for {tgt.iqn}'
+                       for tgt in self.targets for portal in tgt.portals
+                       if portal.addr not in addrs]
+            errors += [f'{agent.mgmtip}: no device {lun.devpath} for {tgt.iqn}'
+                       for tgt in self.targets for lun in tgt.luns
+                       if lun.devpath not in devices]
+        return errors
+
+    def destroy_bulk(self, agent):
+        portals = [arg for tgt in self.targets for portal in tgt.portals
+                   for arg in (portal.iqn, portal.addr, portal.port)]
+        agent.execute('iscsit_portal_disconnect_all', *portals)
+        agent.execute('iscsit_clear')
+
+
+def build(config, journal=None):
     topology = IscsitNode(config)
-    agents = ConfigAgent.from_config(config['agents'])
+    agents = ConfigAgent.from_config(config['agents'], journal)
     return agents, topology
 
 
+def preflight(agents, topology, ttl):
+    preflight_check(topology.preflight(gather_facts(agents, ttl)))
+
+
 def create(agents, topology):
     for agent in agents:
         topology.create(agent)
 
 
-def destroy(agents, topology):
+def destroy(agents, topology, bulk=False):
     agents.reverse()
     for agent in agents:
-        topology.destroy(agent)
+        if bulk:
+            topology.destroy_bulk(agent)
+        else:
+            topology.destroy(agent)
+
+
+def affinity(agents, topology):
+    # the backing disks of all luns and the nics of all portals.
+    items = [lun.devpath for tgt in topology.targets for lun in tgt.luns]
+    setup_affinity(agents, items + [portal.addr for tgt in topology.targets
+                                    for portal in tgt.portals])
+
+
+FLEET_OPERATIONS = ('create', 'destroy')
+
+
+def deploy_fleet(config, journal, args):
+    """
+    run the operation on every node of a fleet config, see fleet.py.
+    """
+    nodes = fleet.build(config, 'iscsit', IscsitNode, journal)
+    if args.operation == 'create':
+        fleet.preflight(nodes, args.facts_ttl)
+        fleet.deploy(nodes, lambda agent, topology: topology.create(agent))
+    elif args.operation == 'destroy' and args.bulk:
+        fleet.deploy(nodes, lambda agent, topology: topology.destroy_bulk(agent), reverse=True)
+    elif args.operation == 'destroy':
+        fleet.deploy(nodes, lambda agent, topology: topology.destroy(agent), reverse=True)
 
 
 def main():
     parser = argparse.ArgumentParser(description="iscsi target configuration script")
     parser.add_argument('-c', '--config', type=str, default='./iscsit.yaml',
         help="Path to the config file")
-    parser.add_argument(dest='operation', choices=['create', 'destroy'],
+    parser.add_argument(dest='operation', choices=['create', 'destroy', 'affinity'],
                         help="create/destroy iscsit deployment")
+    parser.add_argument('--bulk', action='store_true',
+                        help="destroy all targets at once")
+    parser.add_argument('--resume', action='store_true',
+                        help="skip the ops completed by the last run of the same config")
+    parser.add_argument('--facts-ttl', type=int, default=FACTS_TTL,
+                        help="seconds the cached host facts are used, 0 to gather them again")
     args = parser.parse_args()
 
     config_file = args.config
     with open(config_file, 'r') as f:
         config = yaml.safe_load(f)
 
-    agents, topology = build(config)
-    if args.operation == 'create':
-        create(agents, topology)
-    if args.operation == 'destroy':
-        destroy(agents, topology)
+    with Journal.from_config(config, 'iscsit', args.operation, args.resume) as journal:
+        if 'fleet' in config:
+            if args.operation not in FLEET_OPERATIONS:
+                parser.error(f'{args.operation} is not supported for a fleet')
+            deploy_fleet(config, journal, args)
+            return
+
+        agents, topology = build(config, journal)
+        if args.operation == 'create':
+            preflight(agents, topology, args.facts_ttl)
+        if args.operation == 'create':
+            create(agents, topology)
+        if args.operation == 'destroy':
+            destroy(agents, topology, args.bulk)
+        if args.operation == 'affinity':
+            affinity(agents, topology)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,264 @@
+import collections
+import math
+import re
+from tgtconfig import ConfigItem
+
+UNITS = {'KiB': 1 << 10, 'MiB': 1 << 20, 'GiB': 1 << 30, 'TiB': 1 << 40}
+
+# the full stripe of the arrays made by mdraid_create, STRIPESIZE of
+# tgtagent.sh: the chunk is the stripe over the data disks. Partitions
+# start and end on stripe boundaries, so do the chunks of every member
+# behind the 1M data offset of mdadm.
+STRIPE = 1 << 20
+
+# data disks of an array of width members, each of them streaming at
+# the speed of one disk; the parity rotates over all members.
+DATA_DISKS = {'raid5': lambda width: width - 1, 'raid6': lambda width: width - 2}
+
+# the failure domain the members of an array are spread over.
+DOMAINS = {
+    'host':     lambda disk: (disk.hostid,),
+    'numa':     lambda disk: (disk.hostid, disk.numa),
+    'uplink':   lambda disk: (disk.hostid, disk.uplink),
+}
+
+# the symlinks of the local namespaces, see 60-persistent-storage-nvme.rules.
+DISKLINK = re.compile(r'/dev/disk/nvme/(n[^-]+)-([0-9a-f]{4}:[0-9a-f]{2}:[0-9a-f]{2}\.[0-7])-n(\d+)$')
+
+
+def parse_size(size):
+    if isinstance(size, int):
+        return size
+    match = re.fullmatch(r'(\d+)\s*([KMGT]iB)', str(size))
+    if not match:
+        raise ValueError(f'invalid size {size}')
+    return int(match.group(1)) * UNITS[match.group(2)]
+
+
+def align_up(size):
+    return -(-size // STRIPE) * STRIPE
+
+
+def align_down(size):
+    return size // STRIPE * STRIPE
+
+
+def mib(size):
+    return f'{size // UNITS["MiB"]}MiB'
+
+
+class PlanDisk:
+    def __init__(self, hostid, diskid, size, numa, uplink):
+        self.hostid = hostid
+        self.diskid = diskid
+        self.size = size
+        self.numa = numa
+        self.uplink = uplink
+        self.slots = 0
+
+    @property
+    def name(self):
+        return f'{self.hostid}-{self.diskid}'
+
+
+def inventory(facts):
+    """
+    the local nvme namespaces of all hosts with their size, numa node and
+    pcie uplink, and the management address of each host by hostid.
+    """
+    disks, hosts = [], {}
+    for agent, records in facts.items():
+        # the namespaces of other hosts exported by nvmet have links of
+        # the same name, only the block devices of the local pcie
+        # controllers are the disks of this host.
+        local = {r['name']: r['address'] for r in records
+                 if r['kind'] == 'nvme' and r['transport'] == 'pcie'}
+        sizes = {r['name']: r['size'] for r in records if r['kind'] == 'block'}
+        pcis = {r['name']: r for r in records if r['kind'] == 'pci'}
+        for record in records:
+            match = DISKLINK.match(record['name']) if record['kind'] == 'devlink' else None
+            ctrl = re.fullmatch(r'(nvme\d+)n\d+', record['target']) if match else None
+            if not ctrl or local.get(ctrl.group(1)) != match.group(2):
+                continue
+            hostid, address, nsid = match.groups()
+            hosts[hostid] = agent.mgmtip
+            pci = pcis.get(address, {})
+            disks.append(PlanDisk(hostid, f'{address}-n{nsid}', sizes.get(f"/dev/{record['target']}", 0),
+                                  pci.get('numa', -1), pci.get('uplink', address)))
+    return disks, hosts
+
+
+class LayoutPlan:
+    """
+    spread the lustre targets over the disks of all hosts. The mgt and
+    mdts get raid1 pairs of their own; the osts share the other disks,
+    each disk holding the same number of ost slots at the same offsets.
+    The members of an array are in distinct failure domains and the
+    least used hosts, uplinks and numa nodes first; its first two
+    members are on the hosts serving it, and hold its raid1 journal.
+    """
+    def __init__(self, cfgdata, disks, hosts):
+        cfg = ConfigItem(cfgdata)
+        self.osts = cfg.osts or 0
+        self.mdts = cfg.mdts or 1
+        self.raid = cfg.raid or 'raid5'
+        self.width = cfg.width or 3
+        self.net = cfg.net or 'tcp'
+        self.mgtsize = align_up(parse_size(cfg.mgt or '1GiB'))
+        self.journal = align_up(parse_size(cfg.journal or '1GiB'))
+        self.disk_read_mbs = cfg.disk_read_mbs or 6000
+        self.disk_write_mbs = cfg.disk_write_mbs or 3000
+        self.uplink_mbs = cfg.uplink_mbs or 24000
+        self.nic_mbs = cfg.nic_mbs or 12000
+        if self.raid not in DATA_DISKS:
+            raise ValueError(f'invalid ost raid {self.raid}')
+        self.ndata = DATA_DISKS[self.raid](self.width)
+        # the chunk of mdraid_create is the stripe over the data disks.
+        if self.ndata < 1 or STRIPE % self.ndata or (STRIPE // self.ndata) & (STRIPE // self.ndata - 1):
+            raise ValueError(f'{self.raid} of {self.width} disks splits the 1MiB stripe '
+                             f'into {self.ndata} uneven chunks')
+        if (cfg.domain or 'host') not in DOMAINS:
+            raise ValueError(f'invalid failure domain {cfg.domain}')
+        self.domain = DOMAINS[cfg.domain or 'host']
+
+        self.disks = sorted(disks, key=lambda disk: disk.name)
+        self.hostids = sorted(hosts)
+        self.nids = {hostid: f'{hosts[hostid]}@{self.net}' for hostid in self.hostids}
+        self.load = collections.Counter()
+        self.nodes = {hostid: {'diskgroups': [], 'volumes': [], 'targets': []}
+                      for hostid in self.hostids}
+        self.estimates = []
+
+    def servers(self, index):
+        primary = self.hostids[index % len(self.hostids)]
+        return primary, self.hostids[(index + 1) % len(self.hostids)]
+
+    def pick(self, name, pool, count, servers):
+        chosen = []
+        for i in range(count):
+            domains = {self.domain(disk) for disk in chosen}
+
+            def cost(disk):
+                return (self.domain(disk) in domains,
+                        i < len(servers) and disk.hostid != servers[i],
+                        disk.slots, self.load[disk.hostid], self.load[(disk.hostid, disk.uplink)],
+                        self.load[(disk.hostid, disk.numa)], disk.name)
+            candidates = [disk for disk in pool if disk not in chosen]
+            best = min(candidates, key=cost) if candidates else None
+            if best is None or self.domain(best) in domains:
+                raise ValueError(f'{name}: not enough disks in distinct failure domains '
+                                 f'for {count} members')
+            chosen.append(best)
+        for disk in chosen:
+            self.load.update([disk.hostid, (disk.hostid, disk.uplink), (disk.hostid, disk.numa)])
+        return chosen
+
+    def add(self, servers, tgtname, volumes):
+        """
+        add a target with its volumes, each a tuple of name, raid, disk
+        group, disks and partition bounds, to the node of its first
+        server. A volume on the first disks of a group takes their number.
+        """
+        node = self.nodes[servers[0]]
+        for volname, raid, groupname, disks, partsizes in volumes:
+            groups = {dg['name']: dg for dg in node['diskgroups']}
+            if groupname not in groups:
+                groups[groupname] = {'name': groupname, 'diskdir': '/dev/disk/nvme',
+                                     'disknames': [disk.name for disk in disks]}
+                node['diskgroups'].append(groups[groupname])
+            volume = {'name': volname, 'raid': raid, 'diskgroup': groupname,
+                      'partsizes': [mib(partsizes[0]), mib(partsizes[1])]}
+            if len(disks) < len(groups[groupname]['disknames']):
+                volume['disknum'] = len(disks)
+            node['volumes'].append(volume)
+        nids = list(dict.fromkeys(self.nids[host] for host in servers))
+        node['targets'].append({'name': tgtname, 'nids': nids,
+                                'vols': [vol[0] for vol in volumes]})
+
+    def plan_metadata(self, pool):
+        for i in range(self.mdts):
+            servers = self.servers(i)
+            pair = self.pick(f'mdt{i}', pool, 2, servers)
+            for disk in pair:
+                pool.remove(disk)
+            start = STRIPE
+            end = align_down(min(disk.size for disk in pair) - UNITS['MiB'])
+            group = 'mgtmdt0-disks' if i == 0 else f'mdt{i}-disks'
+            if i == 0:
+                # the mgt shares the disks of mdt0, as in the hand made configs.
+                self.add(servers, 'mgt', [('mgt-data', 'raid1', group, pair,
+                                           (start, start + self.mgtsize))])
+                start += self.mgtsize
+            self.add(servers, f'mdt{i}', [(f'mdt{i}-data', 'raid1', group, pair, (start, end))])
+
+    def plan_osts(self, pool):
+        if not self.osts:
+            return
+        if not pool:
+            raise ValueError('no disks left for the osts')
+        # every disk holds the same number of slots, the osts of a round
+        # use the same slot of their members.
+        perround = len(pool) // self.width
+        if not perround:
+            raise ValueError(f'osts of {self.width} disks do not fit on {len(pool)} disks')
+        nslots = math.ceil(self.osts / perround)
+        start = STRIPE
+        end = align_down(min(disk.size for disk in pool) - UNITS['MiB'])
+        slotsize = align_down((end - start) // nslots)
+        if slotsize <= self.journal:
+            raise ValueError(f'{nslots} ost slots do not fit on disks of {mib(end)}')
+
+        index = 0
+        for rnd in range(nslots):
+            free = list(pool)
+            for _ in range(min(perround, self.osts - index)):
+                name = f'ost{index}'
+                servers = self.servers(index)
+                members = self.pick(name, free, self.width, servers)
+                for disk in members:
+                    free.remove(disk)
+                    disk.slots += 1
+                slot = start + rnd * slotsize
+                self.add(servers, name, [
+                    (f'{name}-data', self.raid, f'{name}-disks', members,
+                     (slot + self.journal, slot + slotsize)),
+                    (f'{name}-journal', 'raid1', f'{name}-disks', members[:2],
+                     (slot, slot + self.journal))])
+                # less the 1M data offset of mdadm on each member.
+                capacity = self.ndata * (slotsize - self.journal - UNITS['MiB'])
+                self.estimates.append({'target': name, 'host': servers[0], 'members': members,
+                                       'capacity': capacity})
+                index += 1
+
+    def estimate(self):
+        """
+        the streaming bandwidth of each ost when all of them run at once:
+        a disk gives its speed, less when its pcie uplink is oversubscribed,
+        shared by the osts on it; an array streams at its slowest member
+        times its data disks; the osts of a host are capped by its nic.
+        """
+        uplinks = collections.Counter((disk.hostid, disk.uplink) for disk in self.disks)
+        for key, speed in (('read_mbs', self.disk_read_mbs), ('write_mbs', self.disk_write_mbs)):
+            for est in self.estimates:
+                est[key] = self.ndata * min(
+                    min(speed, self.uplink_mbs / uplinks[(disk.hostid, disk.uplink)]) / disk.slots
+                    for disk in est['members'])
+            for hostid in self.hostids:
+                hostests = [est for est in self.estimates if est['host'] == hostid]
+                total = sum(est[key] for est in hostests)
+                for est in hostests:
+                    if total > self.nic_mbs:
+                        est[key] *= self.nic_mbs / total
+        return [{'target': est['target'], 'host': est['host'],
+                 'members': [disk.name for disk in est['members']],
+                 'capacity_gib': round(est['capacity'] / UNITS['GiB'], 1),
+                 'read_mbs': round(est['read_mbs']), 'write_mbs': round(est['write_mbs'])}
+                for est in self.estimates]
+
+    def plan(self):
+        if not self.hostids:
+            raise ValueError('no local nvme disks found on the hosts')
+        pool = list(self.disks)
+        self.plan_metadata(pool)
+        self.plan_osts(pool)
+        return self.nodes, self.estimate()
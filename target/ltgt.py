@@ -1,25 +1,37 @@
 #!/usr/bin/env python
 
 import argparse
+import json
+import os
+import statistics
+import sys
+import threading
+import time
 import yaml
-from tgtconfig import ConfigAgent, ConfigItem
+import fleet
+import layout
+from tgtconfig import (FACTS_TTL, ConfigAgent, ConfigItem, Journal, fact_names, gather_facts,
+                       parallel, preflight_check, query_status, setup_affinity, status_report)
 
 
 class Disk:
-    gpt_table = {}
-
     def __init__(self, devpath):
         self.devpath = devpath
+        self.partitions = []
 
-    def mklabel(self, agent):
-        if self.devpath in Disk.gpt_table:
-            return
-        agent.execute('parted_label', self.devpath)
-        Disk.gpt_table[self.devpath] = 1
+    def addpart(self, part):
+        self.partitions.append(part)
 
-    def mkpart(self, agent, partname, partsizes):
-        agent.execute('parted_mkpart', self.devpath, partname,
-                      partsizes[0], partsizes[1])
+    def mktable(self, agent):
+        """
+        write the whole gpt of the disk, i.e. all partitions planned on it
+        by any volume, in one operation.
+        """
+        if not self.partitions:
+            return
+        parts = [f'{part.name}:{part.partsizes[0]}:{part.partsizes[1]}'
+                 for part in self.partitions]
+        agent.execute('parted_mktable', self.devpath, *parts)
 
     def rmpart(self, agent, partname):
         agent.execute('parted_rm', self.devpath, partname)
@@ -30,21 +42,18 @@ class Partition:
         self.name = name
         self.partsizes = partsizes
         self.disk = disk
+        disk.addpart(self)
 
     @property
     def devpath(self):
         return f'/dev/disk/by-partlabel/{self.name}'
 
-    def create(self, agent):
-        self.disk.mklabel(agent)
-        self.disk.mkpart(agent, self.name, self.partsizes)
-
     def destroy(self, agent):
         self.disk.rmpart(agent, self.name)
 
 
 class DiskGroup:
-    def __init__(self, cfgdata):
+    def __init__(self, cfgdata, disks):
         cfg = ConfigItem(cfgdata)
         diskpaths = []
         if cfg.disknames:
@@ -53,7 +62,9 @@ class DiskGroup:
             diskpaths = [f'{cfg.diskdir}/{hostid}-{diskid}'
                          for diskid in cfg.diskids
                          for hostid in cfg.hostids]
-        self.disks = [Disk(path) for path in diskpaths]
+        # disks are shared among groups so that all partitions of a
+        # disk are collected in one place.
+        self.disks = [disks.setdefault(path, Disk(path)) for path in diskpaths]
 
     def diskpaths(self):
         return [disk.devpath for disk in self.disks]
@@ -65,7 +76,7 @@ class DiskGroup:
         if ndisk == 1:
             return [Partition(prefix, partsizes, self.disks[0])]
         return [Partition(prefix + f'-{i}', partsizes, disk)
-                for i, disk in enumerate(self.disks)]
+                for i, disk in enumerate(self.disks[:ndisk])]
 
 
 class Volume:
@@ -77,19 +88,30 @@ class Volume:
         self.ndisk = int(cfg.disknum) if cfg.disknum else 0
         self.diskgroup = diskgroups[cfg.diskgroup] if diskgroups else None
 
+    @property
+    def diskpaths(self):
+        return []
+
     def create(self, agent):
         pass
 
     def destroy(self, agent):
         pass
 
+    def status(self, records):
+        """
+        the state and detail of the volume from the records of the host
+        using it.
+        """
+        return 'healthy', ''
+
 
 class NullVolume(Volume):
     """
     used for a nil journal volume to unify volume usage.
     """
     def __init__(self):
-        super().__init__(None, None)
+        super().__init__({}, None)
 
     @property
     def devpath(self):
@@ -106,17 +128,24 @@ class ZpoolVolume(Volume):
     def __init__(self, cfg, diskgroups):
         super().__init__(cfg, diskgroups)
         self.created = 0
+        self.lock = threading.Lock()
 
     @property
     def devpath(self):
         return self.name
 
+    @property
+    def diskpaths(self):
+        return self.diskgroup.diskpaths()
+
     def create(self, agent):
-        if self.created:
-            return
-        agent.execute('zpool_create', self.name, self.raid,
-                      *self.diskgroup.diskpaths())
-        self.created = 1
+        # a pool is shared by the targets created concurrently on it.
+        with self.lock:
+            if self.created:
+                return
+            agent.execute('zpool_create', self.name, self.raid,
+                          *self.diskpaths, disks=self.diskpaths)
+            self.created = 1
 
     def destroy(self, agent):
         agent.execute('zpool_destroy', self.name)
@@ -126,16 +155,24 @@ class RaidVolume(Volume):
     def __init__(self, cfg, diskgroups):
         super().__init__(cfg, diskgroups)
         self.partitions = self.diskgroup.diskparts(self.name, self.partsizes, self.ndisk)
+        # the initial sync runs in the background after the creation, out
+        # of the raid slot, so its speed is bounded per array instead.
+        self.sync_speed_max = int(ConfigItem(cfg).sync_speed_max or 0)
 
     @property
     def devpath(self):
         return f'/dev/md/{self.name}'
 
+    @property
+    def diskpaths(self):
+        return [part.disk.devpath for part in self.partitions]
+
     def create(self, agent):
-        for part in self.partitions:
-            part.create(agent)
         partpaths = [part.devpath for part in self.partitions]
-        agent.execute('mdraid_create', self.name, self.raid, *partpaths)
+        agent.execute('mdraid_create', self.name, self.raid, *partpaths,
+                      disks=self.diskpaths)
+        if self.sync_speed_max:
+            agent.execute('mdraid_throttle', self.name, 0, self.sync_speed_max)
 
     def destroy(self, agent):
         partpaths = [part.devpath for part in self.partitions]
@@ -143,6 +180,22 @@ class RaidVolume(Volume):
         for part in self.partitions:
             part.destroy(agent)
 
+    def readd(self, agent, part, speed_min, speed_max, wait_timeout):
+        agent.execute('mdraid_readd', self.name, part.devpath, speed_min, speed_max,
+                      disks=[part.disk.devpath])
+        agent.execute('mdraid_wait', self.name, wait_timeout)
+
+    def status(self, records):
+        for record in records:
+            if record['kind'] != 'md' or record['name'] != self.name:
+                continue
+            if record['degraded']:
+                return 'degraded', f"{self.name} missing {record['degraded']} members"
+            if record['action'] not in ('idle', 'none'):
+                return 'degraded', f"{self.name} {record['action']}"
+            return 'healthy', ''
+        return 'missing', f'{self.name} not assembled'
+
 
 class RawVolume(Volume):
     """
@@ -157,8 +210,12 @@ class RawVolume(Volume):
     def devpath(self):
         return self.partitions[0].devpath
 
+    @property
+    def diskpaths(self):
+        return [self.partitions[0].disk.devpath]
+
     def create(self, agent):
-        self.partitions[0].create(agent)
+        pass
 
     def destroy(self, agent):
         self.partitions[0].destroy(agent)
@@ -174,6 +231,8 @@ class LustreTgt:
         self.lfsname = lfs_cfg.fsname
         self.osdtype = lfs_cfg.osdtype
         self.mgsnids = ':'.join(lfs_cfg.mgsnids)
+        self.lazy_journal_init = 1 if lfs_cfg.lazy_journal_init else 0
+        self.init_itable = lfs_cfg.init_itable or 0
 
     def create(self, agent):
         self.jvol.create(agent)
@@ -181,8 +240,10 @@ class LustreTgt:
 
         tgttype = self.name[0:3]
         cmd = f'{self.osdtype}_{tgttype}_create'
+        lazyopts = [self.lazy_journal_init, self.init_itable] if self.osdtype == 'ldiskfs' else []
         agent.execute(cmd, self.lfsname, self.name, self.svcnids, self.mgsnids,
-                      self.dvol.devpath, self.jvol.devpath)
+                      self.dvol.devpath, self.jvol.devpath, *lazyopts,
+                      disks=self.dvol.diskpaths + self.jvol.diskpaths)
 
     def destroy(self, agent):
         cmd = f'{self.osdtype}_tgt_destroy'
@@ -191,6 +252,23 @@ class LustreTgt:
         self.jvol.destroy(agent)
         self.dvol.destroy(agent)
 
+    def status(self, facts):
+        """
+        the target is healthy when mounted on one of the hosts with its
+        volumes in good shape there.
+        """
+        mountpoint = f'/var/lib/lustre/{self.lfsname}/{self.name}'
+        row = {'host': '-', 'component': f'target {self.name}',
+               'state': 'missing', 'detail': 'not mounted'}
+        for agent, records in facts.items():
+            if {'kind': 'mount', 'name': mountpoint} not in records:
+                continue
+            states = [vol.status(records) for vol in (self.dvol, self.jvol)]
+            bad = [state for state in states if state[0] != 'healthy']
+            state, detail = bad[0] if bad else states[0]
+            row.update(host=agent.mgmtip, state=state, detail=detail)
+        return row
+
 volume_classes = [
         {
             'raid1':    RaidVolume,
@@ -213,57 +291,419 @@ def volume_class(osdtype, raid):
     raise ValueError(f'unknown raidtype {raid} for osdtype {osdtype}')
 
 
+# the mgt has to run before the other targets register, and mdt0 is
+# the first one to register. The other mdts and the osts are then
+# created at the same time, as far as the concurrency limits allow.
+CREATE_PHASES = ('mgt', 'mdt0', 'others')
+
+
+def create_phase(tgt):
+    if tgt.name.startswith('mgt'):
+        return 'mgt'
+    return 'mdt0' if tgt.name == 'mdt0' else 'others'
+
+
 class LustreNode:
     def __init__(self, cfgdata):
         cfg, lfs_cfg = ConfigItem(cfgdata), ConfigItem(cfgdata['lustre'])
-        self.diskgroups = {dgc['name']: DiskGroup(dgc)
+        self.lfsname = lfs_cfg.fsname
+        self.disks = {}
+        self.diskgroups = {dgc['name']: DiskGroup(dgc, self.disks)
                            for dgc in cfg.diskgroups}
-        self.volumes = {vc['name']: volume_class(lfs_cfg.osdtype, vc['raid'])(vc)
+        self.volumes = {vc['name']: volume_class(lfs_cfg.osdtype, vc['raid'])(vc, self.diskgroups)
                         for vc in cfg.volumes}
         self.targets = [LustreTgt(tc, lfs_cfg, self.volumes) for tc in cfg.targets]
+        self.nids = lfs_cfg.mgsnids + [nid for tc in cfg.targets for nid in tc['nids']]
 
-    def create(self, agent):
-        for tgt in self.targets:
-            tgt.create(agent)
+    def create(self, agent, phases=CREATE_PHASES):
+        # partitions of all volumes are created before any volume, one
+        # gpt write per disk and all disks at the same time.
+        if CREATE_PHASES[0] in phases:
+            parallel(lambda disk: disk.mktable(agent), self.disks.values())
+        for phase in phases:
+            parallel(lambda tgt: tgt.create(agent),
+                     [tgt for tgt in self.targets if create_phase(tgt) == phase])
 
     def destroy(self, agent):
         self.targets.reverse()
         for tgt in self.targets:
             tgt.destroy(agent)
 
-
-def build(config):
+    def find_disk(self, diskname):
+        for disk in self.disks.values():
+            if diskname in (disk.devpath, os.path.basename(disk.devpath)):
+                return disk
+        raise ValueError(f'unknown disk {diskname}')
+
+    def replace_disk(self, agent, diskname, speed_min=0, speed_max=0, wait_timeout=600):
+        """
+        rebuild all arrays touching a replaced disk: recreate its gpt in
+        one pass, then re-add its partitions to their arrays in parallel
+        and wait until every array is clean.
+        """
+        disk = self.find_disk(diskname)
+        disk.mktable(agent)
+
+        readds = []
+        for vol in self.volumes.values():
+            for part in getattr(vol, 'partitions', []):
+                if part.disk is not disk:
+                    continue
+                if isinstance(vol, RaidVolume):
+                    readds.append((vol, part))
+                else:
+                    print(f'volume {vol.name} has no redundancy, recreate it')
+        parallel(lambda readd: readd[0].readd(agent, readd[1], speed_min, speed_max,
+                                              wait_timeout),
+                 readds)
+
+    def bench(self, agent, tool, runtime, size_mb):
+        """
+        benchmark all osts of the node and return one result per ost,
+        size_mb is the amount written per ost by obdfilter-survey.
+        """
+        tgtdevs = [f'{tgt.name}:{tgt.dvol.devpath}'
+                   for tgt in self.targets if tgt.name.startswith('ost')]
+        if tool == 'fio':
+            output = agent.query('ltgt_bench_fio', runtime, *tgtdevs)
+        else:
+            output = agent.query('ltgt_bench_survey', self.lfsname, size_mb, *tgtdevs)
+        results = [json.loads(line) for line in (output or '').splitlines()
+                   if line.startswith('{')]
+        for result in results:
+            result['node'] = agent.mgmtip
+        return results
+
+    def status(self, facts):
+        return [tgt.status(facts) for tgt in self.targets]
+
+    def preflight(self, facts):
+        """
+        the disks of all diskgroups should be on every host of the node.
+        """
+        errors = []
+        for agent, records in facts.items():
+            devices = fact_names(records, 'block', 'devlink')
+            errors += [f'{agent.mgmtip}: no disk {path} of diskgroup {name}'
+                       for name, dg in self.diskgroups.items()
+                       for path in dg.diskpaths() if path not in devices]
+        return errors
+
+    def lazyinit(self, agent):
+        """
+        the progress of the inode table zeroing of every ldiskfs target
+        of the node, one result per target.
+        """
+        tgtdevs = [f'{tgt.name}:{tgt.dvol.devpath}' for tgt in self.targets
+                   if tgt.osdtype == 'ldiskfs']
+        if not tgtdevs:
+            return []
+        output = agent.query('ldiskfs_lazyinit_status', *tgtdevs)
+        results = [json.loads(line) for line in (output or '').splitlines()
+                   if line.startswith('{')]
+        for result in results:
+            result['node'] = agent.mgmtip
+            result['done'] = result['zeroed'] >= result['groups']
+        return results
+
+    def destroy_bulk(self, agent):
+        """
+        tear down the whole node with one op per stage: unmount all
+        targets, stop all arrays, then wipe all members and disks.
+        Each op handles its devices in parallel on the agent side.
+        """
+        agent.execute('lustre_tgt_destroy_all', self.lfsname,
+                      *[tgt.name for tgt in self.targets])
+
+        volumes = self.volumes.values()
+        raidnames = [vol.name for vol in volumes if isinstance(vol, RaidVolume)]
+        if raidnames:
+            agent.execute('mdraid_stop_all', *raidnames)
+        for vol in volumes:
+            if isinstance(vol, ZpoolVolume):
+                vol.destroy(agent)
+
+        disks = [disk for disk in self.disks.values() if disk.partitions]
+        partpaths = [part.devpath for disk in disks for part in disk.partitions]
+        if partpaths:
+            diskpaths = [disk.devpath for disk in disks]
+            agent.execute('mdraid_wipe_all', *partpaths, disks=diskpaths)
+            agent.execute('parted_wipe_all', *diskpaths, disks=diskpaths)
+
+
+def build(config, journal=None):
     lnode = LustreNode(config)
-    agents = ConfigAgent.from_config(config['agents'])
+    agents = ConfigAgent.from_config(config['agents'], journal, config.get('concurrency'))
     return agents, lnode
 
 
+def preflight(agents, lnode, ttl):
+    preflight_check(lnode.preflight(gather_facts(agents, ttl)))
+
+
 def create(agents, lnode):
     for agent in agents:
         lnode.create(agent)
 
 
-def destroy(agents, lnode):
+def destroy(agents, lnode, bulk=False):
+    for agent in agents:
+        if bulk:
+            lnode.destroy_bulk(agent)
+        else:
+            lnode.destroy(agent)
+
+
+def replace_disk(agents, lnode, diskname, speed_min, speed_max, wait_timeout):
     for agent in agents:
-        lnode.destroy(agent)
+        lnode.replace_disk(agent, diskname, speed_min, speed_max, wait_timeout)
+
+
+def status(agents, lnode, report):
+    rows = lnode.status(query_status(agents))
+    if not status_report(rows, report):
+        sys.exit(1)
+
+
+def affinity(agents, lnode):
+    # the disks of all volumes and the nics of all nids.
+    items = list(lnode.disks) + [nid.partition('@')[0] for nid in lnode.nids]
+    setup_affinity(agents, items, lnet=True)
+
+
+def lazyinit(agents, lnode, wait, interval, report):
+    """
+    report the inode table zeroing of all targets, and with wait, poll
+    until all of them are fully initialized. Exit 1 while any is not.
+    """
+    while True:
+        results = []
+        parallel(lambda agent: results.extend(lnode.lazyinit(agent)),
+                 [agent for agent in agents if agent.mode == 'active'])
+        for result in results:
+            print(f"{result['target']:<8} {result['zeroed']:>8}/{result['groups']:<8} "
+                  f"{'initialized' if result['done'] else 'zeroing'}")
+        pending = [result for result in results if not result['done']]
+        if not pending or not wait:
+            break
+        time.sleep(interval)
+
+    if report:
+        with open(report, 'w') as f:
+            json.dump(results, f, indent=2)
+    if pending:
+        sys.exit(1)
+    print('fully initialized')
+
+
+def bench_report(results, tolerance):
+    """
+    aggregate per-ost results per node and flag the outliers: degraded
+    or misaligned arrays and osts notably slower than the median.
+    """
+    nodes = {}
+    for result in results:
+        node = nodes.setdefault(result['node'], {'read_mbs': 0, 'write_mbs': 0, 'iops': 0})
+        for key in node:
+            node[key] += result[key] or 0
+
+    outliers = []
+    for key in ('read_mbs', 'write_mbs', 'iops'):
+        values = [result[key] for result in results if result[key] is not None]
+        if not values:
+            continue
+        median = statistics.median(values)
+        for result in results:
+            if result[key] is not None and result[key] < median * (1 - tolerance):
+                outliers.append({'target': result['target'], 'node': result['node'],
+                                 'reason': f'{key} {result[key]} below median {median}'})
+    for result in results:
+        if result['degraded']:
+            outliers.append({'target': result['target'], 'node': result['node'],
+                             'reason': 'degraded array'})
+        if not result['aligned']:
+            outliers.append({'target': result['target'], 'node': result['node'],
+                             'reason': 'members not aligned to the stripe chunk'})
+    return {'targets': results, 'nodes': nodes, 'outliers': outliers}
+
+
+def bench(agents, lnode, tool, runtime, size_mb, tolerance, report):
+    results, lazyinits = [], []
+    actives = [agent for agent in agents if agent.mode == 'active']
+    # osts still zeroing their inode tables are slower than they will be.
+    parallel(lambda agent: lazyinits.extend(lnode.lazyinit(agent)), actives)
+    parallel(lambda agent: results.extend(lnode.bench(agent, tool, runtime, size_mb)),
+             actives)
+    data = bench_report(results, tolerance)
+    data['outliers'] += [{'target': result['target'], 'node': result['node'],
+                          'reason': 'inode tables not fully initialized'}
+                         for result in lazyinits
+                         if not result['done'] and result['target'].startswith('ost')]
+    if report:
+        with open(report, 'w') as f:
+            json.dump(data, f, indent=2)
+    print(json.dumps(data, indent=2))
+    if data['outliers']:
+        sys.exit(1)
+
+
+def plan_config(config, agents, hosts, nodes):
+    """
+    the fleet config of the planned nodes, see fleet.py, with the lustre
+    section of the plan config and the mgs on the servers of the mgt.
+    """
+    lustre = dict(config['lustre'])
+    if 'mgsnids' not in lustre:
+        lustre['mgsnids'] = next(list(tgt['nids']) for node in nodes.values()
+                                 for tgt in node['targets'] if tgt['name'] == 'mgt')
+    net = config['plan'].get('net', 'tcp')
+    plancfg = {
+        'fleet': {
+            'script': agents[0].script,
+            'workdir': agents[0].workdir,
+            'nodes': list(nodes),
+            'overrides': {hostid: {'vars': {'mgmtip': hosts[hostid],
+                                            'nid': f'{hosts[hostid]}@{net}'},
+                                   'ltgt': node}
+                          for hostid, node in nodes.items()},
+        },
+        'ltgt': {'template': {'lustre': lustre, 'diskgroups': [], 'volumes': [], 'targets': []}},
+    }
+    if 'concurrency' in config:
+        plancfg['concurrency'] = config['concurrency']
+    return plancfg
+
+
+def plan(agents, config, ttl, output, report):
+    """
+    lay out the targets of the plan section over the nvme disks found on
+    the agents, and write it as a fleet config for ltgt.py headed by the
+    estimated bandwidth of each ost.
+    """
+    disks, hosts = layout.inventory(gather_facts(agents, ttl))
+    nodes, estimates = layout.LayoutPlan(config['plan'], disks, hosts).plan()
+
+    lines = [f"{'target':<8} {'host':<8} {'GiB':>10} {'read MB/s':>10} {'write MB/s':>10}  members"]
+    lines += [f"{est['target']:<8} {est['host']:<8} {est['capacity_gib']:>10} "
+              f"{est['read_mbs']:>10} {est['write_mbs']:>10}  {' '.join(est['members'])}"
+              for est in estimates]
+    total = {key: round(sum(est[key] for est in estimates), 1)
+             for key in ('capacity_gib', 'read_mbs', 'write_mbs')}
+    lines.append(f"{'total':<8} {'':<8} {total['capacity_gib']:>10} "
+                 f"{total['read_mbs']:>10} {total['write_mbs']:>10}")
+    text = ''.join(f'# {line}\n' for line in lines) + '\n'
+    text += yaml.safe_dump(plan_config(config, agents, hosts, nodes), sort_keys=False)
+
+    if report:
+        with open(report, 'w') as f:
+            json.dump({'targets': estimates, 'total': total}, f, indent=2)
+    if not output:
+        sys.stdout.write(text)
+        return
+    with open(output, 'w') as f:
+        f.write(text)
+    print('\n'.join(lines))
+
+
+FLEET_OPERATIONS = ('create', 'destroy', 'status')
+
+
+def deploy_fleet(config, journal, args):
+    """
+    run the operation on every node of a fleet config, see fleet.py.
+    """
+    nodes = fleet.build(config, 'ltgt', LustreNode, journal)
+    if args.operation == 'create':
+        fleet.preflight(nodes, args.facts_ttl)
+        # phase by phase over all nodes, so that no target of a node
+        # registers before the mgt and mdt0 of another node exist.
+        for phase in CREATE_PHASES:
+            fleet.deploy(nodes, lambda agent, lnode: lnode.create(agent, (phase,)))
+    elif args.operation == 'destroy' and args.bulk:
+        fleet.deploy(nodes, lambda agent, lnode: lnode.destroy_bulk(agent))
+    elif args.operation == 'destroy':
+        fleet.deploy(nodes, lambda agent, lnode: lnode.destroy(agent))
+    elif args.operation == 'status':
+        if not status_report(fleet.status(nodes), args.report):
+            sys.exit(1)
 
 
 def main():
     parser = argparse.ArgumentParser(description="target script")
-    parser.add_argument(dest='operation', choices=['create', 'destroy'],
+    parser.add_argument(dest='operation',
+                        choices=['create', 'destroy', 'replace-disk', 'bench', 'status',
+                                 'lazyinit', 'affinity', 'plan'],
                         help="create/destroy/monitor lustre deployment")
     parser.add_argument('-c', '--config', type=str, default='./ltgt.yaml',
                         help="Path to the config file")
+    parser.add_argument('--bulk', action='store_true',
+                        help="destroy all targets and volumes at once")
+    parser.add_argument('--disk', type=str,
+                        help="replaced disk, by path or name in its diskdir")
+    parser.add_argument('--speed-min', type=int, default=0,
+                        help="resync speed_min in K/sec for replace-disk")
+    parser.add_argument('--speed-max', type=int, default=0,
+                        help="resync speed_max in K/sec for replace-disk")
+    parser.add_argument('--wait-timeout', type=int, default=600,
+                        help="seconds a resync of replace-disk may make no progress")
+    parser.add_argument('--tool', choices=['survey', 'fio'], default='survey',
+                        help="bench with obdfilter-survey on formatted osts or fio on devices")
+    parser.add_argument('--runtime', type=int, default=60,
+                        help="seconds of each fio run for bench")
+    parser.add_argument('--size-mb', type=int, default=16384,
+                        help="MB written per ost by obdfilter-survey for bench")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="fraction below the median that makes an ost an outlier")
+    parser.add_argument('--report', type=str,
+                        help="path of the json report written by bench, status, lazyinit or plan")
+    parser.add_argument('-o', '--output', type=str,
+                        help="path of the fleet config written by plan, stdout by default")
+    parser.add_argument('--wait', action='store_true',
+                        help="make lazyinit wait until all targets are fully initialized")
+    parser.add_argument('--interval', type=int, default=60,
+                        help="seconds between two polls of lazyinit --wait")
+    parser.add_argument('--resume', action='store_true',
+                        help="skip the ops completed by the last run of the same config")
+    parser.add_argument('--facts-ttl', type=int, default=FACTS_TTL,
+                        help="seconds the cached host facts are used, 0 to gather them again")
     args = parser.parse_args()
+    if args.operation == 'replace-disk' and not args.disk:
+        parser.error('replace-disk requires --disk')
 
     with open(args.config, 'r') as f:
         config = yaml.safe_load(f)
 
-    agents, lnode = build(config)
-    if args.operation == 'create':
-        create(agents, lnode)
-    elif args.operation == 'destroy':
-        destroy(agents, lnode)
+    if args.operation == 'plan':
+        agents = ConfigAgent.from_config(config['agents'])
+        plan(agents, config, args.facts_ttl, args.output, args.report)
+        return
+
+    with Journal.from_config(config, 'ltgt', args.operation, args.resume) as journal:
+        if 'fleet' in config:
+            if args.operation not in FLEET_OPERATIONS:
+                parser.error(f'{args.operation} is not supported for a fleet')
+            deploy_fleet(config, journal, args)
+            return
+
+        agents, lnode = build(config, journal)
+        if args.operation in ('create', 'replace-disk'):
+            preflight(agents, lnode, args.facts_ttl)
+        if args.operation == 'create':
+            create(agents, lnode)
+        elif args.operation == 'destroy':
+            destroy(agents, lnode, args.bulk)
+        elif args.operation == 'replace-disk':
+            replace_disk(agents, lnode, args.disk, args.speed_min, args.speed_max,
+                         args.wait_timeout)
+        elif args.operation == 'bench':
+            bench(agents, lnode, args.tool, args.runtime, args.size_mb, args.tolerance,
+                  args.report)
+        elif args.operation == 'status':
+            status(agents, lnode, args.report)
+        elif args.operation == 'lazyinit':
+            lazyinit(agents, lnode, args.wait, args.interval, args.report)
+        elif args.operation == 'affinity':
+            affinity(agents, lnode)
 
 
 if __name__ == "__main__":
@@ -2,7 +2,7 @@
 
 import argparse
 import yaml
-from tgtconfig import ConfigAgent, ConfigItem
+from tgtconfig import ConfigAgent, ConfigItem, Journal, parallel
 
 class DiskGroup:
     def __init__(self, cfgdata):
@@ -10,6 +10,7 @@ class DiskGroup:
         self.diskpaths = [f'{cfg.diskdir}/{hostid}-{diskid}'
                           for diskid in cfg.diskids
                           for hostid in cfg.hostids]
+        self.diskhosts = [hostid for diskid in cfg.diskids for hostid in cfg.hostids]
 
 
 class RaidVolume:
@@ -23,26 +24,133 @@ class RaidVolume:
     def devpath(self):
         return f'/dev/md/{self.name}'
 
+    @property
+    def pvpaths(self):
+        return [self.devpath]
+
+    @property
+    def pvspecs(self):
+        return self.pvpaths
+
     def create(self, agent):
-        agent.execute('mdraid_create', self.name, self.raid, *self.diskgroup.diskpaths)
+        agent.execute('mdraid_create', self.name, self.raid, *self.diskgroup.diskpaths,
+                      disks=self.diskgroup.diskpaths)
 
     def destroy(self, agent):
         agent.execute('mdraid_destroy', self.name, self.raid, *self.diskgroup.diskpaths)
 
 
+class NamespaceVolume(RaidVolume):
+    """
+    the namespaces of a diskgroup used as pvs as they are, without md.
+    """
+    @property
+    def pvpaths(self):
+        return self.diskgroup.diskpaths
+
+    @property
+    def pvspecs(self):
+        # each pv tagged with the host of its namespace, see lvm_vg_create.
+        return [f'{path}@{hostid}' for path, hostid in
+                zip(self.diskgroup.diskpaths, self.diskgroup.diskhosts)]
+
+    def create(self, agent):
+        pass
+
+    def destroy(self, agent):
+        pass
+
+
+def volume_class(raid):
+    return NamespaceVolume if raid == 'none' else RaidVolume
+
+
+# the stripes of each lv type over n pvs, None when it has no stripes.
+LV_STRIPES = {
+    'striped':  lambda n: n,
+    'raid0':    lambda n: n,
+    'raid1':    lambda n: None,
+    'raid5':    lambda n: n - 1,
+    'raid6':    lambda n: n - 2,
+    'raid10':   lambda n: n // 2,
+}
+
+# the least stripes lvcreate accepts for each lv type.
+LV_MIN_STRIPES = {'raid5': 2, 'raid6': 3, 'raid10': 2}
+
+# the lv types whose legs are placed on pvs of different hosts.
+LV_MIRRORED = ('raid1', 'raid10')
+
+ACTIVATIONS = ('shared', 'exclusive')
+
+
+class LvmLv:
+    """
+    a template of lvs: count lvs named name0, name1... or one lv named
+    name, each of the given size. Stripes and stripe size default to all
+    pvs of the vg and to the stripe of the pvs.
+    """
+    def __init__(self, cfgdata, npv):
+        cfg = ConfigItem(cfgdata)
+        self.name = cfg.name
+        self.type = cfg.type or 'striped'
+        self.size = cfg.size or '100%FREE'
+        self.count = cfg.count
+        self.activation = cfg.activation or 'shared'
+        if self.type not in LV_STRIPES:
+            raise ValueError(f'invalid lv type: {self.type}')
+        if self.activation not in ACTIVATIONS:
+            raise ValueError(f'invalid lv activation: {self.activation}')
+        # lvmlockd activates raid lvs on one host only.
+        if self.activation == 'shared' and self.type.startswith('raid'):
+            raise ValueError(f'{self.type} lv {self.name} can not be activated shared')
+        self.stripes = cfg.stripes or LV_STRIPES[self.type](npv)
+        minstripes = LV_MIN_STRIPES.get(self.type, 1)
+        if self.stripes is not None and self.stripes < minstripes:
+            raise ValueError(f'{self.type} lv {self.name} needs {minstripes} stripes, '
+                             f'has {self.stripes} over {npv} pvs')
+        self.stripesize = cfg.stripesize or 'auto'
+
+    @property
+    def names(self):
+        if self.count is None:
+            return [self.name]
+        return [f'{self.name}{i}' for i in range(self.count)]
+
+    @property
+    def specs(self):
+        return [f'{name}:{self.type}:{self.size}:{self.stripes or 0}:{self.stripesize}:'
+                f'{self.activation}' for name in self.names]
+
+
 class LvmVg:
     def __init__(self, cfgdata, volumes):
         cfg = ConfigItem(cfgdata)
         self.name = cfg.name
-        self.volume = volumes[cfg.volume]
+        names = cfg.volumes or [cfg.volume]
+        self.volumes = [volumes[name] for name in names]
+        self.pvpaths = [path for volume in self.volumes for path in volume.pvpaths]
+        self.pvspecs = [spec for volume in self.volumes for spec in volume.pvspecs]
+        self.lvs = [LvmLv(lv, len(self.pvpaths)) for lv in cfg.lvs or []]
+        # the legs of a mirrored lv go to pvs of different host tags, so the
+        # tagged pvs must span several hosts.
+        hosts = {spec.rpartition('@')[2] for spec in self.pvspecs if '@' in spec}
+        for lv in self.lvs:
+            if lv.type in LV_MIRRORED and len(hosts) == 1:
+                raise ValueError(f'{lv.type} lv {lv.name} needs the pvs of several hosts')
 
     def create(self, agent):
-        self.volume.create(agent)
-        agent.execute('lvm_vg_create', self.name, self.volume.name)
+        parallel(lambda volume: volume.create(agent), self.volumes)
+        agent.execute('lvm_vg_create', self.name, *self.pvspecs)
+        # all lvs of the vg in one batch.
+        if self.lvs:
+            agent.execute('lvm_lv_create', self.name, *[spec for lv in self.lvs
+                                                        for spec in lv.specs])
 
     def destroy(self, agent):
-        agent.execute('lvm_vg_destroy', self.name, self.volume.name)
-        self.volume.destroy(agent)
+        agent.execute('lvm_vg_destroy', self.name, *self.pvpaths)
+        for volume in self.volumes[::-1]:
+            volume.destroy(agent)
 
 
 class LvmNode:
@@ -50,22 +158,23 @@ class LvmNode:
         cfg = ConfigItem(cfgdata)
         self.diskgroups = {dg['name']: DiskGroup(dg)
                            for dg in cfg.diskgroups}
-        self.volumes = {vc['name']: RaidVolume(vc, self.diskgroups)
+        self.volumes = {vc['name']: volume_class(vc['raid'])(vc, self.diskgroups)
                         for vc in cfg.volumes}
         self.vgs = [LvmVg(vg, self.volumes) for vg in cfg.vgs]
 
     def create(self, agent):
-        for vg in self.vgs:
-            vg.create(agent)
+        # vgs are independent, their arrays are created at the same time
+        # as far as the concurrency limits of the node allow.
+        parallel(lambda vg: vg.create(agent), self.vgs)
 
     def destroy(self, agent):
         for vg in self.vgs[::-1]:
             vg.destroy(agent)
 
 
-def build(cfg):
+def build(cfg, journal=None):
     topology = LvmNode(cfg)
-    agents = ConfigAgent.from_config(cfg['agents'])
+    agents = ConfigAgent.from_config(cfg['agents'], journal, cfg.get('concurrency'))
     return agents, topology
 
 
@@ -86,17 +195,20 @@ def main():
                         help="Path to the config file")
     parser.add_argument(dest='operation', choices=['create', 'destroy'],
                         help="create/destroy lvmt deployment")
+    parser.add_argument('--resume', action='store_true',
+                        help="skip the ops completed by the last run of the same config")
     args = parser.parse_args()
     config_file = args.config
 
     with open(config_file, 'r') as f:
         config = yaml.safe_load(f)
 
-    agents, topology = build(config)
-    if args.operation == 'create':
-        create(agents, topology)
-    if args.operation == 'destroy':
-        destroy(agents, topology)
+    with Journal.from_config(config, 'lvm', args.operation, args.resume) as journal:
+        agents, topology = build(config, journal)
+        if args.operation == 'create':
+            create(agents, topology)
+        if args.operation == 'destroy':
+            destroy(agents, topology)
 
 
 if __name__ == "__main__":
@@ -1,8 +1,16 @@
 #!/usr/bin/env python
 
 import argparse
+import ipaddress
+import sys
 import yaml
-from tgtconfig import ConfigAgent, ConfigItem
+import fleet
+from tgtconfig import (FACTS_TTL, ConfigAgent, ConfigItem, Journal, fact_names, gather_facts,
+                       preflight_check, query_status, setup_affinity, status_report)
+
+# seconds a client waits for the namespaces of all subsystems once they
+# are connected.
+CONNECT_TIMEOUT = 60
 
 class NvmetPort:
     def __init__(self, cfg):
@@ -28,6 +36,21 @@ class NvmetPort:
     def del_subsys(self, agent, nqn):
         agent.execute('nvmet_port_del_subsys', self.portid, nqn)
 
+    def preflight(self, agent, records):
+        """
+        the target listens on traddr, and a client connects from its
+        address in the /24 of traddr.
+        """
+        addrs = fact_names(records, 'ipaddr')
+        if agent.mode != 'client':
+            if self.traddr not in addrs:
+                return [f'{agent.mgmtip}: no address {self.traddr} for port {self.portid}']
+            return []
+        network = ipaddress.ip_network(f'{self.traddr}/24', strict=False)
+        if not any(ipaddress.ip_address(addr) in network for addr in addrs):
+            return [f'{agent.mgmtip}: no address in {network} to connect port {self.portid}']
+        return []
+
 
 class NvmetNamespace:
     def __init__(self, nqn, nsid):
@@ -43,6 +66,11 @@ class NvmetNamespace:
             return f"/dev/md/{subsysid}"
         raise ValueError(f'invalid nsid: {self.nsid}')
 
+    @property
+    def clientpath(self):
+        # the link of the connected namespace, see 60-persistent-storage-nvme.rules.
+        return f"/dev/disk/nvme/{self.nqn}-n{self.nsid}"
+
     def create(self, agent):
         agent.execute('nvmet_namespace_create', self.nqn, self.nsid, self.devpath)
 
@@ -64,6 +92,38 @@ class NvmetSubsys:
     def destroy(self, agent):
         agent.execute('nvmet_subsys_destroy', self.nqn)
 
+    def status(self, agent, records, ports):
+        """
+        on a target host, the namespaces should be enabled and exported
+        on all ports; on a client host, connected through all ports.
+        """
+        row = {'host': agent.mgmtip, 'component': f'subsys {self.nqn}',
+               'state': 'healthy', 'detail': ''}
+        if agent.mode == 'client':
+            row['component'] = f'connect {self.nqn}'
+            states = [r['state'] for r in records
+                      if r['kind'] == 'nvme_ctrl' and r['name'] == self.nqn]
+            live = states.count('live')
+            if not states:
+                row.update(state='missing', detail='not connected')
+            elif live < len(ports):
+                row.update(state='degraded', detail=f'{live}/{len(ports)} paths live')
+            return row
+
+        nsids = {r['nsid']: r['enabled'] for r in records
+                 if r['kind'] == 'nvmet_ns' and r['name'] == self.nqn}
+        portids = {r['name'] for r in records
+                   if r['kind'] == 'nvmet_port' and r['nqn'] == self.nqn}
+        missing_ports = [str(port.portid) for port in ports if str(port.portid) not in portids]
+        disabled = [str(ns.nsid) for ns in self.namespaces if not nsids.get(int(ns.nsid))]
+        if not nsids:
+            row.update(state='missing', detail='no subsystem')
+        elif disabled:
+            row.update(state='degraded', detail=f"namespaces {','.join(disabled)} disabled")
+        elif missing_ports:
+            row.update(state='degraded', detail=f"not on ports {','.join(missing_ports)}")
+        return row
+
 
 class NvmetTarget:
     def __init__(self, cfg, hostid, ports):
@@ -94,6 +154,7 @@ class NvmetNode:
 
     def setup(self, cfg):
         self.hostid = cfg.hostid
+        self.connect_timeout = cfg.connect_timeout or CONNECT_TIMEOUT
         self.ports = [NvmetPort(port) for port in cfg.ports]
         self.targets = [NvmetTarget(tgt, self.hostid, self.ports)
                         for tgt in cfg.targets]
@@ -103,6 +164,12 @@ class NvmetNode:
             port.create(agent)
         for tgt in self.targets:
             tgt.create(agent)
+        # the client is done when the namespaces are usable, not when
+        # the connects return.
+        if agent.mode == 'client':
+            agent.execute('nvme_wait_namespaces', self.connect_timeout,
+                          *[ns.clientpath for tgt in self.targets
+                            for subsys in tgt.subsyses for ns in subsys.namespaces])
 
     def destroy(self, agent):
         for tgt in self.targets[::-1]:
@@ -110,22 +177,91 @@ class NvmetNode:
         for port in self.ports:
             port.destroy(agent)
 
+    def status(self, facts):
+        return [subsys.status(agent, records, self.ports)
+                for agent, records in facts.items()
+                for tgt in self.targets for subsys in tgt.subsyses]
 
-def build(config):
+    def preflight(self, facts):
+        errors = []
+        for agent, records in facts.items():
+            for port in self.ports:
+                errors += port.preflight(agent, records)
+            if agent.mode == 'client':
+                continue
+            devices = fact_names(records, 'block', 'devlink')
+            errors += [f'{agent.mgmtip}: no device {ns.devpath} for {subsys.nqn}'
+                       for tgt in self.targets for subsys in tgt.subsyses
+                       for ns in subsys.namespaces if ns.devpath not in devices]
+        return errors
+
+    def destroy_bulk(self, agent):
+        nqns = [subsys.nqn for tgt in self.targets for subsys in tgt.subsyses]
+        agent.execute('nvmet_disconnect_all', *nqns)
+        agent.execute('nvmet_clear')
+        for port in self.ports:
+            port.destroy(agent)
+
+
+def build(config, journal=None):
     topology = NvmetNode(config)
-    agents = ConfigAgent.from_config(config['agents'])
+    agents = ConfigAgent.from_config(config['agents'], journal)
     return agents, topology
 
 
+def preflight(agents, topology, ttl):
+    preflight_check(topology.preflight(gather_facts(agents, ttl)))
+
+
 def create(agents, topology):
     for agent in agents:
         topology.create(agent)
         agent.execute('nvmet_saveconfig')
 
 
-def destroy(agents, topology):
+def destroy(agents, topology, bulk=False):
     for agent in agents[::-1]:
-        topology.destroy(agent)
+        if bulk:
+            topology.destroy_bulk(agent)
+        else:
+            topology.destroy(agent)
+
+
+def status(agents, topology, report):
+    rows = topology.status(query_status(agents))
+    if not status_report(rows, report):
+        sys.exit(1)
+
+
+def affinity(agents, topology):
+    # the backing disks of all namespaces and the nics of all ports.
+    items = [ns.devpath for tgt in topology.targets for subsys in tgt.subsyses
+             for ns in subsys.namespaces]
+    setup_affinity(agents, items + [port.traddr for port in topology.ports])
+
+
+FLEET_OPERATIONS = ('create', 'destroy', 'status')
+
+
+def deploy_fleet(config, journal, args):
+    """
+    run the operation on every node of a fleet config, see fleet.py.
+    """
+    def create_node(agent, topology):
+        topology.create(agent)
+        agent.execute('nvmet_saveconfig')
+
+    nodes = fleet.build(config, 'nvmet', NvmetNode, journal)
+    if args.operation == 'create':
+        fleet.preflight(nodes, args.facts_ttl)
+        fleet.deploy(nodes, create_node)
+    elif args.operation == 'destroy' and args.bulk:
+        fleet.deploy(nodes, lambda agent, topology: topology.destroy_bulk(agent), reverse=True)
+    elif args.operation == 'destroy':
+        fleet.deploy(nodes, lambda agent, topology: topology.destroy(agent), reverse=True)
+    elif args.operation == 'status':
+        if not status_report(fleet.status(nodes), args.report):
+            sys.exit(1)
 
 
 def main():
@@ -133,18 +269,40 @@ def main():
     parser = argparse.ArgumentParser(description="nvme target configuration script")
     parser.add_argument('-c', '--config', type=str, required=True,
                         help="Path to the config file")
-    parser.add_argument(dest='operation', choices=['create', 'destroy'],
+    parser.add_argument(dest='operation', choices=['create', 'destroy', 'status', 'affinity'],
                         help="create/destroy nvmet deployment")
+    parser.add_argument('--bulk', action='store_true',
+                        help="destroy all subsystems and ports at once")
+    parser.add_argument('--report', type=str,
+                        help="path of the json report written by status")
+    parser.add_argument('--resume', action='store_true',
+                        help="skip the ops completed by the last run of the same config")
+    parser.add_argument('--facts-ttl', type=int, default=FACTS_TTL,
+                        help="seconds the cached host facts are used, 0 to gather them again")
     args = parser.parse_args()
     config_file = args.config
 
     with open(config_file, 'r') as f:
         config = yaml.safe_load(f)
-        agents, topology = build(config)
+
+    with Journal.from_config(config, 'nvmet', args.operation, args.resume) as journal:
+        if 'fleet' in config:
+            if args.operation not in FLEET_OPERATIONS:
+                parser.error(f'{args.operation} is not supported for a fleet')
+            deploy_fleet(config, journal, args)
+            return
+
+        agents, topology = build(config, journal)
+        if args.operation == 'create':
+            preflight(agents, topology, args.facts_ttl)
         if args.operation == 'create':
             create(agents, topology)
         if args.operation == 'destroy':
-            destroy(agents, topology)
+            destroy(agents, topology, args.bulk)
+        if args.operation == 'status':
+            status(agents, topology, args.report)
+        if args.operation == 'affinity':
+            affinity(agents, topology)
 
 
 if __name__ == "__main__":
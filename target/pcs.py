@@ -1,8 +1,51 @@
 #!/usr/bin/env python
 
 import argparse
+import json
+import time
 import yaml
-from tgtconfig import ConfigAgent, ConfigItem
+from concurrent.futures import ThreadPoolExecutor
+from xml.etree import ElementTree
+from tgtconfig import ConfigAgent, ConfigItem, Journal, setup_affinity
+
+PROBE_LEAD = 2      # seconds the client probes run before a group is moved
+
+# the resource params naming the nics and disks of the cluster hosts.
+DEVICE_PARAMS = ('nic', 'backing_path', 'device')
+
+# presets of resource ops and meta attributes that shorten failover. The
+# nvmeof hosts reconnect within seconds (ctrl-loss-tmo), so failures are
+# detected fast and a failed resource moves at once; iscsi initiators
+# wait longer for a portal and the target needs more time to log out its
+# sessions when stopped. The stickiness of the resources of a group adds
+# up beyond the gap of its location scores, so a group does not fail back
+# by itself once its primary returns.
+PROFILES = {
+    'nvmeof': {
+        'ops': {
+            'monitor': {'interval': '5s', 'timeout': '15s', 'on-fail': 'restart'},
+            'start': {'timeout': '30s'},
+            'stop': {'timeout': '30s'},
+        },
+        'meta': {'migration-threshold': 1, 'resource-stickiness': 100, 'failure-timeout': '60s'},
+    },
+    'iscsi': {
+        'ops': {
+            'monitor': {'interval': '10s', 'timeout': '20s', 'on-fail': 'restart'},
+            'start': {'timeout': '60s'},
+            'stop': {'timeout': '60s'},
+        },
+        'meta': {'migration-threshold': 1, 'resource-stickiness': 100, 'failure-timeout': '120s'},
+    },
+}
+
+
+def profile(name):
+    if name is None:
+        return {}
+    if name not in PROFILES:
+        raise ValueError(f'unknown profile {name}')
+    return PROFILES[name]
 
 
 class PcsHost:
@@ -34,11 +77,11 @@ class PcsStonith:
     def set_primary(self):
         self.isprimary = True
 
-    def create(self, agent):
-        if self.isprimary:
+    def create(self, agent, delay_base=2, delay_max=3):
+        if self.isprimary and delay_max:
             # it is the primary node and the backup one
             # is told to delay when carrying on stonith.
-            delay = 'pcmk_delay_base=2 pcmk_delay_max=3'
+            delay = f'pcmk_delay_base={delay_base} pcmk_delay_max={delay_max}'
         else:
             delay = ''
         agent.execute('pcs_stonith_create',
@@ -58,9 +101,30 @@ class PcsResource:
         self.name = cfg.name
         self.ra = cfg.ra
         self.params = [f'{k}={v}' for k, v in cfg.params.items()]
+        self.devices = [v for k, v in cfg.params.items() if k in DEVICE_PARAMS]
+        self.ops = dict(cfg.ops or {})
+        self.meta = dict(cfg.meta or {})
+
+    def set_defaults(self, ops, meta):
+        """
+        fill the op attributes and meta attributes not set by the
+        resource itself.
+        """
+        for opname, attrs in ops.items():
+            self.ops[opname] = {**attrs, **self.ops.get(opname, {})}
+        self.meta = {**meta, **self.meta}
+
+    @property
+    def opargs(self):
+        args = []
+        for opname, attrs in self.ops.items():
+            args += ['op', opname] + [f'{k}={v}' for k, v in attrs.items()]
+        if self.meta:
+            args += ['meta'] + [f'{k}={v}' for k, v in self.meta.items()]
+        return args
 
     def create(self, agent):
-        agent.execute('pcs_resource_create', self.name, self.ra, *self.params)
+        agent.execute('pcs_resource_create', self.name, self.ra, *self.params, *self.opargs)
 
 
 class PcsGroup:
@@ -70,6 +134,10 @@ class PcsGroup:
         self.locations = cfg.locations
         self.predecessor = cfg.predecessor
         self.resources = cfg.resources
+        self.probe = cfg.probe
+        self.profile = cfg.profile
+        self.ops = cfg.ops or {}
+        self.meta = cfg.meta or {}
 
     def create(self, agent):
         if self.locations:
@@ -81,6 +149,40 @@ class PcsGroup:
             agent.execute('pcs_resgroup_create_ordered', self.name,
                           self.predecessor, *self.resources)
 
+    def move(self, agent, probes, node, window, timeout, followers, back=False):
+        """
+        move the group to node, or back to its preferred location, while
+        the probes read through it on the clients, and time the move
+        until the group and the groups following it are started. The
+        stickiness keeps the group off its preferred location, so it is
+        moved back too, and the constraint of the moves cleared after.
+        """
+        resources = self.resources + [res for grp in followers for res in grp.resources]
+        probes = probes if self.probe else []
+        with ThreadPoolExecutor(max_workers=len(probes) + 1) as executor:
+            futures = [executor.submit(probe.query, 'pcs_failover_probe', self.probe, window)
+                       for probe in probes]
+            time.sleep(PROBE_LEAD if probes else 0)
+            start = time.monotonic()
+            agent.execute('pcs_resource_move', self.name, node)
+            for grp in [self] + followers:
+                agent.query('pcs_resource_wait', grp.resources[-1], node, timeout)
+            elapsed = time.monotonic() - start
+        if back:
+            agent.execute('pcs_resource_clear', self.name)
+        return {'to': node,
+                'seconds': round(elapsed, 3),
+                'ops': op_history(agent, resources),
+                'probes': [json.loads(line) for future in futures
+                           for line in future.result().splitlines() if line.startswith('{')]}
+
+    def failover_test(self, agent, probes, window, timeout, followers):
+        primary, secondary = self.locations[:2]
+        return {'group': self.name,
+                'failover': self.move(agent, probes, secondary, window, timeout, followers),
+                'failback': self.move(agent, probes, primary, window, timeout, followers,
+                                      back=True)}
+
 
 class PcsCluster:
     def __init__(self, cfgdata):
@@ -91,6 +193,7 @@ class PcsCluster:
         self.resources = [PcsResource(res) for res in cfg.resources]
         self.groups = [PcsGroup(grp) for grp in cfg.groups]
         self.enable_stonith = True if cfg.stonith_enabled is None else cfg.stonith_enabled
+        self.stonith_delay = cfg.stonith_delay or {}
         print(f'stonith enable = {self.enable_stonith}, {cfg.stonith_enabled}')
 
         if len(self.stoniths) == 2:
@@ -99,6 +202,18 @@ class PcsCluster:
             # doing stonith.
             self.stoniths[0].set_primary()
 
+        # the resource settings override those of its group, which
+        # override the profile of the group or else of the cluster.
+        resources = {res.name: res for res in self.resources}
+        for grp in self.groups:
+            preset = profile(grp.profile or cfg.profile)
+            for res in filter(None, (resources.pop(name, None) for name in grp.resources)):
+                res.set_defaults(grp.ops, grp.meta)
+                res.set_defaults(preset.get('ops', {}), preset.get('meta', {}))
+        preset = profile(cfg.profile)
+        for res in resources.values():
+            res.set_defaults(preset.get('ops', {}), preset.get('meta', {}))
+
     def create(self, agent):
         for host in self.hosts:
             host.create(agent)
@@ -119,42 +234,107 @@ class PcsCluster:
             agent.execute('pcs_property_set', 'stonith-enabled=false')
             return
         for stonith in self.stoniths:
-            stonith.create(agent)
+            stonith.create(agent, self.stonith_delay.get('base', 2),
+                           self.stonith_delay.get('max', 3))
 
     def destroy(self, agent):
         agent.execute('pcs_cluster_destroy')
 
-
-def build(config):
+    def failover_test(self, agent, probes, window, timeout):
+        results = []
+        for grp in self.groups:
+            if not grp.locations:
+                continue
+            # the ordered groups follow their predecessor.
+            followers = [follower for follower in self.groups
+                         if follower.predecessor == grp.name]
+            results.append(grp.failover_test(agent, probes, window, timeout, followers))
+        return results
+
+
+def op_history(agent, resources):
+    """
+    the exec time in ms of the last stop and start of the resources on
+    each node, from the operation history of the cluster.
+    """
+    output = agent.query('pcs_op_history')
+    if not output:
+        return {}
+    ops = {}
+    for node in ElementTree.fromstring(output).iter('node'):
+        for history in node.iter('resource_history'):
+            if history.get('id') not in resources:
+                continue
+            resops = ops.setdefault(history.get('id'), {})
+            for op in history.iter('operation_history'):
+                task = op.get('task')
+                if task not in ('stop', 'start'):
+                    continue
+                exectime = int(op.get('exec-time', '0').rstrip('ms'))
+                resops.setdefault(f'{task}_ms', {})[node.get('name')] = exectime
+    return ops
+
+
+def build(config, journal=None):
     cluster = PcsCluster(config)
-    return ConfigAgent.from_config(config['agents']), cluster
+    return ConfigAgent.from_config(config['agents'], journal), cluster
 
 
 def create(agents, cluster):
     for agent in agents:
-        cluster.create(agent)
+        if agent.mode != 'client':
+            cluster.create(agent)
 
 
 def destroy(agents, cluster):
     for agent in agents:
-        cluster.destroy(agent)
+        if agent.mode != 'client':
+            cluster.destroy(agent)
+
+
+def affinity(agents, cluster):
+    setup_affinity(agents, [dev for res in cluster.resources for dev in res.devices])
+
+
+def failover_test(agents, cluster, window, timeout, report):
+    agent = next(agent for agent in agents if agent.mode != 'client')
+    probes = [agent for agent in agents if agent.mode == 'client']
+    results = cluster.failover_test(agent, probes, window, timeout)
+    if report:
+        with open(report, 'w') as f:
+            json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
 
 
 def main():
     parser = argparse.ArgumentParser(description="iscsi target configuration script")
     parser.add_argument('-c', '--config', type=str, required=True, help="Path to the config file")
-    parser.add_argument(dest='operation', choices=['create', 'destroy'],
+    parser.add_argument(dest='operation', choices=['create', 'destroy', 'failover-test', 'affinity'],
                         help="create/destroy nvmet deployment")
+    parser.add_argument('--window', type=int, default=60,
+                        help="seconds the client probes run for each move of failover-test")
+    parser.add_argument('--timeout', type=int, default=120,
+                        help="max seconds a group takes to start on its new location")
+    parser.add_argument('--report', type=str,
+                        help="path of the json report written by failover-test")
+    parser.add_argument('--resume', action='store_true',
+                        help="skip the ops completed by the last run of the same config")
     args = parser.parse_args()
     config_file = args.config
 
     with open(config_file, 'r') as f:
         config = yaml.safe_load(f)
-        agents, cluster = build(config)
+
+    with Journal.from_config(config, 'pcs', args.operation, args.resume) as journal:
+        agents, cluster = build(config, journal)
         if args.operation == 'create':
             create(agents, cluster)
         if args.operation == 'destroy':
             destroy(agents, cluster)
+        if args.operation == 'failover-test':
+            failover_test(agents, cluster, args.window, args.timeout, args.report)
+        if args.operation == 'affinity':
+            affinity(agents, cluster)
 
 
 if __name__ == "__main__":
@@ -81,7 +81,7 @@ class PkgGroup:
     def uninstall(self, agent):
         remote_pkgs = []
         remote_pkgs.extend(self.noncopy_pkgs)
-        remote_pkgs.extend([os.path.basename(pkg).partition('-')[0] for pkg in self.copy_pkgs)]
+        remote_pkgs.extend([os.path.basename(pkg).partition('-')[0] for pkg in self.copy_pkgs])
         remote_pkgs.reverse()
         agent.execute('apt_remove', *remote_pkgs)
 
@@ -26,6 +26,23 @@ wait_device() {
 	udevadm settle --exit-if-exists $devpath
 }
 
+# run a function on each argument concurrently, fail if any of them fails.
+foreach_parallel() {
+	local func=$1
+	shift 1
+	local pids=()
+	local rc=0
+
+	for arg in $*; do
+		$func $arg &
+		pids+=( $! )
+	done
+	for pid in ${pids[@]}; do
+		wait $pid || rc=1
+	done
+	return $rc
+}
+
 apt_install() {
 	runcmd apt install -y $*
 }
@@ -34,6 +51,92 @@ apt_remove() {
 	runcmd apt remove -y $*
 }
 
+# the subsystems reported by a discovery controller, besides itself.
+nvme_discover_nqns() {
+	nvme discover $* 2>/dev/null |
+		awk '$1 == "subnqn:" && $2 !~ /discovery$/ { print $2 }'
+}
+
+nvme_connected() {
+	local nqn=$1
+	local traddr=$2
+	local ctldir
+
+	for ctldir in /sys/class/nvme/nvme*; do
+		[ -e $ctldir/subsysnqn ] || continue
+		if [ "$(cat $ctldir/subsysnqn)" = "$nqn" ] &&
+		   [[ "$(cat $ctldir/address)," == *traddr=$traddr,* ]]; then
+			return 0
+		fi
+	done
+	return 1
+}
+
+# connect all subsystems of a discovery entry at once, where connect-all
+# connects them one after the other. The options of the entry are the
+# ones of discovery.conf, --persistent only applies to the discovery.
+nvme_connect_entry() {
+	local opts=${*//--persistent/}
+	local traddr=$(echo $opts | grep -oE -- '--traddr=[^ ]+' | cut -d= -f2)
+	local nqn
+	local pids=()
+	local rc=0
+
+	for nqn in $(nvme_discover_nqns $opts); do
+		if nvme_connected $nqn $traddr; then
+			continue
+		fi
+		runcmd nvme connect --nqn=$nqn $opts &
+		pids+=( $! )
+	done
+	for pid in ${pids[@]}; do
+		wait $pid || rc=1
+	done
+	return $rc
+}
+
+# wait for the udev links of the namespaces for at most timeout seconds,
+# and report when each of them showed up or that it is missing.
+nvme_wait_namespaces() {
+	local timeout=$1
+	shift 1
+	local start=$(($(date +%s%N) / 1000000))
+	local now path missing
+	local -A arrival=()
+
+	if [ $debug -eq 1 ]; then
+		return
+	fi
+
+	while true; do
+		now=$(($(date +%s%N) / 1000000))
+		missing=0
+		for path in $*; do
+			if [ -z "${arrival[$path]}" ] && [ -e $path ]; then
+				arrival[$path]=$((now - start))
+			fi
+			[ -n "${arrival[$path]}" ] || missing=$((missing + 1))
+		done
+		if [ $missing -eq 0 ] || [ $((now - start)) -ge $((timeout * 1000)) ]; then
+			break
+		fi
+		# settle returns at once when no event is queued.
+		udevadm settle --timeout=1 || true
+		sleep 0.1
+	done
+
+	for path in $*; do
+		if [ -n "${arrival[$path]}" ]; then
+			echo "$path present ${arrival[$path]}ms"
+		else
+			echo "$path missing"
+		fi
+	done
+	if [ $missing -ne 0 ]; then
+		errexit "$missing of $# namespaces missing after ${timeout}s"
+	fi
+}
+
 nvmet_port_create() {
 	local portid=$1
 	local traddr=$2
@@ -66,7 +169,7 @@ nvmet_port_create() {
 		# when client side run to here, the target side has already
 		# created port and added all subsystems. It is possible to
 		# connect all here, instead of each nqn one by one.
-		runcmd nvme connect-all
+		nvme_connect_entry $entry
 		;;
 	esac
 }
@@ -195,6 +298,27 @@ nvmet_clear() {
 	esac
 }
 
+nvmet_disconnect_nqn() {
+	local nqn=$1
+
+	if [ -n "$(ls /sys/class/nvme-subsystem/*/subsysnqn 2>/dev/null |
+		   xargs -r grep -lx -- $nqn)" ]; then
+		runcmd nvme disconnect --nqn $nqn
+	fi
+}
+
+nvmet_disconnect_all() {
+	local nqns=( $* )
+
+	case $mode in
+	active)
+		;;
+	client)
+		foreach_parallel nvmet_disconnect_nqn ${nqns[@]}
+		;;
+	esac
+}
+
 iscsit_iqn_create() {
 	local iqn=$1
 
@@ -259,6 +383,20 @@ iscsit_portal_disconnect() {
 	set -e
 }
 
+iscsit_portal_disconnect_all() {
+	local pids=()
+
+	# arguments are triples of iqn, addr and port.
+	while [ ${#*} -gt 0 ]; do
+		iscsit_portal_disconnect $1 $2 $3 &
+		pids+=( $! )
+		shift 3
+	done
+	for pid in ${pids[@]}; do
+		wait $pid || true
+	done
+}
+
 iscsit_portal_destroy() {
 	local iqn=$1
 	local addr=$2
@@ -286,16 +424,36 @@ iscsit_acl_create() {
 	esac
 }
 
+iscsit_tpg_set() {
+	local iqn=$1
+	local group=$2		# attribute or parameter
+	shift 2
+
+	case $mode in
+	active)
+		runcmd targetcli /iscsi/$iqn/tpg1 set $group $*
+		;;
+	client)
+		;;
+	esac
+}
+
 iscsit_lun_create() {
 	local iqn=$1
 	local devid=$2
 	local devpath=$3
 	local lunid=$4
+	local backstore=${5:-block}
+	shift 5 || shift $#
 
 	case $mode in
 	active)
-		runcmd targetcli /backstores/block create $devid $devpath
-		runcmd targetcli /iscsi/$iqn/tpg1/luns create /backstores/block/$devid $lunid
+		runcmd targetcli /backstores/$backstore create $devid $devpath
+		# the backstore attributes, set before the lun is exported.
+		if [ $# -gt 0 ]; then
+			runcmd targetcli /backstores/$backstore/$devid set attribute $*
+		fi
+		runcmd targetcli /iscsi/$iqn/tpg1/luns create /backstores/$backstore/$devid $lunid
 		;;
 	client)
 		;;
@@ -307,6 +465,7 @@ iscsit_lun_destroy() {
 	local devid=$2
 	local devath=$3
 	local lunid=$4
+	local backstore=${5:-block}
 
 	if [ ! -e /sys/kernel/config/target/iscsi/$iqn ]; then
 		return 0
@@ -315,7 +474,17 @@ iscsit_lun_destroy() {
 	case $mode in
 	active)
 		runcmd targetcli /iscsi/$iqn/tpg1/luns delete $lunid
-		runcmd targetcli /backstores/block delete $devid
+		runcmd targetcli /backstores/$backstore delete $devid
+		;;
+	client)
+		;;
+	esac
+}
+
+iscsit_clear() {
+	case $mode in
+	active)
+		runcmd targetcli clearconfig confirm=True
 		;;
 	client)
 		;;
@@ -332,13 +501,77 @@ iscsit_saveconfig() {
 	esac
 }
 
-parted_label() {
+parted_size_mib() {
+	local size=$1
+
+	case $size in
+	*MiB)	echo ${size%MiB}			;;
+	*GiB)	echo $(( ${size%GiB} * 1024 ))		;;
+	*TiB)	echo $(( ${size%TiB} * 1024 * 1024 ))	;;
+	*)	echo ''					;;	# e.g. 100%, not checked
+	esac
+}
+
+parted_size_equal() {
+	local actual=${1%MiB}
+	local expected=$(parted_size_mib $2)
+
+	if [ -z "$expected" ]; then
+		return 0
+	fi
+	awk -v a=$actual -v e=$expected 'BEGIN { exit !(a - e < 1 && e - a < 1) }'
+}
+
+parted_match() {
 	local disk=$1
+	shift 1
+	local parts=( $* )
+	local table num start end size fs name flags
+	local pname pstart pend
+	local i=0
+
+	if ! parted -m -s $disk print 2>/dev/null | grep -q ':gpt:'; then
+		return 1
+	fi
+	table=$(parted -m -s $disk unit MiB print | grep -E '^[0-9]+:')
+	if [ $(echo "$table" | grep -c .) -ne ${#parts[@]} ]; then
+		return 1
+	fi
+
+	while IFS=: read -r num start end size fs name flags; do
+		IFS=: read -r pname pstart pend <<< "${parts[$i]}"
+		if [ "$name" != "$pname" ] ||
+		   ! parted_size_equal $start $pstart ||
+		   ! parted_size_equal $end $pend; then
+			return 1
+		fi
+		i=$((i + 1))
+	done <<< "$table"
+	return 0
+}
+
+parted_mktable() {
+	local disk=$1
+	shift 1
+	local parts=( $* )
+	local script name start end
+
+	wait_device $disk
 
 	case $mode in
 	active)
+		if parted_match $disk ${parts[@]}; then
+			echo "partition table of $disk is already as desired"
+			return 0
+		fi
+
+		script="mklabel gpt"
+		for part in ${parts[@]}; do
+			IFS=: read -r name start end <<< "$part"
+			script+=" mkpart $name $start $end"
+		done
 		runcmd wipefs -a $disk
-		runcmd parted -s $disk mklabel gpt
+		runcmd parted -s -a optimal $disk $script
 		;;
 	backup)
 		runcmd partprobe $disk
@@ -346,22 +579,28 @@ parted_label() {
 	esac
 }
 
-parted_mkpart() {
-	local disk=$1
-	local partname=$2
-	local partstart=$3
-	local partend=$4
+parted_wipe_all() {
+	local disks=( $* )
 
 	case $mode in
 	active)
-		runcmd parted -s $disk mkpart $partname $partstart $partend
+		# dropping the gpt removes all partitions of a disk at once.
+		foreach_parallel dev_wipe ${disks[@]}
 		;;
 	backup)
-		runcmd partprobe $disk
+		foreach_parallel parted_probe ${disks[@]}
 		;;
 	esac
 }
 
+parted_probe() {
+	local disk=$1
+
+	if [ -e $disk ]; then
+		runcmd partprobe $disk
+	fi
+}
+
 parted_rm() {
 	local disk=$1
 	local part=$2
@@ -402,6 +641,86 @@ mdraid_stop() {
 	fi
 }
 
+mdraid_sysdir() {
+	local volname=$1
+
+	echo /sys/block/$(basename $(realpath /dev/md/$volname))/md
+}
+
+# bound the sync speed of an array in KiB/s, 0 keeps the system limit.
+mdraid_throttle() {
+	local volname=$1
+	local speed_min=$2
+	local speed_max=$3
+	local sysdir
+
+	case $mode in
+	active)
+		sysdir=$(mdraid_sysdir $volname)
+		if [ $speed_min -ne 0 ]; then
+			runcmd "echo $speed_min > $sysdir/sync_speed_min"
+		fi
+		if [ $speed_max -ne 0 ]; then
+			runcmd "echo $speed_max > $sysdir/sync_speed_max"
+		fi
+		;;
+	backup)
+		;;
+	esac
+}
+
+mdraid_readd() {
+	local volname=$1
+	local partpath=$2
+	local speed_min=$3
+	local speed_max=$4
+
+	case $mode in
+	active)
+		wait_device $partpath
+		mdraid_throttle $volname $speed_min $speed_max
+		runcmd mdadm /dev/md/$volname --remove failed --remove detached
+		runcmd mdadm /dev/md/$volname --add $partpath
+		;;
+	backup)
+		;;
+	esac
+}
+
+# wait until the array is clean. The timeout runs while the sync makes
+# no progress, so a long rebuild takes its time, but an array left
+# degraded and idle, e.g. without a spare, fails.
+mdraid_wait() {
+	local volname=$1
+	local timeout=${2:-600}
+	local sysdir action completed deadline
+	local last=""
+
+	case $mode in
+	active)
+		sysdir=$(mdraid_sysdir $volname)
+		while true; do
+			action=$(cat $sysdir/sync_action)
+			completed=$(cat $sysdir/sync_completed)
+			if [ "$action" == "idle" ] && [ $(cat $sysdir/degraded) -eq 0 ]; then
+				break
+			fi
+			if [ "$action $completed" != "$last" ]; then
+				last="$action $completed"
+				deadline=$(($(date +%s) + timeout))
+			elif [ $(date +%s) -ge $deadline ]; then
+				errexit "$volname: $action $completed, no progress in ${timeout}s"
+			fi
+			echo "$volname: $action $completed at $(cat $sysdir/sync_speed)K/sec"
+			sleep 10
+		done
+		echo "$volname: clean"
+		;;
+	backup)
+		;;
+	esac
+}
+
 mdraid_create() {
 	local volname=$1
 	local level=$2
@@ -469,6 +788,38 @@ mdraid_destroy() {
 	esac
 }
 
+dev_wipe() {
+	local dev=$1
+
+	if [ ! -e $dev ]; then
+		return 0
+	fi
+	if mdadm --query $dev | grep -q -E 'device .* in .* array'; then
+		runcmd mdadm --zero-superblock $dev
+	fi
+	runcmd wipefs -a -q $dev
+}
+
+mdraid_stop_all() {
+	local volnames=( $* )
+
+	case $mode in
+	active|backup)
+		foreach_parallel mdraid_stop ${volnames[@]}
+		;;
+	esac
+}
+
+mdraid_wipe_all() {
+	local devices=( $* )
+
+	case $mode in
+	active)
+		foreach_parallel dev_wipe ${devices[@]}
+		;;
+	esac
+}
+
 mdraid_new_config() {
 	local tgtname=$1
 
@@ -500,11 +851,30 @@ lustre_nidopt() {
 lustre_mount() {
 	local mountdev=$1
 	local mountpoint=$2
+	local init_itable=${3:-0}
+	local options=
 
 	if [ ! -e $mountpoint ]; then
 		runcmd mkdir -p $mountpoint
 	fi
-	runcmd mount -t lustre $mountdev $mountpoint
+	# init_itable=n makes ext4lazyinit wait n times the zeroing time of
+	# a group before the next one, throttling it against client io.
+	if [ $init_itable -ne 0 ]; then
+		options="-o init_itable=$init_itable"
+	fi
+	runcmd mount -t lustre $options $mountdev $mountpoint
+}
+
+# the -E options of the ldiskfs targets. The inode tables are always
+# zeroed after mount by ext4lazyinit; the journal may be as well.
+ldiskfs_extopts() {
+	local lazy_journal_init=${1:-0}
+	local extopts="lazy_itable_init=1,nodiscard"
+
+	if [ $lazy_journal_init -ne 0 ]; then
+		extopts+=",lazy_journal_init=1"
+	fi
+	echo $extopts
 }
 
 lustre_umount() {
@@ -515,12 +885,34 @@ lustre_umount() {
 	fi
 }
 
+lustre_tgt_destroy_all() {
+	local lfsname=$1
+	shift 1
+	local tgtnames=( $* )
+	local mountpoints=()
+
+	case $mode in
+	active)
+		for tgtname in ${tgtnames[@]}; do
+			mountpoints+=( /var/lib/lustre/$lfsname/$tgtname )
+		done
+		foreach_parallel lustre_umount ${mountpoints[@]}
+		;;
+	esac
+
+	for tgtname in ${tgtnames[@]}; do
+		mdraid_del_config $tgtname
+	done
+}
+
 ldiskfs_mgt_create() {
 	local lfsname=$1
 	local tgtname=$2
 	local svcnids=$3
 	local mgsnids=$4
 	local dvol=$5
+	local lazy_journal_init=$7
+	local init_itable=$8
 
 	mdraid_new_config $tgtname
 
@@ -531,9 +923,9 @@ ldiskfs_mgt_create() {
 		runcmd "mkfs.lustre --mgs \
 			--fsname=$lfsname --reformat --backfstype=ldiskfs \
 			$opt_svcnids \
-			--mkfsoptions='-E lazy_itable_init=1,nodiscard' \
+			--mkfsoptions='-E $(ldiskfs_extopts $lazy_journal_init)' \
 			$dvol"
-		lustre_mount $dvol /var/lib/lustre/$lfsname/$tgtname
+		lustre_mount $dvol /var/lib/lustre/$lfsname/$tgtname $init_itable
 		;;
 	backup)
 		runcmd mkdir -p /var/lib/lustre/$lfsname/$tgtname
@@ -547,6 +939,8 @@ ldiskfs_mdt_create() {
 	local svcnids=$3
 	local mgsnids=$4
 	local dvol=$5
+	local lazy_journal_init=$7
+	local init_itable=$8
 
 	mdraid_new_config $tgtname
 
@@ -558,9 +952,9 @@ ldiskfs_mdt_create() {
 			--fsname=$lfsname --reformat --backfstype=ldiskfs \
 			$opt_svcnids \
 			$opt_mgsnids \
-			--mkfsoptions='-E lazy_itable_init=1,nodiscard' \
+			--mkfsoptions='-E $(ldiskfs_extopts $lazy_journal_init)' \
 			$dvol"
-		lustre_mount $dvol /var/lib/lustre/$lfsname/$tgtname
+		lustre_mount $dvol /var/lib/lustre/$lfsname/$tgtname $init_itable
 		;;
 	backup)
 		runcmd mkdir -p /var/lib/lustre/$lfsname/$tgtname
@@ -575,6 +969,8 @@ ldiskfs_ost_create_mdraid() {
 	local mgsnids=$4
 	local dvol=$5
 	local jvol=$6
+	local lazy_journal_init=$7
+	local init_itable=$8
 
 	mdraid_new_config $tgtname
 
@@ -583,7 +979,11 @@ ldiskfs_ost_create_mdraid() {
 		local opt_svcnids=$(lustre_nidopt '--servicenode' $svcnids)
 		local opt_mgsnids=$(lustre_nidopt '--mgsnode' $mgsnids)
 
-		runcmd mke2fs -O journal_dev -b 4096 $jvol
+		if [ ${lazy_journal_init:-0} -ne 0 ]; then
+			runcmd mke2fs -O journal_dev -b 4096 -E lazy_journal_init=1 $jvol
+		else
+			runcmd mke2fs -O journal_dev -b 4096 $jvol
+		fi
 
 		mddev=$(basename $(realpath $dvol))
 		chunk_size=$(cat /sys/block/$mddev/md/chunk_size)
@@ -592,11 +992,11 @@ ldiskfs_ost_create_mdraid() {
 			--fsname=$lfsname --reformat --backfstype=ldiskfs \
 			$opt_svcnids \
 			$opt_mgsnids \
-			--mkfsoptions='-E lazy_itable_init=1,nodiscard,stride=$stride,stripe_width=256 -J device=$jvol' \
+			--mkfsoptions='-E $(ldiskfs_extopts $lazy_journal_init),stride=$stride,stripe_width=256 -J device=$jvol' \
 			--mountfsoptions='journal_path=$jvol' \
 			$dvol"
 
-		lustre_mount $dvol /var/lib/lustre/$lfsname/$tgtname
+		lustre_mount $dvol /var/lib/lustre/$lfsname/$tgtname $init_itable
 		;;
 	backup)
 		runcmd mkdir -p /var/lib/lustre/$lfsname/$tgtname
@@ -611,6 +1011,8 @@ ldiskfs_ost_create_noraid() {
 	local svcnids=$3
 	local mgsnids=$4
 	local dvol=$5
+	local lazy_journal_init=$7
+	local init_itable=$8
 
 	case $mode in
 	active)
@@ -621,10 +1023,10 @@ ldiskfs_ost_create_noraid() {
 			--fsname=$lfsname --reformat --backfstype=ldiskfs \
 			$opt_svcnids \
 			$opt_mgsnids \
-			--mkfsoptions='-E lazy_itable_init=1,nodiscard' \
+			--mkfsoptions='-E $(ldiskfs_extopts $lazy_journal_init)' \
 			$dvol"
 
-		lustre_mount $dvol /var/lib/lustre/$lfsname/$tgtname
+		lustre_mount $dvol /var/lib/lustre/$lfsname/$tgtname $init_itable
 		;;
 	backup)
 		runcmd mkdir -p /var/lib/lustre/$lfsname/$tgtname
@@ -639,13 +1041,39 @@ ldiskfs_ost_create() {
 	local mgsnids=$4
 	local dvol=$5
 	local jvol=$6
+	local lazy_journal_init=${7:-0}
+	local init_itable=${8:-0}
 
 	case $dvol in
 	/dev/md/*)
-		ldiskfs_ost_create_mdraid $lfsname $tgtname $svcnids $mgsnids $dvol $jvol
+		ldiskfs_ost_create_mdraid $lfsname $tgtname $svcnids $mgsnids $dvol $jvol \
+			$lazy_journal_init $init_itable
 		;;
 	*)
-		ldiskfs_ost_create_noraid $lfsname $tgtname $svcnids $mgsnids $dvol
+		ldiskfs_ost_create_noraid $lfsname $tgtname $svcnids $mgsnids $dvol $jvol \
+			$lazy_journal_init $init_itable
+		;;
+	esac
+}
+
+# report the inode tables zeroed so far by ext4lazyinit, per target.
+ldiskfs_lazyinit_status() {
+	local tgtdevs=( $* )
+	local tgtname devpath groups zeroed
+
+	case $mode in
+	active)
+		for tgtdev in ${tgtdevs[@]}; do
+			tgtname=${tgtdev%%:*}
+			devpath=${tgtdev#*:}
+			if [ ! -e $devpath ]; then
+				continue
+			fi
+			read -r groups zeroed <<< $(dumpe2fs $devpath 2>/dev/null |
+				awk '/^Group / { n++; if (/ITABLE_ZEROED/) z++ } END { print n + 0, z + 0 }')
+			printf '{"target": "%s", "device": "%s", "groups": %d, "zeroed": %d}\n' \
+				$tgtname $devpath $groups $zeroed
+		done
 		;;
 	esac
 }
@@ -663,6 +1091,283 @@ ldiskfs_tgt_destroy() {
 	esac
 }
 
+ltgt_bench_health() {
+	local devpath=$1
+	local sysdir=/sys/block/$(basename $(realpath -m $devpath))/md
+	local chunk member start
+	local aligned=true
+
+	if [ ! -d $sysdir ]; then
+		echo "0 true"
+		return 0
+	fi
+
+	# every member should start on a chunk boundary of the array.
+	chunk=$(cat $sysdir/chunk_size)
+	for member in $sysdir/dev-*; do
+		member=${member##*/dev-}
+		start=$(cat /sys/class/block/$member/start 2>/dev/null || echo 0)
+		if [ $chunk -gt 0 ] && [ $((start * 512 % chunk)) -ne 0 ]; then
+			aligned=false
+		fi
+	done
+	echo "$(cat $sysdir/degraded) $aligned"
+}
+
+ltgt_bench_result() {
+	local tgtname=$1
+	local devpath=$2
+	local read_mbs=${3:-0}
+	local write_mbs=${4:-null}
+	local iops=${5:-null}
+	local degraded aligned
+
+	read -r degraded aligned <<< $(ltgt_bench_health $devpath)
+	printf '{"target": "%s", "device": "%s", "read_mbs": %s, "write_mbs": %s, ' \
+		$tgtname $devpath $read_mbs $write_mbs
+	printf '"iops": %s, "degraded": %s, "aligned": %s}\n' $iops $degraded $aligned
+}
+
+ltgt_bench_fio() {
+	local runtime=$1
+	shift 1
+	local tgtdevs=( $* )
+	local fioopts="--direct=1 --ioengine=libaio --runtime=$runtime"
+	local tgtname devpath read_mbs write_mbs iops
+
+	fioopts+=" --time_based --group_reporting --output-format=terse --numjobs=4"
+
+	case $mode in
+	active)
+		for tgtdev in ${tgtdevs[@]}; do
+			tgtname=${tgtdev%%:*}
+			devpath=${tgtdev#*:}
+			# the write pass overwrites the device, so it only runs
+			# before the ost is formatted.
+			write_mbs=null
+			if [ $debug -ne 0 ] || [ -z "$(blkid -p -o value -s TYPE $devpath)" ]; then
+				write_mbs=$(runcmd fio --name=seqwrite --filename=$devpath $fioopts \
+					    --rw=write --bs=1M --iodepth=32 | awk -F';' '{ print $48 / 1024 }')
+			else
+				echo "$devpath is formatted, skip the write pass" >&2
+			fi
+			read_mbs=$(runcmd fio --name=seqread --filename=$devpath --readonly $fioopts \
+				   --rw=read --bs=1M --iodepth=32 | awk -F';' '{ print $7 / 1024 }')
+			iops=$(runcmd fio --name=randread --filename=$devpath --readonly $fioopts \
+			       --rw=randread --bs=4k --iodepth=64 | awk -F';' '{ print $8 }')
+			ltgt_bench_result $tgtname $devpath "$read_mbs" "${write_mbs:-null}" "$iops"
+		done
+		;;
+	esac
+}
+
+# size is the MB written per ost, a plain integer for obdfilter-survey.
+ltgt_bench_survey() {
+	local lfsname=$1
+	local size=$2
+	shift 2
+	local tgtdevs=( $* )
+	local tgtname devpath obdname output read_mbs write_mbs
+
+	case $mode in
+	active)
+		for tgtdev in ${tgtdevs[@]}; do
+			tgtname=${tgtdev%%:*}
+			devpath=${tgtdev#*:}
+			obdname=$(printf "%s-OST%04x" $lfsname ${tgtname#ost})
+			output=$(runcmd "size=$size nobjlo=1 nobjhi=1 thrlo=16 thrhi=16" \
+				 "targets=$obdname obdfilter-survey" | grep '^ost' | tail -n 1)
+			write_mbs=$(echo "$output" | awk '{ for (i = 1; i < NF; i++) if ($i == "write") print $(i + 1) }')
+			read_mbs=$(echo "$output" | awk '{ for (i = 1; i < NF; i++) if ($i == "read") print $(i + 1) }')
+			ltgt_bench_result $tgtname $devpath "$read_mbs" "$write_mbs" null
+		done
+		;;
+	esac
+}
+
+# print the state of all storage components of the host, one json
+# record per line and component.
+tgt_status() {
+	local link sysdir cfgdir portdir subsys nsdir ctldir lundir
+
+	for link in /dev/md/*; do
+		[ -e $link ] || continue
+		sysdir=/sys/block/$(basename $(realpath $link))/md
+		printf '{"kind": "md", "name": "%s", "state": "%s", "degraded": %s, "action": "%s"}\n' \
+			${link##*/} $(cat $sysdir/array_state) $(cat $sysdir/degraded 2>/dev/null || echo 0) \
+			$(cat $sysdir/sync_action 2>/dev/null || echo none)
+	done
+
+	for link in $(findmnt -rn -t lustre -o TARGET); do
+		printf '{"kind": "mount", "name": "%s"}\n' $link
+	done
+
+	cfgdir=/sys/kernel/config/nvmet
+	for portdir in $cfgdir/ports/*; do
+		for subsys in $portdir/subsystems/*; do
+			[ -e $subsys ] || continue
+			printf '{"kind": "nvmet_port", "name": "%s", "nqn": "%s"}\n' \
+				${portdir##*/} ${subsys##*/}
+		done
+	done
+	for nsdir in $cfgdir/subsystems/*/namespaces/*; do
+		[ -e $nsdir ] || continue
+		subsys=${nsdir%/namespaces/*}
+		printf '{"kind": "nvmet_ns", "name": "%s", "nsid": %s, "enabled": %s}\n' \
+			${subsys##*/} ${nsdir##*/} $(cat $nsdir/enable)
+	done
+
+	for ctldir in /sys/class/nvme-fabrics/ctl/nvme*; do
+		[ -e $ctldir/subsysnqn ] || continue
+		printf '{"kind": "nvme_ctrl", "name": "%s", "state": "%s", "address": "%s"}\n' \
+			$(cat $ctldir/subsysnqn) $(cat $ctldir/state) $(cat $ctldir/address)
+	done
+
+	for lundir in /sys/kernel/config/target/iscsi/*/tpgt_*/lun/lun_*; do
+		[ -e $lundir ] || continue
+		printf '{"kind": "iscsi_lun", "name": "%s", "lun": %s}\n' \
+			$(echo $lundir | cut -d/ -f6) ${lundir##*_}
+	done
+}
+
+# the inventory of the host as json lines, one record per fact, checked
+# by the pre-flight of the config scripts.
+host_facts() {
+	local ctldir pcidir nic pci
+
+	printf '{"kind": "host", "name": "%s", "kernel": "%s", "machine": "%s"}\n' \
+		$(hostname) $(uname -r) $(uname -m)
+	if [ -e /proc/modules ]; then
+		awk '{ printf "{\"kind\": \"module\", \"name\": \"%s\"}\n", $1 }' /proc/modules
+	fi
+
+	lsblk -bnrpo NAME,SIZE,TYPE | awk '{
+		printf "{\"kind\": \"block\", \"name\": \"%s\", \"size\": %s, \"type\": \"%s\"}\n", $1, $2, $3 }'
+	# udev escapes odd characters of the link names as \xNN.
+	find /dev/disk /dev/md -type l -printf '%p %l\n' 2>/dev/null | awk '{
+		gsub(/\\/, "\\\\"); n = split($2, target, "/")
+		printf "{\"kind\": \"devlink\", \"name\": \"%s\", \"target\": \"%s\"}\n", $1, target[n] }'
+
+	for ctldir in /sys/class/nvme/nvme*; do
+		[ -e $ctldir/transport ] || continue
+		printf '{"kind": "nvme", "name": "%s", "transport": "%s", "address": "%s", "model": "%s", "serial": "%s"}\n' \
+			${ctldir##*/} $(cat $ctldir/transport) "$(cat $ctldir/address)" \
+			"$(xargs < $ctldir/model)" "$(xargs < $ctldir/serial)"
+	done
+
+	# storage and network controllers only. The uplink is the root port
+	# above the device, shared by all devices behind the same switch.
+	for pcidir in /sys/bus/pci/devices/*; do
+		case $(cat $pcidir/class) in
+		0x01*|0x02*)	;;
+		*)		continue	;;
+		esac
+		printf '{"kind": "pci", "name": "%s", "class": "%s", "numa": %s, "uplink": "%s"}\n' \
+			${pcidir##*/} $(cat $pcidir/class) $(cat $pcidir/numa_node) \
+			$(realpath $pcidir | grep -oE '[0-9a-f]{4}:[0-9a-f]{2}:[0-9a-f]{2}\.[0-7]' | head -1)
+	done
+
+	for nic in /sys/class/net/*; do
+		[ ${nic##*/} != lo ] || continue
+		pci=""
+		if [ -e $nic/device ]; then
+			pci=$(affinity_pci $nic/device)
+		fi
+		printf '{"kind": "nic", "name": "%s", "state": "%s", "pci": "%s"}\n' \
+			${nic##*/} $(cat $nic/operstate) "$pci"
+	done
+	ip -o -4 addr show | awk '{
+		split($4, addr, "/")
+		printf "{\"kind\": \"ipaddr\", \"name\": \"%s\", \"prefix\": %s, \"nic\": \"%s\"}\n", addr[1], addr[2], $2 }'
+}
+
+# the pci address of a sysfs device, nothing for virtual devices like
+# fabrics namespaces.
+affinity_pci() {
+	realpath $1 | grep -oE '[0-9a-f]{4}:[0-9a-f]{2}:[0-9a-f]{2}\.[0-7]' | tail -1
+}
+
+# print "pci kind" for an item of the config: a pci address, a device
+# path, an ip address or a nic name. Md and dm devices resolve to their
+# disks and bonds to their slaves, items absent on this host to nothing.
+affinity_item() {
+	local item=$1
+	local sysdir slave nic
+
+	case $item in
+	[0-9a-f][0-9a-f][0-9a-f][0-9a-f]:*)
+		item=${item%-n*}
+		[ -e /sys/bus/pci/devices/$item ] && echo "$item disk"
+		;;
+	/dev/*)
+		[ -e $item ] || return 0
+		sysdir=/sys/class/block/$(basename $(realpath $item))
+		[ -e $sysdir/partition ] && sysdir=$(dirname $(realpath $sysdir))
+		if [ -n "$(ls $sysdir/slaves 2>/dev/null)" ]; then
+			for slave in $sysdir/slaves/*; do
+				affinity_item /dev/${slave##*/}
+			done
+			return 0
+		fi
+		# a multipath nvme namespace hangs under its subsystem, the
+		# pci device is that of its controllers.
+		for slave in $(realpath $sysdir) $(realpath $sysdir/../nvme[0-9]* 2>/dev/null); do
+			slave=$(affinity_pci $slave)
+			[ -n "$slave" ] && echo "$slave disk"
+		done
+		;;
+	*)
+		nic=$item
+		if [[ $item =~ ^[0-9.]+$ ]]; then
+			nic=$(ip -o addr show to $item | awk '{ print $2 }' | head -1)
+		fi
+		[ -n "$nic" ] && [ -e /sys/class/net/$nic ] || return 0
+		if [ -e /sys/class/net/$nic/bonding/slaves ]; then
+			for slave in $(cat /sys/class/net/$nic/bonding/slaves); do
+				affinity_item $slave
+			done
+			return 0
+		fi
+		slave=$(affinity_pci /sys/class/net/$nic)
+		[ -n "$slave" ] && echo "$slave nic"
+		;;
+	esac
+	return 0
+}
+
+irq_affinity_setup() {
+	local lnet=$1
+	shift 1
+	local libdir item
+
+	for libdir in /lib/lustre /lib/lvm; do
+		[ -x $libdir/irq_affinity.sh ] && break
+	done
+	[ -x $libdir/irq_affinity.sh ] || errexit "irq_affinity.sh not installed"
+
+	for item in $*; do
+		affinity_item $item
+	done | sort -u > /tmp/irq-affinity.conf
+	[ -s /tmp/irq-affinity.conf ] || errexit "no local device in $*"
+	runcmd "(echo '# pci kind, written by tgtagent.sh'; cat /tmp/irq-affinity.conf) > /etc/irq-affinity.conf"
+
+	# irqbalance must not move the pinned interrupts back.
+	runcmd "mkdir -p /etc/systemd/system/irqbalance.service.d"
+	runcmd "printf '[Service]\nEnvironment=IRQBALANCE_ARGS=--policyscript=$libdir/irq_affinity.sh\n' \
+		> /etc/systemd/system/irqbalance.service.d/irq-affinity.conf"
+	runcmd "systemctl daemon-reload"
+	runcmd "systemctl try-restart irqbalance.service"
+
+	# one lnet cpu partition per numa node, lnet binds each ni to the
+	# partition of its nic. It applies on the next load of libcfs.
+	if [ $lnet -eq 1 ] && ! grep -qs cpu_pattern /etc/modprobe.d/*.conf; then
+		runcmd "echo 'options libcfs cpu_pattern=\"N\"' > /etc/modprobe.d/lustre-cpt.conf"
+	fi
+
+	runcmd "systemctl enable irq-affinity.service"
+	runcmd "$libdir/irq_affinity.sh apply"
+}
+
 zpool_create() {
 	local pool=$1
 	shift 1
@@ -825,31 +1530,133 @@ pcs_property_set() {
 	runcmd pcs property set ${kvs[@]}
 }
 
+pcs_resource_move() {
+	local name=$1
+	local node=$2
+
+	runcmd pcs resource move $name $node
+}
+
+pcs_resource_clear() {
+	local name=$1
+
+	runcmd pcs resource clear $name
+}
+
+# wait until the resource runs on the node, a group is started when its
+# last resource is.
+pcs_resource_wait() {
+	local name=$1
+	local node=$2
+	local timeout=$3
+	local deadline=$(( $(date +%s) + timeout ))
+
+	if [ $debug -eq 1 ]; then
+		return
+	fi
+	until crm_resource --locate -r $name 2>/dev/null | grep -q "running on: $node\$"; do
+		if [ $(date +%s) -ge $deadline ]; then
+			errexit "$name not running on $node after ${timeout}s"
+		fi
+		sleep 0.2
+	done
+}
+
+pcs_op_history() {
+	crm_mon -1 --output-as=xml --include=operations
+}
+
+# read a block of the path every 50ms during window seconds and report
+# the longest time without a completed read, i.e. the io stall. A read
+# on a lost path may block for good, so one taking more than 2s is
+# killed and counted as an error.
+pcs_failover_probe() {
+	local path=$1
+	local window=$2
+	local start=$(date +%s%3N)
+	local last=$start now=$start
+	local ios=0 errors=0 stall=0 stallstart=0
+
+	case $mode in
+	client)
+		while [ $(( now - start )) -lt $(( window * 1000 )) ]; do
+			if timeout -s KILL 2 dd if=$path of=/dev/null bs=4k count=1 iflag=direct 2>/dev/null; then
+				now=$(date +%s%3N)
+				ios=$(( ios + 1 ))
+				if [ $(( now - last )) -gt $stall ]; then
+					stall=$(( now - last ))
+					stallstart=$last
+				fi
+				last=$now
+				sleep 0.05
+			else
+				errors=$(( errors + 1 ))
+				sleep 0.1
+				now=$(date +%s%3N)
+			fi
+		done
+		# the io may still be stalled when the window ends.
+		if [ $(( now - last )) -gt $stall ]; then
+			stall=$(( now - last ))
+			stallstart=$last
+		fi
+		printf '{"host": "%s", "path": "%s", "ios": %d, "errors": %d, ' \
+			$(hostname) $path $ios $errors
+		printf '"stall_ms": %d, "stall_start": %d}\n' $stall $stallstart
+		;;
+	esac
+}
+
 lvm_do_vg_destroy() {
 	local vgname=$1
-	local volname=$2
+	shift 1
+	local devpath
 
-	mdraid_start $volname $volname
-	if [ $? -ne 0 ]; then
-		return 0
-	fi
+	for devpath in $*; do
+		if [[ $devpath == /dev/md/* ]]; then
+			mdraid_start ${devpath##*/} ${devpath##*/}
+			if [ $? -ne 0 ]; then
+				return 0
+			fi
+		fi
+	done
 
 	runcmd vgchange --lockstart $vgname
 	runcmd vgremove --force $vgname
 
-	runcmd wipefs -a /dev/md/$volname
-	mdraid_stop $volname
+	for devpath in $*; do
+		runcmd wipefs -a $devpath
+		if [[ $devpath == /dev/md/* ]]; then
+			mdraid_stop ${devpath##*/}
+		fi
+	done
 }
 
+# the pvs are given as devpath or devpath@host, a pv with a host is
+# tagged host_<host> so that the legs of raid1/raid10 lvs are placed on
+# different hosts, see lvm_lv_create.
 lvm_vg_create() {
 	local vgname=$1
-	local volname=$2
-
-	mdraid_new_config $volname
+	shift 1
+	local pvspec devpath
+	local devpaths=()
+
+	for pvspec in $*; do
+		devpath=${pvspec%@*}
+		devpaths+=( $devpath )
+		if [[ $devpath == /dev/md/* ]]; then
+			mdraid_new_config ${devpath##*/}
+		fi
+	done
 
 	case $mode in
 	active)
-		runcmd vgcreate --share --locktype sanlock $vgname /dev/md/$volname
+		runcmd vgcreate --share --locktype sanlock $vgname ${devpaths[@]}
+		for pvspec in $*; do
+			if [[ $pvspec == *@* ]]; then
+				runcmd pvchange --addtag host_${pvspec##*@} ${pvspec%@*}
+			fi
+		done
 		runcmd vgchange --lockstop $vgname
 		;;
 	esac
@@ -857,19 +1664,117 @@ lvm_vg_create() {
 
 lvm_vg_destroy() {
 	local vgname=$1
-	local volname=$2
+	shift 1
+	local devpath
 
 	case $mode in
 	active)
 		set +e
-		lvm_do_vg_destroy $vgname $volname
+		lvm_do_vg_destroy $vgname $*
 		set -e
 		;;
 	esac
 
-	mdraid_del_config $volname
+	for devpath in $*; do
+		if [[ $devpath == /dev/md/* ]]; then
+			mdraid_del_config ${devpath##*/}
+		fi
+	done
+}
+
+# the lvm stripe size matching a pv in K: the full stripe of an md array
+# or the optimal io size of a namespace, cut to a power of 2.
+lvm_stripe_kb() {
+	local sysdir=/sys/block/$(basename $(realpath $1))
+	local kb=$STRIPESIZE
+	local chunk disks layout copies pow
+
+	if [ -e $sysdir/md/chunk_size ]; then
+		chunk=$(( $(cat $sysdir/md/chunk_size) / 1024 ))
+		disks=$(cat $sysdir/md/raid_disks)
+		case $(cat $sysdir/md/level) in
+		raid0)	kb=$((chunk * disks))		;;
+		raid5)	kb=$((chunk * (disks - 1)))	;;
+		raid6)	kb=$((chunk * (disks - 2)))	;;
+		raid10)
+			layout=$(cat $sysdir/md/layout)
+			copies=$(((layout & 255) * ((layout >> 8) & 255)))
+			[ $copies -gt 0 ] && kb=$((chunk * disks / copies))
+			;;
+		esac
+	elif [ $(cat $sysdir/queue/optimal_io_size) -gt 0 ]; then
+		kb=$(( $(cat $sysdir/queue/optimal_io_size) / 1024 ))
+	fi
+
+	pow=4
+	while [ $((pow * 2)) -le $kb ]; do
+		pow=$((pow * 2))
+	done
+	echo $pow
 }
 
+# create the lvs of a vg in one lvm process, each given as
+# name:type:size:stripes:stripesize:activation. A stripesize of auto is
+# the smallest stripe of the pvs of the vg.
+lvm_lv_create() {
+	local vgname=$1
+	shift 1
+	local batch=/tmp/lvm-$vgname.batch
+	local spec name type size stripes stripesize activation pv opts
+	local autokb=0
+
+	[ "$mode" == "active" ] || return 0
+
+	runcmd vgchange --lockstart $vgname
+	for pv in $(pvs --noheadings -o pv_name --select vg_name=$vgname); do
+		stripesize=$(lvm_stripe_kb $pv)
+		if [ $autokb -eq 0 ] || [ $stripesize -lt $autokb ]; then
+			autokb=$stripesize
+		fi
+	done
+
+	> $batch
+	for spec in $*; do
+		IFS=: read name type size stripes stripesize activation <<< "$spec"
+		[ "$stripesize" == "auto" ] && stripesize=$autokb
+
+		opts="--type $type"
+		case $type in
+		raid1)		opts+=" -m 1"					;;
+		raid10)		opts+=" -m 1 -i $stripes -I ${stripesize}k"	;;
+		*)		opts+=" -i $stripes -I ${stripesize}k"		;;
+		esac
+		# the images of a mirrored lv on pvs of different host tags.
+		case $type in
+		raid1|raid10)
+			opts+=' --alloc cling_by_tags --config allocation/cling_tag_list=["@*"]'
+			;;
+		esac
+		if [[ $size == *%* ]]; then
+			opts+=" -l $size"
+		else
+			opts+=" -L $size"
+		fi
+		# created inactive, the hosts using an lv activate it in the
+		# mode given by its tag.
+		echo "lvcreate -y -an -Zn -Wn $opts --addtag activation_$activation -n $name $vgname" >> $batch
+	done
+	cat $batch
+
+	runcmd lvm $batch
+	runcmd vgchange --lockstop $vgname
+
+	for spec in $*; do
+		name=${spec%%:*}
+		if [ $debug -eq 0 ] && ! lvs $vgname/$name > /dev/null 2>&1; then
+			errexit "create lv $vgname/$name failed"
+		fi
+	done
+}
+
+# run one op, called with the mode, the op and its args. tgtagentd.py
+# sources the script once and runs each op through dispatch.
+dispatch() {
 mode=$1; shift
 oper=$1; shift
 case $oper in
@@ -886,6 +1791,8 @@ case $oper in
 'nvmet_namespace_create')	nvmet_namespace_create $*	;;
 'nvmet_saveconfig')		nvmet_saveconfig $*		;;
 'nvmet_clear')			nvmet_clear $*			;;
+'nvmet_disconnect_all')		nvmet_disconnect_all $*		;;
+'nvme_wait_namespaces')		nvme_wait_namespaces $*		;;
 
 # operations for iscsi target
 'iscsit_iqn_create')		iscsit_iqn_create $*		;;
@@ -894,23 +1801,38 @@ case $oper in
 'iscsit_portal_connect')	iscsit_portal_connect $*	;;
 'iscsit_portal_disconnect')	iscsit_portal_disconnect $*	;;
 'iscsit_portal_destroy')	iscsit_portal_destroy $*	;;
+'iscsit_portal_disconnect_all')	iscsit_portal_disconnect_all $*	;;
+'iscsit_clear')			iscsit_clear $*			;;
+'iscsit_tpg_set')		iscsit_tpg_set $*		;;
 'iscsit_acl_create')		iscsit_acl_create $*		;;
 'iscsit_lun_create')		iscsit_lun_create $*		;;
 'iscsit_lun_destroy')		iscsit_lun_destroy $*		;;
 'iscsit_saveconfig')		iscsit_saveconfig $*		;;
 
 # operations for target on ldiskfs
-'parted_label')			parted_label $*			;;
-'parted_mkpart')		parted_mkpart $*		;;
+'parted_mktable')		parted_mktable $*		;;
 'parted_rm')			parted_rm $*			;;
+'parted_wipe_all')		parted_wipe_all $*		;;
 
 'mdraid_create')		mdraid_create $*		;;
 'mdraid_destroy')		mdraid_destroy $*		;;
+'mdraid_stop_all')		mdraid_stop_all $*		;;
+'mdraid_readd')			mdraid_readd $*			;;
+'mdraid_throttle')		mdraid_throttle $*		;;
+'mdraid_wait')			mdraid_wait $*			;;
+'mdraid_wipe_all')		mdraid_wipe_all $*		;;
 
 'ldiskfs_mgt_create') 		ldiskfs_mgt_create $*		;;
 'ldiskfs_mdt_create') 		ldiskfs_mdt_create $*		;;
 'ldiskfs_ost_create') 		ldiskfs_ost_create $*		;;
 'ldiskfs_tgt_destroy') 		ldiskfs_tgt_destroy $*		;;
+'ldiskfs_lazyinit_status')	ldiskfs_lazyinit_status $*	;;
+'ltgt_bench_fio')		ltgt_bench_fio $*		;;
+'ltgt_bench_survey')		ltgt_bench_survey $*		;;
+'tgt_status')			tgt_status $*			;;
+'host_facts')			host_facts $*			;;
+'irq_affinity_setup')		irq_affinity_setup $*		;;
+'lustre_tgt_destroy_all')	lustre_tgt_destroy_all $*	;;
 
 # operations for target on zfs
 'zpool_create')			zpool_create $*			;;
@@ -928,13 +1850,24 @@ case $oper in
 'pcs_resgroup_create_ordered') 	pcs_resgroup_create_ordered $* 	;;
 'pcs_stonith_create')		pcs_stonith_create $*		;;
 'pcs_property_set')		pcs_property_set $*		;;
+'pcs_resource_move')		pcs_resource_move $*		;;
+'pcs_resource_clear')		pcs_resource_clear $*		;;
+'pcs_resource_wait')		pcs_resource_wait $*		;;
+'pcs_op_history')		pcs_op_history $*		;;
+'pcs_failover_probe')		pcs_failover_probe $*		;;
 'pcs_cluster_setup')		pcs_cluster_setup $*		;;
 'pcs_cluster_destroy')		pcs_cluster_destroy $*		;;
 
 # operations for lvm
 'lvm_vg_create')		lvm_vg_create $*		;;
 'lvm_vg_destroy')		lvm_vg_destroy $*		;;
+'lvm_lv_create')		lvm_lv_create $*		;;
 
 'echo')			echo "$*"				;;	# for test
 *)			errexit "UNKNOWN OPERATION $oper"	;;
 esac
+}
+
+if [ "${BASH_SOURCE[0]}" = "$0" ]; then
+	dispatch $*
+fi
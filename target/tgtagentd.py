@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+
+# this file is the resident agent of a deployment run. ConfigAgent starts
+# it once per host over ssh; it reads one json op per line on stdin and
+# writes one json result per line on stdout, tagged with the op id. The
+# ops only reading sysfs or waiting on state are answered natively, the
+# others are run by workers that sourced tgtagent.sh once, each op in a
+# subshell of its worker as a per-op ssh would run the script. Ops run
+# concurrently, so the parallel callers of an agent still work. A long
+# op may send progress lines before its result.
+
+import glob
+import json
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+MAXOPS = 32
+
+# a worker reads one op per line, the files taking the output of the op
+# and the op as the shell gets it from ssh, and answers its exit code.
+# The op runs in a forked subshell, with errexit as in the script, so a
+# failed op does not end the worker.
+WORKER = '''
+source "$1"
+set +e
+while IFS=' ' read -r outfile errfile cmd; do
+	( set -e; eval "dispatch $cmd" ) > "$outfile" 2> "$errfile" < /dev/null
+	echo $?
+done
+'''
+
+
+def readfile(path):
+    with open(path, 'r') as f:
+        return f.read().strip()
+
+
+def readfile_raw(path):
+    with open(path, 'r') as f:
+        return f.read()
+
+
+def mdraid_sysdir(volname):
+    return f'/sys/block/{os.path.basename(os.path.realpath(f"/dev/md/{volname}"))}/md'
+
+
+def native_echo(mode, *args):
+    return ' '.join(args) + '\n'
+
+
+def native_mdraid_wait(mode, volname, timeout='600'):
+    # a generator, each line is sent as progress while the array syncs.
+    # The timeout runs while the sync makes no progress, see mdraid_wait.
+    if mode != 'active':
+        return
+    sysdir = mdraid_sysdir(volname)
+    last, deadline = None, None
+    while True:
+        action = readfile(f'{sysdir}/sync_action')
+        completed = readfile(f'{sysdir}/sync_completed')
+        if action == 'idle' and readfile(f'{sysdir}/degraded') == '0':
+            break
+        if (action, completed) != last:
+            last, deadline = (action, completed), time.monotonic() + int(timeout)
+        elif time.monotonic() >= deadline:
+            raise RuntimeError(f'{volname}: {action} {completed}, no progress in {timeout}s')
+        yield f'{volname}: {action} {completed} at {readfile(f"{sysdir}/sync_speed")}K/sec\n'
+        time.sleep(10)
+    yield f'{volname}: clean\n'
+
+
+def native_pcs_resource_wait(mode, name, node, timeout):
+    deadline = time.monotonic() + int(timeout)
+    while True:
+        result = subprocess.run(['crm_resource', '--locate', '-r', name],
+                                capture_output=True, text=True)
+        if any(line.endswith(f'running on: {node}') for line in result.stdout.splitlines()):
+            return ''
+        if time.monotonic() >= deadline:
+            raise RuntimeError(f'{name} not running on {node} after {timeout}s')
+        time.sleep(0.2)
+
+
+def readattr(path, default=''):
+    try:
+        return readfile(path)
+    except OSError:
+        return default
+
+
+def native_tgt_status(mode):
+    records = []
+    for link in sorted(glob.glob('/dev/md/*')):
+        sysdir = f'/sys/block/{os.path.basename(os.path.realpath(link))}/md'
+        records.append({'kind': 'md', 'name': os.path.basename(link),
+                        'state': readattr(f'{sysdir}/array_state'),
+                        'degraded': int(readattr(f'{sysdir}/degraded', '0')),
+                        'action': readattr(f'{sysdir}/sync_action', 'none')})
+
+    with open('/proc/mounts', 'r') as f:
+        for line in f:
+            _, mountpoint, fstype = line.split()[:3]
+            if fstype == 'lustre':
+                records.append({'kind': 'mount', 'name': mountpoint})
+
+    cfgdir = '/sys/kernel/config/nvmet'
+    for subsys in sorted(glob.glob(f'{cfgdir}/ports/*/subsystems/*')):
+        records.append({'kind': 'nvmet_port', 'name': subsys.split('/')[-3],
+                        'nqn': os.path.basename(subsys)})
+    for nsdir in sorted(glob.glob(f'{cfgdir}/subsystems/*/namespaces/*')):
+        records.append({'kind': 'nvmet_ns', 'name': nsdir.split('/')[-3],
+                        'nsid': int(os.path.basename(nsdir)),
+                        'enabled': int(readattr(f'{nsdir}/enable', '0'))})
+
+    for ctldir in sorted(glob.glob('/sys/class/nvme-fabrics/ctl/nvme*')):
+        if os.path.exists(f'{ctldir}/subsysnqn'):
+            records.append({'kind': 'nvme_ctrl', 'name': readattr(f'{ctldir}/subsysnqn'),
+                            'state': readattr(f'{ctldir}/state'),
+                            'address': readattr(f'{ctldir}/address')})
+
+    for lundir in sorted(glob.glob('/sys/kernel/config/target/iscsi/*/tpgt_*/lun/lun_*')):
+        records.append({'kind': 'iscsi_lun', 'name': lundir.split('/')[5],
+                        'lun': int(lundir.rpartition('_')[2])})
+    return ''.join(json.dumps(record) + '\n' for record in records)
+
+
+NATIVE = {
+    'echo':                 native_echo,
+    'tgt_status':           native_tgt_status,
+    'mdraid_wait':          native_mdraid_wait,
+    'pcs_resource_wait':    native_pcs_resource_wait,
+}
+
+
+class ScriptWorker:
+    def __init__(self, script):
+        self.proc = subprocess.Popen(['bash', '-c', WORKER, 'tgtagentd', script],
+                                     stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                     text=True, bufsize=1)
+        self.outfile = self.tempfile()
+        self.errfile = self.tempfile()
+
+    @staticmethod
+    def tempfile():
+        fd, path = tempfile.mkstemp(prefix='tgtagentd-')
+        os.close(fd)
+        return path
+
+    def run(self, mode, op, opargs):
+        self.proc.stdin.write(f'{self.outfile} {self.errfile} {mode} {op} {opargs}\n')
+        self.proc.stdin.flush()
+        line = self.proc.stdout.readline()
+        if not line:
+            raise RuntimeError('worker exited')
+        return int(line), readfile_raw(self.outfile), readfile_raw(self.errfile)
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.stdin.close()
+            self.proc.wait()
+        for path in (self.outfile, self.errfile):
+            os.unlink(path)
+
+
+class AgentDaemon:
+    def __init__(self, script):
+        self.script = script
+        self.lock = threading.Lock()
+        self.idle = []
+        self.workers = []
+
+    def reply(self, result):
+        line = json.dumps(result)
+        with self.lock:
+            sys.stdout.write(line + '\n')
+            sys.stdout.flush()
+
+    def run_script(self, mode, op, opargs):
+        # an idle worker runs the op, or a new one when all are busy.
+        with self.lock:
+            worker = self.idle.pop() if self.idle else None
+        if worker is None:
+            worker = ScriptWorker(self.script)
+            with self.lock:
+                self.workers.append(worker)
+        result = worker.run(mode, op, opargs)
+        with self.lock:
+            self.idle.append(worker)
+        return result
+
+    def handle(self, request):
+        start = time.monotonic()
+        rc, stdout, stderr = 1, '', ''
+        # whatever happens, the caller waiting for the id gets a result.
+        try:
+            mode, op, opargs = request['mode'], request['op'], request['args']
+            if op not in NATIVE:
+                rc, stdout, stderr = self.run_script(mode, op, opargs)
+            else:
+                output = NATIVE[op](mode, *shlex.split(opargs))
+                if not isinstance(output, str):
+                    for line in output:
+                        self.reply({'id': request['id'], 'progress': line})
+                    output = ''
+                rc, stdout = 0, output
+        except Exception as e:
+            rc, stderr = 1, stderr + f"{request.get('op')} failed: {e}\n"
+        finally:
+            self.reply({'id': request.get('id'), 'rc': rc, 'stdout': stdout, 'stderr': stderr,
+                        'ms': round((time.monotonic() - start) * 1000, 1)})
+
+    def serve(self):
+        # the run ends by closing stdin, pending ops are completed first.
+        with ThreadPoolExecutor(max_workers=MAXOPS) as executor:
+            for line in sys.stdin:
+                if not line.strip():
+                    continue
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    sys.stderr.write(f'invalid request: {line}')
+                    continue
+                executor.submit(self.handle, request)
+        for worker in self.workers:
+            worker.close()
+
+
+def main(argv):
+    script = argv[0] if argv else os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                               'tgtagent.sh')
+    AgentDaemon(script).serve()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
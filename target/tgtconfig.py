@@ -1,25 +1,364 @@
+import atexit
+import collections
+import contextlib
+import fcntl
+import hashlib
+import json
 import os
 import subprocess
 import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 
 debug = True
 
+# the heavy ops by concurrency class. The ops of a class are limited per
+# host, and each heavy op holds the disks it touches for its duration.
+# A raid op returns once the array is assembled, so the raid limit bounds
+# the creations only; the sync that follows is bounded by sync_speed_max
+# of the volume, see ltgt.py RaidVolume.
+OPCLASSES = {
+    'ldiskfs_mgt_create':   'mkfs',
+    'ldiskfs_mdt_create':   'mkfs',
+    'ldiskfs_ost_create':   'mkfs',
+    'zfs_tgt_create':       'mkfs',
+    'mdraid_create':        'raid',
+    'mdraid_readd':         'raid',
+    'zpool_create':         'raid',
+    'mdraid_wipe_all':      'wipe',
+    'parted_wipe_all':      'wipe',
+}
 
-def run(cmd: str):
-    print(f"=> {cmd}", flush=True)
+# default limits, overridden by the concurrency section of the config:
+# concurrent ops per class and host, concurrent heavy ops per disk.
+CONCURRENCY = {'mkfs': 2, 'raid': 4, 'wipe': 2, 'disk': 1}
+
+# host facts are cached per host, a later run within the ttl in seconds
+# reuses them instead of querying the hosts again.
+FACTS_DIR = os.path.expanduser('~/.cache/lustre-deploy/facts')
+FACTS_TTL = 600
+
+# the operations changing the hosts, the only ones journaled for --resume.
+JOURNALED_OPERATIONS = ('create', 'destroy', 'replace-disk')
+
+
+def run(cmd: str, capture=False):
+    print(f"=> {cmd}\n", end="", flush=True)
     if debug:
-        return
+        return '' if capture else None
     try:
-        subprocess.run(cmd, shell=True, check=True)
+        result = subprocess.run(cmd, shell=True, check=True,
+                                stdout=subprocess.PIPE if capture else None, text=True)
     except subprocess.CalledProcessError as e:
         print(f"Command failed: {e.cmd}\nExit code: {e.returncode}")
         sys.exit(e.returncode)
+    return result.stdout
+
+
+def parallel(func, items):
+    """
+    call func on each item concurrently and wait for all of them. The
+    first failure, including the exit of a failed command, is raised
+    again in the caller.
+    """
+    items = list(items)
+    if len(items) <= 1:
+        for item in items:
+            func(item)
+        return
+    with ThreadPoolExecutor(max_workers=len(items)) as executor:
+        futures = [executor.submit(func, item) for item in items]
+    for future in futures:
+        future.result()
+
+
+def query_status(agents):
+    """
+    collect the component records of all agents in one fan-out, keyed
+    by the agent.
+    """
+    facts = {agent: [] for agent in agents}
+
+    def query(agent):
+        output = agent.query('tgt_status')
+        facts[agent] = [json.loads(line) for line in output.splitlines()
+                        if line.startswith('{')]
+    parallel(query, agents)
+    return facts
+
+
+def gather_facts(agents, ttl=FACTS_TTL):
+    """
+    the inventory of all agents, keyed by the agent: block devices and
+    their links, nvme controllers, pci devices with their numa node,
+    nics and addresses, kernel and modules. The facts of a host are
+    cached locally for ttl seconds; the hosts without fresh facts are
+    queried in one fan-out.
+    """
+    facts = {}
+    now = time.time()
+    for agent in agents:
+        path = f'{FACTS_DIR}/{agent.mgmtip}.json'
+        if os.path.exists(path) and now - os.path.getmtime(path) < ttl:
+            with open(path, 'r') as f:
+                facts[agent] = json.load(f)
+
+    def query(agent):
+        output = agent.query('host_facts')
+        facts[agent] = [json.loads(line) for line in output.splitlines()
+                        if line.startswith('{')]
+        if debug:
+            return
+        os.makedirs(FACTS_DIR, exist_ok=True)
+        with open(f'{FACTS_DIR}/{agent.mgmtip}.json', 'w') as f:
+            json.dump(facts[agent], f)
+    parallel(query, [agent for agent in agents if agent not in facts])
+    return facts
+
+
+def fact_names(records, *kinds):
+    return {record['name'] for record in records if record['kind'] in kinds}
+
+
+def preflight_check(errors):
+    """
+    print what the config names but the hosts do not have, and exit
+    before any op runs if there is anything.
+    """
+    if debug:
+        print(f"=> debug skip pre-flight checks, {len(errors)} errors\n", end="", flush=True)
+        return
+    for error in errors:
+        print(f"pre-flight: {error}")
+    if errors:
+        sys.exit(1)
+
+
+def setup_affinity(agents, items, lnet=False):
+    """
+    pin the interrupts of the nics and nvme drives named by items to the
+    cpus of their numa node, on every target agent and across reboots.
+    Items are pci addresses, device paths, ip addresses or nic names;
+    each host skips the items it does not have.
+    """
+    items = list(dict.fromkeys(str(item) for item in items))
+    parallel(lambda agent: agent.execute('irq_affinity_setup', int(lnet), *items),
+             [agent for agent in agents if agent.mode != 'client'])
+
+
+def status_report(rows, report=None):
+    """
+    print one line per component with its host count per state and the
+    hosts not healthy, and write the rows as json to report. Each row is
+    a dict of host, component, state (healthy, degraded or missing) and
+    detail. Return whether all components are healthy.
+    """
+    if report:
+        with open(report, 'w') as f:
+            json.dump(rows, f, indent=2)
+
+    components = collections.OrderedDict()
+    for row in rows:
+        components.setdefault(row['component'], []).append(row)
+    print(f"{'component':<40} {'healthy':>8} {'degraded':>8} {'missing':>8}  hosts")
+    for component, crows in components.items():
+        counts = collections.Counter(row['state'] for row in crows)
+        bad = [f"{row['host']}({row['detail']})" if row['detail'] else row['host']
+               for row in crows if row['state'] != 'healthy']
+        print(f"{component:<40} {counts['healthy']:>8} {counts['degraded']:>8} "
+              f"{counts['missing']:>8}  {' '.join(bad[:8])}{' ...' if len(bad) > 8 else ''}")
+    return all(row['state'] == 'healthy' for row in rows)
+
+
+class Scheduler:
+    """
+    enforce the concurrency limits of the heavy ops on each host and
+    disk, so that parallel creation does not overload one node.
+    """
+    def __init__(self, limits=None):
+        self.limits = {**CONCURRENCY, **(limits or {})}
+        self.lock = threading.Lock()
+        self.semaphores = {}
+
+    def semaphore(self, key, limit):
+        with self.lock:
+            if key not in self.semaphores:
+                self.semaphores[key] = threading.BoundedSemaphore(limit)
+            return self.semaphores[key]
+
+    @contextlib.contextmanager
+    def slot(self, host, opname, disks=()):
+        opclass = OPCLASSES.get(opname)
+        if not opclass:
+            yield
+            return
+        keys = [(host, opclass, self.limits[opclass])]
+        keys += [(host, disk, self.limits['disk']) for disk in set(disks)]
+        # always acquired in the same order, so that two ops waiting for
+        # each other's slots can not deadlock.
+        semaphores = [self.semaphore(key[:2], key[2]) for key in sorted(keys)]
+        with contextlib.ExitStack() as stack:
+            for semaphore in semaphores:
+                stack.enter_context(semaphore)
+            yield
+
+
+class Journal:
+    """
+    local record of the ops completed by each agent. A journal belongs
+    to one script, config and operation, so a failed run can be resumed
+    and the ops already done are skipped. An op is recorded with the
+    mode of the agent, since a host may run the same op in several modes.
+    The journal is removed once the operation completes, and running an
+    operation removes the journal of the one it undoes, so a resumed
+    create never skips the ops of a config destroyed since. A run holds
+    the lock of its config until it is over, a second run of the same
+    config is refused rather than truncating the journal of the first.
+    """
+    journal_dir = os.path.expanduser('~/.cache/lustre-deploy')
+    undoes = {'create': 'destroy', 'destroy': 'create'}
+
+    def __init__(self, path, lockpath, resume=False, undone=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.done = collections.Counter()
+        self.seen = collections.Counter()
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lockfile = open(lockpath, 'a')
+        try:
+            fcntl.flock(self.lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.lockfile.close()
+            print(f"=> another run holds {lockpath}, retry once it is over\n",
+                  end="", flush=True)
+            sys.exit(1)
+
+        if undone and os.path.exists(undone):
+            os.remove(undone)
+        if resume and os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    entry = json.loads(line)
+                    self.done[(entry['agent'], entry.get('mode'), entry['op'])] += 1
+        else:
+            open(path, 'w').close()
+
+    def skip(self, agent, mode, op):
+        """
+        tell whether op is already done. The same op may be executed
+        more than once, so each occurrence is matched separately.
+        """
+        key = (agent, mode, op)
+        with self.lock:
+            self.seen[key] += 1
+            return self.seen[key] <= self.done[key]
+
+    def record(self, agent, mode, op):
+        line = json.dumps({'agent': agent, 'mode': mode, 'op': op}) + '\n'
+        with self.lock, open(self.path, 'a') as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def complete(self):
+        """
+        forget the journal once the operation is done, the next run of
+        the same config starts from scratch.
+        """
+        with self.lock:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # a failed run, including a sys.exit of a failed check, keeps the
+        # journal for --resume.
+        if exc_type is None:
+            self.complete()
+        self.lockfile.close()
+
+    @staticmethod
+    def from_config(config, kind, operation, resume=False):
+        """
+        the journal of a mutating operation of the kind of script, or a
+        null context giving no journal for the read-only operations.
+        """
+        if operation not in JOURNALED_OPERATIONS:
+            return contextlib.nullcontext()
+        data = json.dumps(config, sort_keys=True, default=str).encode()
+        digest = hashlib.sha256(data).hexdigest()[:16]
+        prefix = f'{Journal.journal_dir}/{kind}'
+        undone = Journal.undoes.get(operation)
+        return Journal(f'{prefix}-{operation}-{digest}.journal', f'{prefix}-{digest}.lock',
+                       resume, undone and f'{prefix}-{undone}-{digest}.journal')
+
+
+class AgentChannel:
+    """
+    one ssh session to the resident tgtagentd.py of a host, carrying all
+    ops of a run. Ops may be sent concurrently by several threads, each
+    waits for the result with its own id.
+    """
+    def __init__(self, mgmtip, daemon, script):
+        cmd = f'ssh root@{mgmtip} python3 {daemon} {script}'
+        print(f"=> {cmd}\n", end="", flush=True)
+        self.mgmtip = mgmtip
+        self.proc = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE, text=True, bufsize=1)
+        self.lock = threading.Lock()
+        self.lastid = 0
+        self.pending = {}
+        self.closed = False
+        threading.Thread(target=self.receive, daemon=True).start()
+        atexit.register(self.close)
+
+    def receive(self):
+        for line in self.proc.stdout:
+            result = json.loads(line)
+            if 'progress' in result:
+                # the output of a long op as it goes, its result follows.
+                sys.stdout.write(f"[{self.mgmtip}] {result['progress']}")
+                sys.stdout.flush()
+                continue
+            with self.lock:
+                future = self.pending.pop(result['id'], None)
+            if future:
+                future.set_result(result)
+        with self.lock:
+            self.closed = True
+            for future in self.pending.values():
+                future.set_exception(ConnectionError('agent session closed'))
+            self.pending.clear()
+
+    def call(self, mode, opname, opargs):
+        future = Future()
+        with self.lock:
+            if self.closed:
+                raise ConnectionError('agent session closed')
+            self.lastid += 1
+            self.pending[self.lastid] = future
+            self.proc.stdin.write(json.dumps({'id': self.lastid, 'mode': mode,
+                                              'op': opname, 'args': opargs}) + '\n')
+            self.proc.stdin.flush()
+        return future.result()
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.stdin.close()
+            self.proc.wait()
 
 
 class ConfigAgent:
-    def __init__(self, cfg):
+    def __init__(self, cfg, journal=None, scheduler=None):
         self.cfg = cfg
+        self.journal = journal
+        self.scheduler = scheduler or Scheduler()
         self.client_cmds = []
+        self.channel = None
 
     @property
     def mgmtip(self):
@@ -37,18 +376,67 @@ class ConfigAgent:
     def script(self):
         return self.cfg['script']
 
+    @property
+    def persistent(self):
+        return self.cfg.get('persistent', False)
+
+    @property
+    def daemon(self):
+        return os.path.join(os.path.dirname(self.script), 'tgtagentd.py')
+
     def workfile(self, origfile):
         return f'{self.workdir}/' + os.path.basename(origfile)
 
     def start(self):
         run(f'ssh root@{self.mgmtip} mkdir -p {self.workdir}')
         self.copy(self.script)
+        if self.persistent and not debug:
+            self.copy(self.daemon)
+            self.channel = AgentChannel(self.mgmtip, self.workfile(self.daemon),
+                                        self.workfile(self.script))
+
+    def remote(self, opname, opargs, capture=False):
+        """
+        run an op on the host, through the resident agent if it runs or
+        else by its own ssh.
+        """
+        if not self.channel:
+            script = self.workfile(self.script)
+            return run(f'ssh root@{self.mgmtip} {script} {self.mode} {opname} {opargs}',
+                       capture)
+        print(f"=> [{self.mgmtip}] {self.mode} {opname} {opargs}\n", end="", flush=True)
+        result = self.channel.call(self.mode, opname, opargs)
+        sys.stderr.write(result['stderr'])
+        if result['rc'] != 0:
+            print(f"Command failed: {opname} {opargs}\nExit code: {result['rc']}")
+            sys.exit(result['rc'])
+        if capture:
+            return result['stdout']
+        sys.stdout.write(result['stdout'])
+        sys.stdout.flush()
+
+    def execute(self, opname, *args, disks=()):
+        """
+        run an op on the host; a heavy op waits for a slot of its class
+        and for the disks it touches.
+        """
+        opargs = ' '.join(str(arg) for arg in args)
+        op = f'{opname} {opargs}'
+        if self.journal and self.journal.skip(self.mgmtip, self.mode, op):
+            print(f"=> done [{self.mgmtip}] {self.mode} {op}\n", end="", flush=True)
+            return
+        with self.scheduler.slot(self.mgmtip, opname, disks):
+            self.remote(opname, opargs)
+        if self.journal and not debug:
+            self.journal.record(self.mgmtip, self.mode, op)
 
-    def execute(self, opname, *args):
-        mode = self.mode
+    def query(self, opname, *args):
+        """
+        execute a read-only op and return its output. Queries are
+        never journaled.
+        """
         opargs = ' '.join(str(arg) for arg in args)
-        script = self.workfile(self.script)
-        run(f'ssh root@{self.mgmtip} {script} {mode} {opname} {opargs}')
+        return self.remote(opname, opargs, capture=True)
 
     def copy(self, *files):
         copyfiles = ' '.join(files)
@@ -56,8 +444,9 @@ class ConfigAgent:
         return [self.workfile(file) for file in files]
 
     @staticmethod
-    def from_config(configs):
-        agents = [ConfigAgent(cfg) for cfg in configs]
+    def from_config(configs, journal=None, concurrency=None):
+        scheduler = Scheduler(concurrency)
+        agents = [ConfigAgent(cfg, journal, scheduler) for cfg in configs]
         agents.sort(key=lambda a: a.mode)
         for agent in agents:
             agent.start()
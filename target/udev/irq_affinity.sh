@@ -0,0 +1,67 @@
+#!/bin/bash
+
+# this file pins the interrupts of the storage nics and nvme drives listed
+# in /etc/irq-affinity.conf to the cpus of their numa node. The file is
+# written by the irq_affinity_setup op of tgtagent.sh, one line of pci
+# address and kind (nic or disk) per device. It should be put in
+# directory /lib/lustre or /lib/lvm, and is run at boot by
+# irq-affinity.service and by irqbalance as its policy script.
+#
+#   irq_affinity.sh apply
+#   irq_affinity.sh policy <sysfs device path> <irq>
+
+CONF=/etc/irq-affinity.conf
+
+devices() {
+	[ -f $CONF ] && grep -v '^#' $CONF
+}
+
+apply() {
+	local pci kind devdir cpus irq pinned managed
+	local niccpus=
+
+	devices | while read pci kind; do
+		devdir=/sys/bus/pci/devices/$pci
+		[ -e $devdir ] || continue
+		cpus=$(cat $devdir/local_cpulist)
+		pinned=0; managed=0
+		for irq in $(ls $devdir/msi_irqs 2>/dev/null); do
+			# the queue interrupts of nvme are managed by the kernel,
+			# which already spreads them on the cpus of each queue.
+			if echo $cpus > /proc/irq/$irq/smp_affinity_list 2>/dev/null; then
+				pinned=$((pinned + 1))
+			else
+				managed=$((managed + 1))
+			fi
+		done
+		echo "$pci $kind node $(cat $devdir/numa_node) cpus $cpus: $pinned pinned, $managed managed"
+	done
+
+	# the iscsi target threads run on the cpus of the nics. nvmet-rdma and
+	# nvmet-tcp complete their queues on the cpu of the nic interrupt,
+	# so they follow the nic pinning above.
+	for pci in $(devices | awk '$2 == "nic" { print $1 }'); do
+		[ -e /sys/bus/pci/devices/$pci ] || continue
+		niccpus="${niccpus:+$niccpus,}$(cat /sys/bus/pci/devices/$pci/local_cpulist)"
+	done
+	if [ -n "$niccpus" ] && [ -e /sys/kernel/config/target/iscsi/cpus_allowed_list ]; then
+		echo $niccpus > /sys/kernel/config/target/iscsi/cpus_allowed_list
+		echo "iscsi target cpus $niccpus"
+	fi
+}
+
+# irqbalance asks for each interrupt, it must leave ours alone.
+policy() {
+	local pci=${1##*/}
+
+	if devices | awk '{ print $1 }' | grep -qx "$pci"; then
+		echo "ban=true"
+	fi
+}
+
+case $1 in
+'apply')	apply		;;
+'policy')	policy $2 $3	;;
+*)		echo "usage: $0 apply|policy <devpath> <irq>" >&2; exit 1 ;;
+esac
+exit 0
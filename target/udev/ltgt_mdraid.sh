@@ -8,7 +8,16 @@
 
 device=$1
 raidname=${2##*:}
-if [ ! -z "$raidname" ] && [ -e /dev/md/$raidname ]; then
-       	mdadm --add /dev/md/$raidname $device 
+if [ -z "$raidname" ] || [ ! -e /dev/md/$raidname ]; then
+	exit 0
 fi
+
+# queue the device in mdraid-hotadd.service if it runs, which adds all
+# returned members of an array in one batch.
+if [ -S /run/mdraid_hotadd.sock ] &&
+   /lib/lustre/mdraid_hotadd.py notify $device $raidname; then
+	exit 0
+fi
+
+mdadm --add /dev/md/$raidname $device
 exit 0
@@ -91,6 +91,12 @@ oper=$1; shift 1
 case $oper in
         add)
 		logger_info "add" "$*"
+		# hand the device over to lvm-restore.service if it runs,
+		# which restores a whole burst of devices at once.
+		if [ -S /run/lvm_restore.sock ] &&
+		   /opt/lvm/lvm_restored.py notify add $*; then
+			exit 0
+		fi
 		dev_add $*
                 ;;
         remove)
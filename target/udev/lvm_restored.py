@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+# this file is the restore service behind 99-dm-lvm-restore.rules. udev
+# only notifies it of returning nvme namespaces through lvm_restore.sh;
+# the service coalesces the events of a burst, scans lvm once and then
+# restores each affected vg in one batch. It should be put in directory
+# /opt/lvm and is started by lvm-restore.service.
+
+import os
+import socket
+import subprocess
+import sys
+import syslog
+import time
+
+SOCKPATH = '/run/lvm_restore.sock'
+QUIET = 2.0         # a burst ends when no event arrives for QUIET seconds
+MAXDELAY = 10.0     # or at the latest MAXDELAY seconds after it started
+
+
+def logger_info(msg):
+    syslog.syslog(syslog.LOG_INFO, msg)
+
+
+def runcmd(*cmd):
+    logger_info(' '.join(cmd))
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    if result.returncode != 0:
+        logger_info(f'command failed: {result.stderr.strip()}')
+    return result.stdout
+
+
+def lvm_rows(*cmd):
+    output = runcmd(*cmd, '--noheadings', '--separator', '|')
+    return [[field.strip() for field in line.split('|')]
+            for line in output.splitlines() if line.strip()]
+
+
+class VgRestore:
+    """
+    pending restore of one vg: the returned pvs and the time the first
+    of them was reported.
+    """
+    def __init__(self, name, since):
+        self.name = name
+        self.since = since
+        self.pvnames = set()
+
+    def missing_pvnames(self):
+        # pvs still marked missing though their device is back.
+        rows = lvm_rows('vgs', '-o', 'pv_name', self.name,
+                        '--select', 'pv_missing=missing&&pv_name!=[unknown]')
+        return {row[0] for row in rows}
+
+    def unknown_pvcnt(self):
+        rows = lvm_rows('vgs', '-o', 'pv_name', self.name)
+        return sum(1 for row in rows if 'unknown' in row[0])
+
+    def refresh_lvnames(self):
+        # the 5th attr character is state and the 6th is device, X
+        # means unknown. Sub lvs are refreshed through their top lv.
+        rows = lvm_rows('lvs', '-a', '-o', 'lv_name', self.name,
+                        '--select', 'lv_attr=~....XX.*')
+        return sorted({row[0].strip('[]').split('_')[0] for row in rows})
+
+    def restore(self):
+        """
+        return True when the vg is fully restored, False when it still
+        waits for some of its pvs.
+        """
+        # it is not possible to determine whether the missing device
+        # is an lvmlock device, so add the lock space first.
+        runcmd('vgchange', '--lockstart', self.name)
+        pvnames = sorted(self.pvnames | self.missing_pvnames())
+        if pvnames:
+            runcmd('vgextend', '--restoremissing', self.name, *pvnames)
+        self.pvnames.clear()
+
+        if self.unknown_pvcnt() != 0:
+            return False
+        lvnames = self.refresh_lvnames()
+        if lvnames:
+            runcmd('lvchange', '--refresh',
+                   *[f'{self.name}/{lvname}' for lvname in lvnames])
+        return True
+
+
+class RestoreService:
+    def __init__(self):
+        self.devnames = set()
+        self.burst_start = None
+        self.last_event = None
+        self.vgs = {}
+
+    def notify(self, devname):
+        now = time.monotonic()
+        if not self.devnames:
+            self.burst_start = now
+        self.devnames.add(devname)
+        self.last_event = now
+
+    def timeout(self):
+        if not self.devnames:
+            return None
+        now = time.monotonic()
+        deadline = min(self.last_event + QUIET, self.burst_start + MAXDELAY)
+        return max(deadline - now, 0.001)
+
+    def flush(self):
+        devnames, self.devnames = self.devnames, set()
+        logger_info(f'restore burst of {len(devnames)} devices')
+
+        # one scan for the whole burst instead of one per device.
+        for pvname, vgname in lvm_rows('pvs', '-o', 'pv_name,vg_name'):
+            if pvname not in devnames or not vgname:
+                continue
+            if vgname not in self.vgs:
+                self.vgs[vgname] = VgRestore(vgname, self.burst_start)
+            self.vgs[vgname].pvnames.add(pvname)
+
+        for vgname, vg in list(self.vgs.items()):
+            if not vg.pvnames:
+                continue
+            elapsed = time.monotonic() - vg.since
+            if vg.restore():
+                logger_info(f'vg {vgname} restored in {elapsed:.2f}s')
+                del self.vgs[vgname]
+            else:
+                logger_info(f'vg {vgname} waits for more pvs after {elapsed:.2f}s')
+
+    def serve(self):
+        if os.path.exists(SOCKPATH):
+            os.unlink(SOCKPATH)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(SOCKPATH)
+        logger_info(f'listening on {SOCKPATH}')
+
+        while True:
+            sock.settimeout(self.timeout())
+            try:
+                data = sock.recv(4096)
+            except socket.timeout:
+                self.flush()
+                continue
+            oper, _, devname = data.decode().partition(' ')
+            if oper == 'add' and devname:
+                self.notify(devname)
+
+
+def notify(oper, devname):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.sendto(f'{oper} {devname}'.encode(), SOCKPATH)
+
+
+def main(argv):
+    syslog.openlog('lvm_restore')
+    if argv and argv[0] == 'notify':
+        notify(*argv[1:3])
+        return
+    RestoreService().serve()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,39 @@
+#!/bin/bash
+
+# this file is used by the queue tuning rules generated by udevtune.py.
+# It prints the full stripe size of an md array in KB as MD_STRIPE_KB,
+# cut to the whole chunks the queue takes in one request. Nothing is
+# printed for arrays without stripes. It should be put in directory
+# /lib/lustre or /lib/lvm.
+
+[ $# -ne 1 ] && exit 1
+
+sysdir=/sys/block/$1
+[ -e $sysdir/md/chunk_size ] || exit 0
+
+level=$(cat $sysdir/md/level)
+chunk=$(( $(cat $sysdir/md/chunk_size) / 1024 ))
+disks=$(cat $sysdir/md/raid_disks)
+
+case $level in
+raid0)		data=$disks				;;
+raid4|raid5)	data=$((disks - 1))			;;
+raid6)		data=$((disks - 2))			;;
+raid10)
+	# near and far copies are the low two bytes of the layout.
+	layout=$(cat $sysdir/md/layout)
+	copies=$(((layout & 255) * ((layout >> 8) & 255)))
+	[ $copies -gt 0 ] || exit 0
+	data=$((disks / copies))
+	;;
+*)		exit 0					;;
+esac
+[ $chunk -gt 0 ] && [ $data -gt 0 ] || exit 0
+
+stripe=$((chunk * data))
+maxkb=$(cat $sysdir/queue/max_hw_sectors_kb)
+if [ $stripe -gt $maxkb ]; then
+	stripe=$((maxkb / chunk * chunk))
+fi
+[ $stripe -gt 0 ] && echo "MD_STRIPE_KB=$stripe"
+exit 0
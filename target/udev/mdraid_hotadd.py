@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+# this file is the hot-add service behind the md-raid-device rules. udev
+# only notifies it of returning array members through ltgt_mdraid.sh or
+# lvm_mdraid.sh; the service queues them per array, adds each queue in
+# one batch so that one recovery covers all of them, limits the rebuild
+# speed and reports the recovery progress. It should be put in directory
+# /lib/lustre or /lib/lvm and is started by mdraid-hotadd.service.
+
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import syslog
+import time
+
+SOCKPATH = '/run/mdraid_hotadd.sock'
+
+
+def logger_info(msg):
+    syslog.syslog(syslog.LOG_INFO, msg)
+
+
+def runcmd(*cmd):
+    logger_info(' '.join(cmd))
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    if result.returncode != 0:
+        logger_info(f'command failed: {result.stderr.strip()}')
+    return result.returncode
+
+
+class MdArray:
+    def __init__(self, name):
+        self.name = name
+        self.devices = set()
+        self.first_event = None
+        self.last_event = None
+        self.recovery_start = None
+        self.recovery_started = False
+        self.last_report = None
+
+    @property
+    def devpath(self):
+        return f'/dev/md/{self.name}'
+
+    @property
+    def sysdir(self):
+        kname = os.path.basename(os.path.realpath(self.devpath))
+        return f'/sys/block/{kname}/md'
+
+    def getattr(self, attr):
+        try:
+            with open(f'{self.sysdir}/{attr}', 'r') as f:
+                return f.read().strip()
+        except OSError:
+            return ''
+
+    def setattr(self, attr, value):
+        logger_info(f'set {self.name} {attr}={value}')
+        try:
+            with open(f'{self.sysdir}/{attr}', 'w') as f:
+                f.write(str(value))
+        except OSError as e:
+            logger_info(f'set {self.name} {attr} failed: {e}')
+
+    def is_member(self, device):
+        kname = os.path.basename(os.path.realpath(device))
+        return os.path.exists(f'{self.sysdir}/dev-{kname}')
+
+    def queue(self, device):
+        now = time.monotonic()
+        if not self.devices:
+            self.first_event = now
+        self.devices.add(device)
+        self.last_event = now
+
+    def deadline(self, quiet, maxdelay):
+        if not self.devices:
+            return None
+        return min(self.last_event + quiet, self.first_event + maxdelay)
+
+    def hotadd(self, speed_min, speed_max):
+        devices = sorted(dev for dev in self.devices if os.path.exists(dev))
+        self.devices.clear()
+        if not devices or not os.path.exists(self.devpath):
+            return
+
+        if speed_min:
+            self.setattr('sync_speed_min', speed_min)
+        if speed_max:
+            self.setattr('sync_speed_max', speed_max)
+
+        # freeze recovery while adding, so that all returned members
+        # are rebuilt by one recovery instead of one after another.
+        self.setattr('sync_action', 'frozen')
+        # re-add relies on the write-intent bitmap and only resyncs the
+        # regions written while the member was away.
+        if runcmd('mdadm', self.devpath, '--re-add', *devices) != 0:
+            devices = [dev for dev in devices if not self.is_member(dev)]
+            if devices:
+                runcmd('mdadm', self.devpath, '--add', *devices)
+        self.setattr('sync_action', 'idle')
+
+        self.recovery_start = self.last_report = time.monotonic()
+        self.recovery_started = False
+
+    def report(self, interval, start_timeout):
+        """
+        log the recovery progress every interval seconds and return
+        True once the recovery is over. The action is still idle right
+        after the members are added, so an idle array is only recovered
+        once it is no longer degraded; one whose recovery does not start
+        within start_timeout seconds is given up.
+        """
+        now = time.monotonic()
+        elapsed = now - self.recovery_start
+        action = self.getattr('sync_action')
+        if action not in ('idle', ''):
+            self.recovery_started = True
+        elif self.getattr('degraded') in ('0', ''):
+            logger_info(f'{self.name} recovered in {elapsed:.0f}s')
+            return True
+        elif self.recovery_started:
+            logger_info(f'{self.name} recovery ended after {elapsed:.0f}s, '
+                        f'still degraded={self.getattr("degraded")}')
+            return True
+        elif elapsed >= start_timeout:
+            logger_info(f'{self.name} recovery not started after {elapsed:.0f}s, '
+                        f'degraded={self.getattr("degraded")}')
+            return True
+        else:
+            return False
+        if now - self.last_report >= interval:
+            logger_info(f'{self.name} {action} {self.getattr("sync_completed")} '
+                        f'at {self.getattr("sync_speed")}K/sec after {elapsed:.0f}s')
+            self.last_report = now
+        return False
+
+
+class HotaddService:
+    def __init__(self, args):
+        self.args = args
+        self.arrays = {}
+
+    def array(self, name):
+        if name not in self.arrays:
+            self.arrays[name] = MdArray(name)
+        return self.arrays[name]
+
+    def timeout(self):
+        deadlines = [array.deadline(self.args.quiet, self.args.maxdelay)
+                     for array in self.arrays.values()]
+        deadlines = [deadline for deadline in deadlines if deadline is not None]
+        if any(array.recovery_start for array in self.arrays.values()):
+            deadlines.append(time.monotonic() + self.args.report_interval)
+        if not deadlines:
+            return None
+        return max(min(deadlines) - time.monotonic(), 0.001)
+
+    def poll(self):
+        now = time.monotonic()
+        for array in self.arrays.values():
+            deadline = array.deadline(self.args.quiet, self.args.maxdelay)
+            if deadline is not None and deadline <= now:
+                array.hotadd(self.args.speed_min, self.args.speed_max)
+            elif array.recovery_start and array.report(self.args.report_interval,
+                                                       self.args.start_timeout):
+                array.recovery_start = None
+
+    def serve(self):
+        if os.path.exists(SOCKPATH):
+            os.unlink(SOCKPATH)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(SOCKPATH)
+        logger_info(f'listening on {SOCKPATH}')
+
+        while True:
+            sock.settimeout(self.timeout())
+            try:
+                data = sock.recv(4096)
+            except socket.timeout:
+                self.poll()
+                continue
+            device, _, raidname = data.decode().partition(' ')
+            if device and raidname:
+                self.array(raidname).queue(device)
+            self.poll()
+
+
+def notify(device, raidname):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.sendto(f'{device} {raidname}'.encode(), SOCKPATH)
+
+
+def main(argv):
+    syslog.openlog('mdraid_hotadd')
+    if argv and argv[0] == 'notify':
+        notify(*argv[1:3])
+        return
+
+    ap = argparse.ArgumentParser('md hot-add service')
+    ap.add_argument('--quiet', type=float, default=3.0,
+                    help="seconds without a new member before an array is handled")
+    ap.add_argument('--maxdelay', type=float, default=15.0,
+                    help="max seconds a returned member is queued")
+    ap.add_argument('--speed-min', type=int, default=0,
+                    help="sync_speed_min in K/sec, 0 keeps the system default")
+    ap.add_argument('--speed-max', type=int, default=0,
+                    help="sync_speed_max in K/sec, 0 keeps the system default")
+    ap.add_argument('--report-interval', type=float, default=30.0,
+                    help="seconds between two recovery progress reports")
+    ap.add_argument('--start-timeout', type=float, default=60.0,
+                    help="seconds a degraded array may stay idle after the hot-add")
+    args = ap.parse_args(args=argv)
+    HotaddService(args).serve()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
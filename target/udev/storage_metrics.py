@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+
+# this file collects the state of the deployed storage components and
+# writes it as a prometheus textfile, to be exported by the textfile
+# collector of node-exporter. It reads sysfs, configfs and debugfs
+# directly and only runs lctl, sanlock and lvmlockctl for the state
+# they do not expose in files. It should be put in directory
+# /lib/lustre or /lib/lvm and is run by storage-metrics.timer.
+
+import argparse
+import glob
+import os
+import subprocess
+import sys
+import time
+
+
+def readfile(path):
+    try:
+        with open(path, 'r') as f:
+            return f.read().strip()
+    except OSError:
+        return ''
+
+
+def command(*cmd):
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=10)
+    except (OSError, subprocess.TimeoutExpired):
+        return ''
+    return result.stdout if result.returncode == 0 else ''
+
+
+class Metrics:
+    def __init__(self):
+        self.helps = {}
+        self.samples = []
+
+    def add(self, name, value, help, **labels):
+        self.helps.setdefault(name, help)
+        self.samples.append((name, labels, value))
+
+    def text(self):
+        lines = []
+        for name, help in self.helps.items():
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} gauge')
+            for sname, labels, value in self.samples:
+                if sname != name:
+                    continue
+                label = ','.join(f'{k}="{v}"' for k, v in sorted(labels.items()))
+                lines.append(f'{name}{{{label}}} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def collect_md(metrics):
+    names = {os.path.basename(os.path.realpath(path)): os.path.basename(path)
+             for path in glob.glob('/dev/md/*')}
+    for sysdir in glob.glob('/sys/block/md*/md'):
+        kname = sysdir.split('/')[3]
+        labels = {'device': kname, 'array': names.get(kname, kname)}
+        state = readfile(f'{sysdir}/array_state')
+        metrics.add('storage_md_active',
+                    int(state in ('clean', 'active', 'active-idle', 'write-pending')),
+                    'whether the md array is running', **labels)
+        metrics.add('storage_md_degraded', readfile(f'{sysdir}/degraded') or 0,
+                    'number of missing members of the md array', **labels)
+        metrics.add('storage_md_disks', readfile(f'{sysdir}/raid_disks') or 0,
+                    'number of members of the md array', **labels)
+
+        action = readfile(f'{sysdir}/sync_action') or 'idle'
+        completed = readfile(f'{sysdir}/sync_completed')
+        done, _, total = completed.partition(' / ')
+        ratio = int(done) / int(total) if total and int(total) else 1
+        metrics.add('storage_md_sync_completed_ratio', f'{ratio:.4f}',
+                    'progress of the current md sync action', action=action, **labels)
+        metrics.add('storage_md_sync_speed_kbytes', readfile(f'{sysdir}/sync_speed') or 0,
+                    'current md sync speed in K/sec', **labels)
+
+
+def collect_nvmet(metrics):
+    cfgdir = '/sys/kernel/config/nvmet'
+    for portdir in glob.glob(f'{cfgdir}/ports/*'):
+        port = os.path.basename(portdir)
+        trtype = readfile(f'{portdir}/addr_trtype')
+        traddr = readfile(f'{portdir}/addr_traddr')
+        for subsysdir in glob.glob(f'{portdir}/subsystems/*'):
+            metrics.add('storage_nvmet_port_subsystem', 1,
+                        'subsystem exported on a nvmet port', port=port,
+                        trtype=trtype, traddr=traddr, nqn=os.path.basename(subsysdir))
+
+    for subsysdir in glob.glob(f'{cfgdir}/subsystems/*'):
+        nqn = os.path.basename(subsysdir)
+        nsids = glob.glob(f'{subsysdir}/namespaces/*')
+        enabled = sum(1 for nsdir in nsids if readfile(f'{nsdir}/enable') == '1')
+        metrics.add('storage_nvmet_namespaces_enabled', enabled,
+                    'enabled namespaces of a nvmet subsystem', nqn=nqn)
+        # controllers are only exposed in debugfs by recent kernels.
+        if os.path.isdir(f'/sys/kernel/debug/nvmet/{nqn}'):
+            ctrls = glob.glob(f'/sys/kernel/debug/nvmet/{nqn}/ctrl*')
+            metrics.add('storage_nvmet_controllers', len(ctrls),
+                        'host controllers connected to a nvmet subsystem', nqn=nqn)
+
+
+def collect_iscsi(metrics):
+    for tpgdir in glob.glob('/sys/kernel/config/target/iscsi/iqn.*/tpgt_*'):
+        iqn = tpgdir.split('/')[-2]
+        tpgt = tpgdir.split('_')[-1]
+        sessions = [line for line in readfile(f'{tpgdir}/dynamic_sessions').split('\n')
+                    if line.strip()]
+        metrics.add('storage_iscsi_sessions', len(sessions),
+                    'initiator sessions logged in a iscsi target', iqn=iqn, tpgt=tpgt)
+        metrics.add('storage_iscsi_luns', len(glob.glob(f'{tpgdir}/lun/lun_*')),
+                    'luns of a iscsi target', iqn=iqn, tpgt=tpgt)
+
+
+def collect_lustre(metrics):
+    # target and client obd stats, e.g.
+    # obdfilter.afa01-OST0000.stats=
+    # read_bytes  1234 samples [bytes] 4096 1048576 1293942784
+    output = command('lctl', 'get_param',
+                     'obdfilter.*.stats', 'mdt.*.md_stats', 'osc.*.stats', 'mdc.*.stats')
+    param = obd = None
+    for line in output.splitlines():
+        if line.endswith('='):
+            param, obd, _ = line[:-1].split('.', 2)
+            continue
+        fields = line.split()
+        if not obd or len(fields) < 4 or fields[2] != 'samples':
+            continue
+        labels = {'type': param, 'obd': obd, 'stat': fields[0]}
+        metrics.add('storage_lustre_stats_samples', fields[1],
+                    'samples of a lustre obd stat', **labels)
+        if len(fields) >= 7:
+            metrics.add('storage_lustre_stats_sum', fields[6],
+                        'sum of a lustre obd stat in its unit', unit=fields[3].strip('[]'),
+                        **labels)
+
+    # client rpcs in flight, e.g. "read RPCs in flight:  0"
+    output = command('lctl', 'get_param', 'osc.*.rpc_stats', 'mdc.*.rpc_stats')
+    for line in output.splitlines():
+        if line.endswith('='):
+            param, obd, _ = line[:-1].split('.', 2)
+            continue
+        if 'RPCs in flight:' in line:
+            op = line.split()[0]
+            metrics.add('storage_lustre_rpcs_in_flight', line.split(':')[1].strip(),
+                        'rpcs in flight of a lustre client obd', type=param, obd=obd, op=op)
+
+
+def collect_lnet(metrics):
+    # nid refs state last max rtr min tx min queue
+    for path in ('/sys/kernel/debug/lnet/peers', '/proc/sys/lnet/peers'):
+        content = readfile(path)
+        if content:
+            break
+    for line in content.splitlines()[1:]:
+        fields = line.split()
+        if len(fields) < 10:
+            continue
+        nid = fields[0]
+        for kind, value in zip(('max', 'rtr', 'rtr_min', 'tx', 'tx_min'), fields[4:9]):
+            metrics.add('storage_lnet_peer_credits', value,
+                        'credits of a lnet peer', nid=nid, kind=kind)
+        metrics.add('storage_lnet_peer_queue_bytes', fields[9],
+                    'bytes queued for a lnet peer', nid=nid)
+        metrics.add('storage_lnet_peer_up', int(fields[2] == 'up'),
+                    'whether a lnet peer is up', nid=nid)
+
+
+def collect_locks(metrics):
+    # s lvm_vg01:12:/dev/mapper/vg01-lvmlock:0
+    # r lvm_vg01:Q8dnqN-...:/dev/mapper/vg01-lvmlock:71303168:2 p 1234
+    lockspaces, resources = {}, {}
+    for line in command('sanlock', 'client', 'status').splitlines():
+        kind, _, rest = line.partition(' ')
+        lsname = rest.split(':')[0]
+        if kind == 's':
+            lockspaces[lsname] = 1
+        elif kind == 'r':
+            resources[lsname] = resources.get(lsname, 0) + 1
+    for lsname in lockspaces:
+        metrics.add('storage_sanlock_resources', resources.get(lsname, 0),
+                    'sanlock resources held in a lockspace', lockspace=lsname)
+
+    # VG vg01 lock_type=sanlock Q8dnqN-...
+    # LK VG sh ver 12 pid 0 ()
+    vg = None
+    locks = {}
+    for line in command('lvmlockctl', '-i').splitlines():
+        fields = line.split()
+        if fields[:1] == ['VG'] and len(fields) > 1:
+            vg = fields[1]
+            locks[vg] = 0
+        elif fields[:1] == ['LK'] and vg:
+            locks[vg] += 1
+    for vg, count in locks.items():
+        metrics.add('storage_lvmlockd_locks', count,
+                    'locks held by lvmlockd in a vg', vg=vg)
+
+
+collectors = {
+    'md':       collect_md,
+    'nvmet':    collect_nvmet,
+    'iscsi':    collect_iscsi,
+    'lustre':   collect_lustre,
+    'lnet':     collect_lnet,
+    'locks':    collect_locks,
+}
+
+
+def main(argv):
+    ap = argparse.ArgumentParser('storage metrics collector')
+    ap.add_argument('-o', '--output', default='/var/lib/prometheus/node-exporter/storage.prom',
+                    help="path of the textfile written")
+    args = ap.parse_args(args=argv)
+
+    metrics = Metrics()
+    for name, collect in collectors.items():
+        start = time.monotonic()
+        try:
+            collect(metrics)
+            success = 1
+        except Exception as e:
+            print(f'collector {name} failed: {e}', file=sys.stderr)
+            success = 0
+        metrics.add('storage_metrics_collector_success', success,
+                    'whether a storage metrics collector succeeded', collector=name)
+        metrics.add('storage_metrics_collector_seconds', f'{time.monotonic() - start:.3f}',
+                    'time spent by a storage metrics collector', collector=name)
+
+    # write aside and rename, the exporter never reads a partial file.
+    os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    tmppath = f'{args.output}.{os.getpid()}'
+    with open(tmppath, 'w') as f:
+        f.write(metrics.text())
+    os.rename(tmppath, args.output)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
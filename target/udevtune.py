@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+import argparse
+import sys
+import yaml
+
+# the udev match of each device class. Fabric namespaces are those of a
+# linux nvmet target, as in 60-persistent-storage-nvme.rules.
+CLASSES = {
+    'nvme-local':   'KERNEL=="nvme*[0-9]n*[0-9]", ENV{DEVTYPE}=="disk", ENV{ID_MODEL}!="Linux"',
+    'nvme-fabric':  'KERNEL=="nvme*[0-9]n*[0-9]", ENV{DEVTYPE}=="disk", ENV{ID_MODEL}=="Linux"',
+    'iscsi':        'KERNEL=="sd*[!0-9]", SUBSYSTEMS=="scsi", ATTRS{vendor}=="LIO-ORG"',
+    'md':           'KERNEL=="md*", ENV{DEVTYPE}=="disk"',
+    'dm':           'KERNEL=="dm-*", ENV{DEVTYPE}=="disk"',
+}
+
+HEADER = """\
+# generated by udevtune.py from {config}, do not edit.
+
+SUBSYSTEM!="block", GOTO="queue_tuning_end"
+ACTION!="add|change", GOTO="queue_tuning_end"
+"""
+
+
+def attr_path(name):
+    return name if '/' in name else f'queue/{name}'
+
+
+def class_rules(name, attrs, libdir):
+    if name not in CLASSES:
+        raise ValueError(f'unknown device class: {name}')
+    match = CLASSES[name]
+    rules = [f'# {name}']
+    if 'stripe' in attrs.values():
+        if name != 'md':
+            raise ValueError(f'stripe is only valid for md, not {name}')
+        rules.append(f'{match}, TEST=="md/chunk_size", IMPORT{{program}}="{libdir}/md_stripe_kb.sh %k"')
+
+    # an attribute the device does not have, like the scheduler of a
+    # bio based dm device, is skipped rather than failed.
+    for attr, value in attrs.items():
+        path = attr_path(attr)
+        if value == 'stripe':
+            rules.append(f'{match}, ENV{{MD_STRIPE_KB}}=="?*", TEST=="{path}", '
+                         f'ATTR{{{path}}}="$env{{MD_STRIPE_KB}}"')
+        else:
+            rules.append(f'{match}, TEST=="{path}", ATTR{{{path}}}="{value}"')
+    return rules
+
+
+def generate(config, cfgname, libdir):
+    lines = [HEADER.format(config=cfgname)]
+    for name, attrs in (config.get('classes') or {}).items():
+        lines += class_rules(name, attrs or {}, libdir) + ['']
+    lines.append('LABEL="queue_tuning_end"')
+    return '\n'.join(lines) + '\n'
+
+
+def main():
+    parser = argparse.ArgumentParser(description="queue tuning udev rules generator")
+    parser.add_argument('-c', '--config', type=str, default='./yaml/udevtune.yaml',
+                        help="Path to the config file")
+    parser.add_argument('-o', '--output', type=str,
+                        help="path of the rules file written, stdout by default")
+    parser.add_argument('--libdir', type=str, default='/lib/lustre',
+                        help="directory of md_stripe_kb.sh on the hosts")
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as f:
+        config = yaml.safe_load(f)
+
+    rules = generate(config, args.config, args.libdir)
+    if not args.output:
+        sys.stdout.write(rules)
+        return
+    with open(args.output, 'w') as f:
+        f.write(rules)
+
+
+if __name__ == "__main__":
+    main()